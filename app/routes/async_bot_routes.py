@@ -0,0 +1,277 @@
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from quart import Blueprint, Response, request, jsonify
+from app.services import metrics
+from app.services.ai_client import LLMError
+from app.services.context_builder import lead_tools
+from app.services.llm_router import router
+from app.services.parser import JsonBlockFilter
+from app.routes.bot_routes import (
+    storage, conversations, leads, greetings, store_setup, parse_chat_request, greeting_messages, reply_messages,
+    last_bot_message, start_conversation, record_reply, visible_text, sse_event, lead_query,
+    chat_flight, flight_key, replays, replayed_events, interrupted_error
+)
+from app.services.lead_export import iter_json_array, iter_ndjson, iter_csv
+
+# Async twin of bot_routes: same URLs and payloads, but provider calls are
+# awaited on httpx.AsyncClient and store reads and writes (SQLite queries,
+# conversation files read on a cache miss) run off the event loop, so an
+# in-flight LLM call no longer pins a worker thread.
+bot_bp = Blueprint("bot", __name__)
+
+# --- Errors ---
+@bot_bp.errorhandler(LLMError)
+async def handle_llm_error(e):
+    status = 503 if e.retryable else 502
+    return jsonify({"reply": e.user_message, "error": e.message, "provider": e.provider}), status
+
+# --- Helpers ---
+async def agenerate_reply(model, messages, tools=None):
+    with metrics.span("llm"):
+        return await router.agenerate(model, messages, tools)
+
+async def aopening_greeting(setup, model):
+    welcome_msg = greetings.take(setup, model)
+    if welcome_msg is None:
+        welcome_msg = await agenerate_reply(model, greeting_messages(setup))
+        greetings.add(setup, model, welcome_msg)
+    return welcome_msg
+
+async def history_with(conv_key, user_message):
+    """The stored history plus the new user turn, read on a worker thread."""
+    history = await asyncio.to_thread(conversations.__getitem__, conv_key)
+    return history + [{"role": "user", "message": user_message}]
+
+# Pieces of an export (leads, or 64 KiB of CSV) pulled per worker-thread hop
+EXPORT_BATCH = 256
+
+async def _aiter(chunks):
+    """
+    Quart streams async iterables. Each step of an export runs a store query
+    or takes the store's lock, so it is pulled on a worker thread, a batch at a time.
+    """
+    while True:
+        batch = await asyncio.to_thread(list, itertools.islice(chunks, EXPORT_BATCH))
+        if not batch:
+            return
+        yield "".join(batch)
+
+def astream_reply(model, messages, tools=None):
+    return router.astream(model, messages, tools)
+
+# Turns waiting on a conversation inside this worker: conv_key -> [asyncio.Lock, holders and waiters]
+_turn_locks = {}
+# Backoff between non-blocking tries of the store's lock while another process holds it
+LOCK_POLL_MIN = 0.005
+LOCK_POLL_MAX = 0.1
+
+@asynccontextmanager
+async def conversation_lock(conv_key):
+    """
+    conversations.lock(conv_key) without tying up a thread: turns in this
+    worker queue on an asyncio.Lock, and the one at the head only ever tries
+    the store's lock without blocking, backing off while another process holds it.
+    """
+    entry = _turn_locks.get(conv_key)
+    if entry is None:
+        entry = _turn_locks[conv_key] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            lock = conversations.lock(conv_key)
+            with metrics.span("lock_wait"):
+                delay = LOCK_POLL_MIN
+                while not lock.acquire(blocking=False):
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, LOCK_POLL_MAX)
+            try:
+                yield
+            finally:
+                lock.release()
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del _turn_locks[conv_key]
+
+# --- Routes ---
+@bot_bp.route("/setup", methods=["POST"])
+async def save_setup():
+    data = await request.get_json()
+    await asyncio.to_thread(store_setup, data)
+    return jsonify({"status": "ok", "message": "Setup saved"})
+
+@bot_bp.route("/setup/<user_id>", methods=["GET"])
+async def get_setup_for_user(user_id):
+    user_data = await asyncio.to_thread(storage.setups.get, user_id)
+    if not user_data:
+        return jsonify({"error": "User data not found"}), 404
+    return jsonify(user_data)
+
+@bot_bp.route("/clear-conversations", methods=["POST"])
+async def clear_conversations():
+    await asyncio.to_thread(conversations.clear)
+    return jsonify({"status": "ok", "message": "All conversations cleared"})
+
+@bot_bp.route("/clinicchat", methods=["POST"])
+async def chat():
+    request_obj = parse_chat_request(await request.get_json())
+
+    page_id = request_obj.page_id
+    sender_id = request_obj.user_id
+    model = request_obj.model.lower() if request_obj.model else "chatgpt"
+
+    setup = await asyncio.to_thread(storage.setups.get_for_page, page_id)
+    if not setup:
+        return jsonify({"reply": "Please complete your business setup first."})
+
+    conv_key = f"{page_id}_{sender_id}"
+    user_message = request_obj.message.strip()
+
+    key = flight_key(conv_key, user_message, request.headers.get("Idempotency-Key"))
+    return jsonify(await chat_flight.ado(key, lambda: chat_turn(setup, conv_key, page_id, sender_id, user_message, model),
+                                         replay=replays(key)))
+
+async def chat_turn(setup, conv_key, page_id, sender_id, user_message, model):
+    async with conversation_lock(conv_key):
+        # --- Initialize conversation dynamically using AI ---
+        if not await asyncio.to_thread(conversations.__contains__, conv_key):
+            welcome_msg = await asyncio.to_thread(start_conversation, conv_key, await aopening_greeting(setup, model))
+
+            if not user_message:
+                return {"reply": welcome_msg}
+
+        # --- If user message is empty, return last bot message ---
+        elif not user_message:
+            return {"reply": await asyncio.to_thread(last_bot_message, conv_key)}
+
+        # --- Process non-empty user messages ---
+        history = await history_with(conv_key, user_message)
+        bot_reply = await agenerate_reply(model, reply_messages(setup, conv_key, history), lead_tools(setup))
+
+        bot_reply_visible = await asyncio.to_thread(record_reply, conv_key, page_id, sender_id, user_message, bot_reply)
+    return {"reply": bot_reply_visible}
+
+@bot_bp.route("/clinicchat/stream", methods=["POST"])
+async def chat_stream():
+    request_obj = parse_chat_request(await request.get_json())
+
+    page_id = request_obj.page_id
+    sender_id = request_obj.user_id
+    model = request_obj.model.lower() if request_obj.model else "chatgpt"
+    setup = await asyncio.to_thread(storage.setups.get_for_page, page_id)
+    conv_key = f"{page_id}_{sender_id}"
+    user_message = request_obj.message.strip()
+    key = flight_key(conv_key, user_message, request.headers.get("Idempotency-Key"))
+    outcome = {}
+
+    def done(payload):
+        outcome["payload"] = payload
+        return sse_event("done", payload)
+
+    async def events():
+        if not setup:
+            yield done({"reply": "Please complete your business setup first."})
+            return
+
+        greeting_only = False
+        if not await asyncio.to_thread(conversations.__contains__, conv_key):
+            welcome_msg = greetings.take(setup, model)
+            if welcome_msg is None and not user_message:
+                # Cache miss on an opening request: stream the greeting itself
+                greeting_only = True
+            else:
+                if welcome_msg is None:
+                    welcome_msg = await aopening_greeting(setup, model)
+                welcome_msg = await asyncio.to_thread(start_conversation, conv_key, welcome_msg)
+                if not user_message:
+                    yield sse_event("delta", {"text": visible_text(welcome_msg)})
+                    yield done({"reply": visible_text(welcome_msg)})
+                    return
+        elif not user_message:
+            yield done({"reply": await asyncio.to_thread(last_bot_message, conv_key)})
+            return
+
+        if greeting_only:
+            messages, tools = greeting_messages(setup), None
+        else:
+            messages = reply_messages(setup, conv_key, await history_with(conv_key, user_message))
+            tools = lead_tools(setup)
+
+        block_filter = JsonBlockFilter()
+        chunks = []
+        async for delta in astream_reply(model, messages, tools):
+            chunks.append(delta)
+            visible = block_filter.feed(delta)
+            if visible:
+                yield sse_event("delta", {"text": visible})
+        tail = block_filter.finish()
+        if tail:
+            yield sse_event("delta", {"text": tail})
+
+        bot_reply = "".join(chunks).strip()
+        if greeting_only:
+            greetings.add(setup, model, bot_reply)
+            visible_reply = visible_text(await asyncio.to_thread(start_conversation, conv_key, bot_reply))
+        else:
+            visible_reply = await asyncio.to_thread(record_reply, conv_key, page_id, sender_id, user_message, bot_reply)
+        yield done({"reply": visible_reply})
+
+    async def guarded():
+        future, leader = chat_flight.join(key)
+        if not leader:
+            try:
+                for event in replayed_events(await asyncio.wrap_future(future)):
+                    yield event
+            except LLMError as e:
+                yield sse_event("error", {"reply": e.user_message, "error": e.message, "provider": e.provider})
+            return
+        error = None
+        try:
+            async with conversation_lock(conv_key):
+                async for event in events():
+                    yield event
+        except LLMError as e:
+            error = e
+            yield sse_event("error", {"reply": e.user_message, "error": e.message, "provider": e.provider})
+        finally:
+            if "payload" in outcome:
+                chat_flight.complete(key, future, outcome["payload"], replay=replays(key))
+            else:
+                chat_flight.complete(key, future, error=error or interrupted_error())
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(guarded(), mimetype="text/event-stream", headers=headers)
+
+@bot_bp.route("/leads", methods=["GET"])
+async def get_all_leads():
+    try:
+        page_id, updated_since, limit = lead_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if limit is None:
+        return Response(_aiter(iter_json_array(leads, page_id, updated_since)), mimetype="application/json")
+    try:
+        items, next_cursor = await asyncio.to_thread(leads.page, request.args.get("cursor"), limit, page_id, updated_since)
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    return jsonify({"leads": items, "next_cursor": next_cursor})
+
+@bot_bp.route("/leads/export", methods=["GET"])
+async def export_leads():
+    try:
+        page_id, updated_since, _ = lead_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if request.args.get("format", "ndjson") == "csv":
+        headers = {"Content-Disposition": "attachment; filename=leads.csv"}
+        return Response(_aiter(iter_csv(leads, page_id, updated_since)), mimetype="text/csv", headers=headers)
+    return Response(_aiter(iter_ndjson(leads, page_id, updated_since)), mimetype="application/x-ndjson")
+
+@bot_bp.route("/clear-leads", methods=["POST"])
+async def clear_leads_endpoint():
+    try:
+        await asyncio.to_thread(leads.clear)
+        return jsonify({"status": "ok", "message": "All leads cleared"})
+    except Exception as e:
+        return jsonify({"status": "error", "message": str(e)}), 500
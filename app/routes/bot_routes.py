@@ -1,27 +1,31 @@
-import json
-import os
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, Response, request, jsonify, stream_with_context
 from typing import List, Optional
+from contextlib import contextmanager
 from dataclasses import dataclass, field as dc_field
-from app.services.file_store import setups_by_user, save_setups, leads, save_leads, page_to_setup_map, clear_leads
-from app.services.context_builder import build_context
-from app.services.ai_client import generate_deepseek_reply, generate_chatgpt_reply
-from app.services.parser import parse_booking_confirmation
-import re
+from datetime import datetime, timezone
+from app.services import metrics
+from app.services.storage import get_storage
+from app.services.lead_export import iter_json_array, iter_ndjson, iter_csv
+from app.services.context_builder import lead_tools
+from app.services.ai_client import LLMError
+from app.services.llm_router import router
+from app.services.parser import parse_reply, lead_updates, JsonBlockFilter
+from app.services.context_window import greeting_messages, reply_messages
+from app.services.greeting_cache import GreetingCache
+from app.services.single_flight import SingleFlight
+import hashlib
+import json
+import os
 
 bot_bp = Blueprint("bot", __name__)
-conversations = {}
-CONVERSATIONS_FILE = "conversations.json"
-
-# --- Helper to save conversations to file ---
-def save_conversations_to_file():
-    with open(CONVERSATIONS_FILE, "w", encoding="utf-8") as f:
-        json.dump(conversations, f, indent=2, ensure_ascii=False)
+MAX_LEADS_PAGE = 500
+# Seconds a chat result is replayed to retries carrying the same Idempotency-Key
+CHAT_REPLAY_TTL = float(os.getenv("CHAT_REPLAY_TTL", "10"))
 
-# --- Load conversations from file on startup ---
-if os.path.exists(CONVERSATIONS_FILE):
-    with open(CONVERSATIONS_FILE, "r", encoding="utf-8") as f:
-        conversations.update(json.load(f))
+# --- Persistence: JSON files (default) or SQLite, chosen by STORAGE_BACKEND ---
+storage = get_storage()
+conversations = storage.conversations
+leads = storage.leads
 
 # --- Data classes ---
 @dataclass
@@ -55,42 +59,45 @@ class ChatRequest:
     model: Optional[str] = "chatgpt"
     modelConfig: Optional[dict] = None
 
+# --- Errors ---
+@bot_bp.errorhandler(LLMError)
+def handle_llm_error(e):
+    # Provider failures are reported to the client but never written to history
+    status = 503 if e.retryable else 502
+    return jsonify({"reply": e.user_message, "error": e.message, "provider": e.provider}), status
+
 # --- Routes ---
-@bot_bp.route("/setup", methods=["POST"])
-def save_setup():
-    data = request.json
+def store_setup(data):
     setup = SetupModel(**data)
-    user_id = setup.user_id
-    setups_by_user[user_id] = data
-    page_to_setup_map[setup.page_id] = data
-    save_setups()
+    storage.setups.save(data)
 
     # Clear existing conversations for this page
-    keys_to_delete = [k for k in conversations if k.startswith(setup.page_id)]
-    for k in keys_to_delete:
-        del conversations[k]
+    conversations.delete_prefix(setup.page_id)
+
+    # Drop greetings for the old setup and pre-generate new ones off the request path
+    greetings.prewarm(storage.setups.get_for_page(setup.page_id))
+    return setup
 
-    save_conversations_to_file()
+@bot_bp.route("/setup", methods=["POST"])
+def save_setup():
+    store_setup(request.json)
     return jsonify({"status": "ok", "message": "Setup saved"})
 
 @bot_bp.route("/setup/<user_id>", methods=["GET"])
 def get_setup_for_user(user_id):
-    user_data = setups_by_user.get(user_id)
+    user_data = storage.setups.get(user_id)
     if not user_data:
         return jsonify({"error": "User data not found"}), 404
     return jsonify(user_data)
 
 @bot_bp.route("/clear-conversations", methods=["POST"])
 def clear_conversations():
-    global conversations
-    conversations = {}
-    save_conversations_to_file()
+    conversations.clear()
     return jsonify({"status": "ok", "message": "All conversations cleared"})
 
-@bot_bp.route("/clinicchat", methods=["POST"])
-def chat():
-    data = request.json
-    request_obj = ChatRequest(
+# --- Chat helpers shared by the blocking, streaming and async endpoints ---
+def parse_chat_request(data) -> ChatRequest:
+    return ChatRequest(
         user_id=data.get("user_id"),
         message=data.get("message", ""),
         page_id=data.get("page_id"),
@@ -98,95 +105,302 @@ def chat():
         modelConfig=data.get("modelConfig")
     )
 
+def opening_greeting(setup, model):
+    """Greeting for a new conversation: from the cache, or generated on a miss."""
+    welcome_msg = greetings.take(setup, model)
+    if welcome_msg is None:
+        welcome_msg = generate_reply(model, greeting_messages(setup))
+        greetings.add(setup, model, welcome_msg)
+    return welcome_msg
+
+# `model` picks the primary provider; the router hedges and fails over to the other
+# `tools` (lead_tools(setup)) asks for lead fields as a structured call where the provider supports it
+def generate_reply(model, messages, tools=None):
+    with metrics.span("llm"):
+        return router.generate(model, messages, tools)
+
+def stream_reply(model, messages, tools=None):
+    return router.stream(model, messages, tools)
+
+# --- Welcome messages: pooled per setup version, refilled in the background ---
+greetings = GreetingCache(generate_reply, greeting_messages)
+
+# --- Duplicate requests: concurrent ones share one turn, keyed retries replay its result ---
+chat_flight = SingleFlight(ttl=CHAT_REPLAY_TTL)
+
+def flight_key(conv_key, user_message, idempotency_key=None):
+    """
+    Requests that count as the same turn: same conversation and the same
+    Idempotency-Key header, or the same message when the client sends none.
+    """
+    if idempotency_key:
+        return (conv_key, "key", idempotency_key)
+    return (conv_key, "message", hashlib.sha256(user_message.encode("utf-8")).hexdigest())
+
+def replays(key):
+    """
+    Whether a finished turn is replayed to later requests with `key`. Only
+    with an Idempotency-Key: the same text sent again ("yes" to the next
+    question) is a new turn, so unkeyed duplicates are only merged while
+    the first one is still running.
+    """
+    return key[1] == "key"
+
+def last_bot_message(conv_key):
+    for msg in reversed(conversations[conv_key]):
+        if msg.get("role") == "bot":
+            return msg.get("message")
+    return None
+
+@contextmanager
+def conversation_lock(conv_key):
+    """conversations.lock(conv_key), with the wait recorded as the lock_wait stage."""
+    lock = conversations.lock(conv_key)
+    with metrics.span("lock_wait"):
+        lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
+
+# The writers below expect the caller to hold conversations.lock(conv_key):
+# turns of one conversation then run one at a time, each seeing the last reply.
+def start_conversation(conv_key, welcome_msg):
+    """Store the opening greeting, or return the one stored while we waited for the lock."""
+    history = conversations.get(conv_key)
+    if history:
+        return history[0]["message"]
+    conversations.append(conv_key, {"role": "bot", "message": welcome_msg})
+    return welcome_msg
+
+def record_reply(conv_key, page_id, sender_id, user_message, bot_reply):
+    """Store a completed turn, extract leads and return the user-visible reply."""
+    with metrics.span("persist"):
+        conversations.extend(conv_key, [
+            {"role": "user", "message": user_message},
+            {"role": "bot", "message": bot_reply},
+        ])
+
+    # Extract leads and the visible text in one pass over the reply
+    with metrics.span("lead_parse"):
+        parsed = parse_reply(bot_reply)
+    metrics.inc(metrics.LEAD_PARSE, result=parsed.status)
+    if parsed.fields:
+        # Only new or changed values are written; the store merges them into the lead
+        updates = lead_updates(parsed.fields, leads.get(page_id, sender_id))
+        if updates:
+            with metrics.span("persist"):
+                leads.upsert(page_id, sender_id, updates)
+
+    return parsed.visible
+
+def replayed_events(payload):
+    """The stream for a coalesced or replayed request: the whole reply as one delta, then done."""
+    if payload.get("reply"):
+        yield sse_event("delta", {"text": payload["reply"]})
+    yield sse_event("done", payload)
+
+def interrupted_error():
+    # What requests waiting on a stream see when its client went away mid-turn
+    return LLMError("chat", "request was interrupted before the reply was stored", retryable=True)
+
+def visible_text(bot_reply):
+    with metrics.span("strip"):
+        return parse_reply(bot_reply).visible
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@bot_bp.route("/clinicchat", methods=["POST"])
+def chat():
+    request_obj = parse_chat_request(request.json)
+
     page_id = request_obj.page_id
     sender_id = request_obj.user_id
     model = request_obj.model.lower() if request_obj.model else "chatgpt"
 
-    setup = page_to_setup_map.get(page_id)
+    setup = storage.setups.get_for_page(page_id)
     if not setup:
         return jsonify({"reply": "Please complete your business setup first."})
 
     conv_key = f"{page_id}_{sender_id}"
     user_message = request_obj.message.strip()
 
-    # --- Initialize conversation dynamically using AI ---
-    if conv_key not in conversations:
-        conversations[conv_key] = []
+    key = flight_key(conv_key, user_message, request.headers.get("Idempotency-Key"))
+    return jsonify(chat_flight.do(key, lambda: chat_turn(setup, conv_key, page_id, sender_id, user_message, model),
+                                  replay=replays(key)))
+
+def chat_turn(setup, conv_key, page_id, sender_id, user_message, model):
+    """One /clinicchat turn; returns the response payload."""
+    with conversation_lock(conv_key):
+        # --- Initialize conversation dynamically using AI ---
+        if conv_key not in conversations:
+            welcome_msg = start_conversation(conv_key, opening_greeting(setup, model))
+
+            # Return the AI-generated first greeting immediately
+            if not user_message:
+                return {"reply": welcome_msg}
+
+        # --- If user message is empty, return last bot message ---
+        elif not user_message:
+            return {"reply": last_bot_message(conv_key)}
+
+        # --- Process non-empty user messages ---
+        # The user turn is only stored together with a successful reply, so a
+        # provider failure leaves the history untouched for the retry
+        history = conversations[conv_key] + [{"role": "user", "message": user_message}]
+        bot_reply = generate_reply(model, reply_messages(setup, conv_key, history), lead_tools(setup))
+
+        bot_reply_visible = record_reply(conv_key, page_id, sender_id, user_message, bot_reply)
+    return {"reply": bot_reply_visible}
+
+@bot_bp.route("/clinicchat/stream", methods=["POST"])
+def chat_stream():
+    """
+    Same contract as /clinicchat, answered as Server-Sent Events:
+    `delta` events carry visible text as it arrives, then a final `done`
+    event carries the full visible reply (or `error` on provider failure).
+    """
+    request_obj = parse_chat_request(request.json)
 
-        # Prompt to generate dynamic first greeting
-        prompt = f"""{build_context(setup)}
-
-User hasn't said anything yet. Generate a friendly, professional welcome message for career coaching.
-"""
-        if model == "deepseek":
-            welcome_msg = generate_deepseek_reply(prompt)
+    page_id = request_obj.page_id
+    sender_id = request_obj.user_id
+    model = request_obj.model.lower() if request_obj.model else "chatgpt"
+    setup = storage.setups.get_for_page(page_id)
+    conv_key = f"{page_id}_{sender_id}"
+    user_message = request_obj.message.strip()
+    key = flight_key(conv_key, user_message, request.headers.get("Idempotency-Key"))
+    outcome = {}
+
+    def done(payload):
+        outcome["payload"] = payload
+        return sse_event("done", payload)
+
+    def events():
+        if not setup:
+            yield done({"reply": "Please complete your business setup first."})
+            return
+
+        greeting_only = False
+        if conv_key not in conversations:
+            welcome_msg = greetings.take(setup, model)
+            if welcome_msg is None and not user_message:
+                # Cache miss on an opening request: stream the greeting itself
+                greeting_only = True
+            else:
+                if welcome_msg is None:
+                    welcome_msg = generate_reply(model, greeting_messages(setup))
+                    greetings.add(setup, model, welcome_msg)
+                welcome_msg = start_conversation(conv_key, welcome_msg)
+                if not user_message:
+                    yield sse_event("delta", {"text": visible_text(welcome_msg)})
+                    yield done({"reply": visible_text(welcome_msg)})
+                    return
+        elif not user_message:
+            yield done({"reply": last_bot_message(conv_key)})
+            return
+
+        if greeting_only:
+            messages, tools = greeting_messages(setup), None
         else:
-            welcome_msg = generate_chatgpt_reply(prompt)
-
-        conversations[conv_key].append({"role": "bot", "message": welcome_msg})
-        save_conversations_to_file()
-
-        # Return the AI-generated first greeting immediately
-        if not user_message:
-            return jsonify({"reply": welcome_msg})
-
-    # --- If user message is empty, return last bot message ---
-    elif not user_message:
-        for msg in reversed(conversations[conv_key]):
-            if msg.get("role") == "bot":
-                return jsonify({"reply": msg.get("message")})
-
-    # --- Process non-empty user messages ---
-    if user_message:
-        conversations[conv_key].append({"role": "user", "message": user_message})
-        save_conversations_to_file()
-
-        conversation_history = "\n".join([f"{m['role'].capitalize()}: {m['message']}" for m in conversations[conv_key]])
-        prompt = f"""{build_context(setup)}
-
-Conversation history:
-{conversation_history}
-
-Please respond as the business assistant.
-"""
-
-        if model == "deepseek":
-            bot_reply = generate_deepseek_reply(prompt)
+            messages = reply_messages(setup, conv_key, conversations[conv_key] + [{"role": "user", "message": user_message}])
+            tools = lead_tools(setup)
+
+        block_filter = JsonBlockFilter()
+        chunks = []
+        for delta in stream_reply(model, messages, tools):
+            chunks.append(delta)
+            visible = block_filter.feed(delta)
+            if visible:
+                yield sse_event("delta", {"text": visible})
+        tail = block_filter.finish()
+        if tail:
+            yield sse_event("delta", {"text": tail})
+
+        bot_reply = "".join(chunks).strip()
+        if greeting_only:
+            greetings.add(setup, model, bot_reply)
+            visible_reply = visible_text(start_conversation(conv_key, bot_reply))
         else:
-            bot_reply = generate_chatgpt_reply(prompt)
-
-        conversations[conv_key].append({"role": "bot", "message": bot_reply})
-        save_conversations_to_file()
-
-        # Extract leads
-        confirmed = parse_booking_confirmation(bot_reply)
-        if confirmed:
-            confirmed["user_id"] = sender_id
-            confirmed["page_id"] = page_id
-
-            existing_lead = next((l for l in leads if l["user_id"] == sender_id and l["page_id"] == page_id), None)
-            if existing_lead:
-                existing_lead.update(confirmed)
+            visible_reply = record_reply(conv_key, page_id, sender_id, user_message, bot_reply)
+        yield done({"reply": visible_reply})
+
+    def guarded():
+        future, leader = chat_flight.join(key)
+        if not leader:
+            try:
+                yield from replayed_events(future.result())
+            except LLMError as e:
+                yield sse_event("error", {"reply": e.user_message, "error": e.message, "provider": e.provider})
+            return
+        error = None
+        try:
+            with conversation_lock(conv_key):
+                yield from events()
+        except LLMError as e:
+            error = e
+            yield sse_event("error", {"reply": e.user_message, "error": e.message, "provider": e.provider})
+        finally:
+            if "payload" in outcome:
+                chat_flight.complete(key, future, outcome["payload"], replay=replays(key))
             else:
-                leads.append(confirmed)
-
-            save_leads()
-
-        bot_reply_visible = re.sub(r"<<JSON>>.*?<<ENDJSON>>", "", bot_reply, flags=re.DOTALL).strip()
-        return jsonify({"reply": bot_reply_visible})
-
-    return jsonify({"reply": ""})
-
-
+                chat_flight.complete(key, future, error=error or interrupted_error())
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(guarded()), mimetype="text/event-stream", headers=headers)
+
+
+
+def lead_query(args):
+    """
+    Filters and paging from /leads query args: (page_id, updated_since, limit or None).
+    updated_since is normalized to the stores' UTC timestamps, which compare as
+    strings; a value that is not ISO-8601 raises ValueError.
+    """
+    limit = None
+    if "limit" in args or "cursor" in args:
+        limit = min(max(args.get("limit", 100, type=int), 1), MAX_LEADS_PAGE)
+    updated_since = args.get("updated_since")
+    if updated_since:
+        try:
+            since = datetime.fromisoformat(updated_since)
+        except ValueError:
+            raise ValueError("Invalid updated_since: expected an ISO-8601 timestamp") from None
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        updated_since = since.astimezone(timezone.utc).isoformat(timespec="seconds")
+    return args.get("page_id"), updated_since, limit
 
 @bot_bp.route("/leads", methods=["GET"])
 def get_all_leads():
-    return jsonify(leads)
+    try:
+        page_id, updated_since, limit = lead_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if limit is None:
+        # No paging requested: the full array, streamed instead of built in memory
+        return Response(iter_json_array(leads, page_id, updated_since), mimetype="application/json")
+    try:
+        items, next_cursor = leads.page(request.args.get("cursor"), limit, page_id, updated_since)
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    return jsonify({"leads": items, "next_cursor": next_cursor})
+
+@bot_bp.route("/leads/export", methods=["GET"])
+def export_leads():
+    try:
+        page_id, updated_since, _ = lead_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if request.args.get("format", "ndjson") == "csv":
+        headers = {"Content-Disposition": "attachment; filename=leads.csv"}
+        return Response(iter_csv(leads, page_id, updated_since), mimetype="text/csv", headers=headers)
+    return Response(iter_ndjson(leads, page_id, updated_since), mimetype="application/x-ndjson")
 
 @bot_bp.route("/clear-leads", methods=["POST"])
 def clear_leads_endpoint():
     try:
-        clear_leads()  # call the function from file_store.py
+        leads.clear()
         return jsonify({"status": "ok", "message": "All leads cleared"})
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
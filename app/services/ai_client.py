@@ -1,11 +1,31 @@
+import asyncio
+import json
+import logging
 import os
+import random
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Iterator, List, Optional
+
+import httpcore
 import httpx
 
+from app.services import metrics
+from app.services.context_builder import LEAD_TOOL
+from app.services.parser import lead_block, parse_block
+
+logger = logging.getLogger(__name__)
+
 # Load API key from .env
 OPENAI_API_KEY = os.environ.get("OPENAI_API")
 DEESEEK_API_KEY = os.environ.get("DEEPSEEK_API")
-DEESEEK_BASE_URL = "https://api.deepseek.com/v1"
-OPENAI_BASE_URL = "https://api.openai.com/v1"
+DEESEEK_BASE_URL = os.environ.get("DEEPSEEK_BASE_URL", "https://api.deepseek.com/v1")
+OPENAI_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
 
 if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY not set in .env")
@@ -13,54 +33,731 @@ if not OPENAI_API_KEY:
 if not DEESEEK_API_KEY:
     raise RuntimeError("DEESEEK_API not set in .env")
 
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+POOL_SHARD_SIZE = int(os.environ.get("LLM_POOL_SHARD_SIZE", "32"))
+# Shown when a reply is only a record_lead call and the follow-up asking
+# for the text fails too
+TOOL_ONLY_REPLY = "Thank you!"
+# The result sent back for a record_lead call, to get the text that goes with it
+TOOL_RESULT = json.dumps({"recorded": True})
+
+# A dict set here (per asyncio task or thread) also receives the usage of the
+# calls made under it, so a caller can bill tokens to one session
+usage_sink: ContextVar[Optional[dict]] = ContextVar("llm_usage_sink", default=None)
+
+
+class LLMError(Exception):
+    """A provider call that failed after retries. Never store it as a bot reply."""
+
+    def __init__(self, provider: str, message: str, status_code: Optional[int] = None, retryable: bool = False):
+        super().__init__(f"{provider}: {message}")
+        self.provider = provider
+        self.message = message
+        self.status_code = status_code
+        self.retryable = retryable
+
+    @property
+    def user_message(self) -> str:
+        if self.retryable:
+            return f"⚠️ {self.provider} is busy right now. Try again."
+        return f"⚠️ {self.provider} API error. Try again later."
+
+
+class Cancelled(Exception):
+    """A provider call stopped through its Cancellation. Says nothing about the provider's health."""
+
+
+class Cancellation:
+    """
+    Lets another thread stop a blocking streamed call (the router cancels hedge losers).
+    Requests made with one (the "cancellation" request extension) go through
+    CancellableTransport, which attaches the HTTP/1.1 connection each is
+    written to; cancel() shuts that socket down, which wakes the blocked read,
+    whether it is still waiting for headers or already reading the body, and
+    tells the provider to stop generating. A call not sent yet, or sleeping
+    between retries, stops at once. HTTP/2 connections are shared, so a
+    request on one is only abandoned, not cut.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._stream = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            stream, self._stream = self._stream, None
+        if stream is not None:
+            _shutdown(stream)
+
+    def attach(self, stream: httpcore.NetworkStream):
+        """The connection the request is on now; shut down at once if already cancelled."""
+        with self._lock:
+            if not self._event.is_set():
+                self._stream = stream
+                return
+        _shutdown(stream)
 
-def generate_deepseek_reply(prompt: str) -> str:
-    headers = {"Authorization": f"Bearer {DEESEEK_API_KEY}"}
-    payload = {
-        "model": "deepseek-chat",
-        "messages": [
-            {"role": "system", "content": prompt}
-        ]
-    }
+    def detach(self):
+        with self._lock:
+            self._stream = None
+
+    def wait(self, seconds: float) -> bool:
+        """Sleep up to `seconds`; True if cancelled meanwhile."""
+        return self._event.wait(seconds)
+
+
+def _shutdown(stream: httpcore.NetworkStream):
+    sock = stream.get_extra_info("socket")
+    if sock is None:
+        return
     try:
-        response = httpx.post(
-            f"{DEESEEK_BASE_URL}/chat/completions",
-            json=payload,
-            headers=headers,
-            timeout=60.0
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+# The Cancellation of the request this thread is sending, for _WatchedStream.write
+_sending = threading.local()
+
+
+class _WatchedStream(httpcore.NetworkStream):
+    def __init__(self, stream: httpcore.NetworkStream):
+        self._stream = stream
+        ssl_object = stream.get_extra_info("ssl_object")
+        self._shared = ssl_object is not None and ssl_object.selected_alpn_protocol() == "h2"
+
+    def read(self, max_bytes: int, timeout: Optional[float] = None) -> bytes:
+        return self._stream.read(max_bytes, timeout)
+
+    def write(self, buffer: bytes, timeout: Optional[float] = None) -> None:
+        cancel = getattr(_sending, "cancel", None)
+        if cancel is not None and not self._shared:
+            cancel.attach(self._stream)
+        self._stream.write(buffer, timeout)
+
+    def close(self) -> None:
+        self._stream.close()
+
+    def start_tls(self, ssl_context, server_hostname=None, timeout=None) -> "_WatchedStream":
+        return _WatchedStream(self._stream.start_tls(ssl_context, server_hostname, timeout))
+
+    def get_extra_info(self, info: str):
+        return self._stream.get_extra_info(info)
+
+
+class _WatchedBackend(httpcore.NetworkBackend):
+    """Network backend whose connections attach themselves to the Cancellation of the request written on them."""
+
+    def __init__(self, backend: httpcore.NetworkBackend):
+        self._backend = backend
+
+    def connect_tcp(self, *args, **kwargs) -> _WatchedStream:
+        return _WatchedStream(self._backend.connect_tcp(*args, **kwargs))
+
+    def connect_unix_socket(self, *args, **kwargs) -> _WatchedStream:
+        return _WatchedStream(self._backend.connect_unix_socket(*args, **kwargs))
+
+    def sleep(self, seconds: float) -> None:
+        self._backend.sleep(seconds)
+
+
+# httpcore errors and the httpx ones raised for them, most specific first
+_HTTPX_ERRORS = [
+    (httpcore.ConnectTimeout, httpx.ConnectTimeout),
+    (httpcore.ReadTimeout, httpx.ReadTimeout),
+    (httpcore.WriteTimeout, httpx.WriteTimeout),
+    (httpcore.PoolTimeout, httpx.PoolTimeout),
+    (httpcore.TimeoutException, httpx.TimeoutException),
+    (httpcore.ConnectError, httpx.ConnectError),
+    (httpcore.ReadError, httpx.ReadError),
+    (httpcore.WriteError, httpx.WriteError),
+    (httpcore.NetworkError, httpx.NetworkError),
+    (httpcore.ProxyError, httpx.ProxyError),
+    (httpcore.UnsupportedProtocol, httpx.UnsupportedProtocol),
+    (httpcore.RemoteProtocolError, httpx.RemoteProtocolError),
+    (httpcore.LocalProtocolError, httpx.LocalProtocolError),
+    (httpcore.ProtocolError, httpx.ProtocolError),
+]
+
+
+@contextmanager
+def _httpx_errors():
+    try:
+        yield
+    except Exception as e:
+        for from_error, to_error in _HTTPX_ERRORS:
+            if isinstance(e, from_error):
+                raise to_error(str(e)) from e
+        raise
+
+
+class _ResponseStream(httpx.SyncByteStream):
+    def __init__(self, stream, cancel: Optional[Cancellation]):
+        self._stream = stream
+        self._cancel = cancel
+
+    def __iter__(self) -> Iterator[bytes]:
+        with _httpx_errors():
+            yield from self._stream
+
+    def close(self) -> None:
+        # Let go of the connection before it can go back to the pool and carry another request
+        if self._cancel is not None:
+            self._cancel.detach()
+        self._stream.close()
+
+
+class CancellableTransport(httpx.BaseTransport):
+    """
+    httpx transport over an httpcore connection pool whose connections can be
+    cut through a Cancellation, passed as the "cancellation" request extension.
+    """
+
+    def __init__(self, limits: httpx.Limits, http2: bool = False):
+        self._pool = httpcore.ConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            http2=http2,
+            network_backend=_WatchedBackend(httpcore.SyncBackend()),
         )
-        response.raise_for_status()
-        data = response.json()
-        return data["choices"][0]["message"]["content"].strip()
-    except httpx.ReadTimeout:
-        return "⚠️ DeepSeek API timeout. Try again."
-    except httpx.HTTPStatusError as e:
-        return f"⚠️ DeepSeek API error: {e.response.text}"
-
-
-def generate_chatgpt_reply(prompt: str) -> str:
-    headers = {
-        "Authorization": f"Bearer {OPENAI_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    payload = {
-        "model": "gpt-4.1",
-        "messages": [
-            {"role": "system", "content": prompt},
-            
-        ]
-    }
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        extensions = dict(request.extensions)
+        cancel = extensions.pop("cancellation", None)
+        url = request.url
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(scheme=url.raw_scheme, host=url.raw_host, port=url.port, target=url.raw_path),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=extensions,
+        )
+        _sending.cancel = cancel
+        try:
+            with _httpx_errors():
+                response = self._pool.handle_request(core_request)
+        except BaseException:
+            if cancel is not None:
+                cancel.detach()
+            raise
+        finally:
+            _sending.cancel = None
+        return httpx.Response(response.status, headers=response.headers,
+                              stream=_ResponseStream(response.stream, cancel), extensions=response.extensions)
+
+    def close(self) -> None:
+        self._pool.close()
+
+
+def _env(provider: str, name: str, default: str) -> str:
+    # Per-provider setting first (DEEPSEEK_READ_TIMEOUT), then global (LLM_READ_TIMEOUT)
+    return os.environ.get(f"{provider.upper()}_{name}", os.environ.get(f"LLM_{name}", default))
+
+
+@dataclass
+class ProviderConfig:
+    name: str
+    base_url: str
+    api_key: str
+    model: str
+    max_connections: int = 20
+    max_keepalive: int = 10
+    keepalive_expiry: float = 60.0
+    http2: bool = False
+    connect_timeout: float = 5.0
+    read_timeout: float = 60.0
+    max_retries: int = 2
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+    # Send the record_lead tool, so lead fields come back as structured arguments
+    lead_tools: bool = True
+
+    @classmethod
+    def from_env(cls, name: str, label: str, base_url: str, api_key: str, model: str) -> "ProviderConfig":
+        return cls(
+            name=label,
+            base_url=base_url,
+            api_key=api_key,
+            model=_env(name, "MODEL", model),
+            max_connections=int(_env(name, "MAX_CONNECTIONS", "20")),
+            max_keepalive=int(_env(name, "MAX_KEEPALIVE", "10")),
+            keepalive_expiry=float(_env(name, "KEEPALIVE_EXPIRY", "60")),
+            http2=_env(name, "HTTP2", "0") == "1",
+            connect_timeout=float(_env(name, "CONNECT_TIMEOUT", "5")),
+            read_timeout=float(_env(name, "READ_TIMEOUT", "60")),
+            max_retries=int(_env(name, "MAX_RETRIES", "2")),
+            backoff_base=float(_env(name, "BACKOFF_BASE", "0.5")),
+            backoff_max=float(_env(name, "BACKOFF_MAX", "8")),
+            lead_tools=_env(name, "LEAD_TOOLS", "1") == "1",
+        )
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
     try:
-        response = httpx.post(
-            f"{OPENAI_BASE_URL}/chat/completions",
-            json=payload,
-            headers=headers,
-            timeout=60.0
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class ProviderClient:
+    """
+    Keep-alive connection pool plus retry policy for one chat-completions provider.
+    The `a*` methods are the asyncio equivalents used by the ASGI app.
+    """
+
+    def __init__(self, config: ProviderConfig):
+        self.config = config
+        self._client = None
+        self._lock = threading.Lock()
+        self._async_clients = []
+        self._async_loop = None
+        self.usage = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        self._next_shard = 0
+
+    @property
+    def client(self) -> httpx.Client:
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    kwargs = self._client_kwargs()
+                    transport = CancellableTransport(kwargs.pop("limits"), kwargs.pop("http2"))
+                    self._client = httpx.Client(transport=transport, **kwargs)
+        return self._client
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        # An AsyncClient's pool is bound to the event loop that first used it.
+        # httpcore scans every pooled connection on each request, which goes
+        # quadratic with hundreds of in-flight calls, so the async pool is
+        # split into shards of at most POOL_SHARD_SIZE connections.
+        loop = asyncio.get_running_loop()
+        if not self._async_clients or self._async_loop is not loop:
+            shards = max(1, -(-self.config.max_connections // POOL_SHARD_SIZE))
+            self._async_clients = [httpx.AsyncClient(**self._client_kwargs(shards)) for _ in range(shards)]
+            self._async_loop = loop
+        self._next_shard = (self._next_shard + 1) % len(self._async_clients)
+        return self._async_clients[self._next_shard]
+
+    def _client_kwargs(self, shards: int = 1) -> dict:
+        cfg = self.config
+        return dict(
+            base_url=cfg.base_url,
+            headers={
+                "Authorization": f"Bearer {cfg.api_key}",
+                "Content-Type": "application/json",
+            },
+            limits=httpx.Limits(
+                max_connections=-(-cfg.max_connections // shards),
+                max_keepalive_connections=-(-cfg.max_keepalive // shards),
+                keepalive_expiry=cfg.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(cfg.read_timeout, connect=cfg.connect_timeout),
+            http2=cfg.http2 and _http2_available(),
         )
-        response.raise_for_status()
-        data = response.json()
-        return data["choices"][0]["message"]["content"].strip()
-    except httpx.ReadTimeout:
-        return "⚠️ ChatGPT API timeout. Try again."
-    except httpx.HTTPStatusError as e:
-        return f"⚠️ ChatGPT API error: {e.response.text}"
+
+    def _retry_delay(self, error: LLMError, attempt: int, retry_after: Optional[float]) -> float:
+        """Seconds to wait before retrying after `error`; raises it instead when it is not worth retrying."""
+        cfg = self.config
+        if not error.retryable or attempt >= cfg.max_retries:
+            raise error
+        if retry_after is not None:
+            # Waiting longer than backoff_max is left to the caller (the router fails over)
+            if retry_after > cfg.backoff_max:
+                raise error
+            return retry_after
+        # Full jitter: uniform in [0, base * 2^attempt], capped
+        return random.uniform(0, min(cfg.backoff_max, cfg.backoff_base * (2 ** attempt)))
+
+    def _error_for(self, exc: Exception) -> LLMError:
+        name = self.config.name
+        if isinstance(exc, httpx.HTTPStatusError):
+            status = exc.response.status_code
+            return LLMError(name, exc.response.text[:500], status, status in RETRYABLE_STATUS)
+        if isinstance(exc, httpx.TimeoutException):
+            return LLMError(name, "timeout", retryable=True)
+        return LLMError(name, str(exc) or exc.__class__.__name__, retryable=True)
+
+    def record_usage(self, data: dict) -> Optional[dict]:
+        """Accumulate token usage, including prompt-cache hits, from a completion body."""
+        usage = data.get("usage") if isinstance(data, dict) else None
+        if not usage:
+            return None
+        # DeepSeek reports prompt_cache_hit_tokens, OpenAI prompt_tokens_details.cached_tokens
+        cached = usage.get("prompt_cache_hit_tokens")
+        if cached is None:
+            cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+        record = {
+            "prompt_tokens": usage.get("prompt_tokens", 0),
+            "cached_tokens": cached or 0,
+            "completion_tokens": usage.get("completion_tokens", 0),
+        }
+        with self._lock:
+            self.usage["calls"] += 1
+            for k, v in record.items():
+                self.usage[k] += v
+        sink = usage_sink.get()
+        if sink is not None:
+            sink["calls"] = sink.get("calls", 0) + 1
+            for k, v in record.items():
+                sink[k] = sink.get(k, 0) + v
+        for kind, tokens in record.items():
+            metrics.inc(metrics.LLM_TOKENS, tokens, provider=self.config.name.lower(),
+                        kind=kind.replace("_tokens", ""))
+        logger.info("%s usage prompt=%d cached=%d completion=%d", self.config.name,
+                    record["prompt_tokens"], record["cached_tokens"], record["completion_tokens"])
+        return record
+
+    def _retry_or_raise(self, error: LLMError, attempt: int, retry_after: Optional[float] = None,
+                        cancel: Optional[Cancellation] = None):
+        delay = self._retry_delay(error, attempt, retry_after)
+        if cancel is not None:
+            # Cancelled while backing off: the failure behind the retry still counts
+            if cancel.wait(delay):
+                raise error
+        else:
+            time.sleep(delay)
+
+    def chat_completion(self, payload: dict) -> dict:
+        payload = {"model": self.config.model, **payload}
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                response = self.client.post("/chat/completions", json=payload)
+                response.raise_for_status()
+                data = response.json()
+                self.record_usage(data)
+                return data
+            except httpx.HTTPStatusError as e:
+                error = self._error_for(e)
+                retry_after = _retry_after(e.response)
+            except (httpx.TransportError, ValueError) as e:
+                error = self._error_for(e)
+            self._retry_or_raise(error, attempt, retry_after)
+            attempt += 1
+
+    def stream_chat_completion(self, payload: dict, cancel: Optional[Cancellation] = None) -> Iterator[str]:
+        """Yield content deltas. Retries only happen before the first delta is sent."""
+        payload = {"model": self.config.model, **payload, "stream": True, "stream_options": {"include_usage": True}}
+        attempt = 0
+        started = False
+        while True:
+            retry_after = None
+            calls = LeadToolCalls()
+            if cancel is not None and cancel.cancelled:
+                raise failed if attempt else Cancelled()
+            extensions = {"cancellation": cancel} if cancel is not None else None
+            try:
+                with self.client.stream("POST", "/chat/completions", json=payload, extensions=extensions) as response:
+                    if response.is_error:
+                        response.read()
+                        response.raise_for_status()
+                    for line in response.iter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            # Read on to the end of the body, so the connection goes back to the pool
+                            continue
+                        chunk = json.loads(data)
+                        self.record_usage(chunk)
+                        calls.feed(_delta_tool_calls(chunk))
+                        delta = _delta_text(chunk)
+                        if delta:
+                            started = True
+                            yield delta
+                if cancel is not None and cancel.cancelled:
+                    raise failed if attempt else Cancelled()
+                if calls.wants_follow_up(started, payload):
+                    break
+                tail = calls.tail(started)
+                if tail:
+                    yield tail
+                return
+            except httpx.HTTPStatusError as e:
+                error = self._error_for(e)
+                retry_after = _retry_after(e.response)
+            except (httpx.TransportError, ValueError) as e:
+                error = self._error_for(e)
+            if cancel is not None and cancel.cancelled:
+                # Cut off by the cancel; a failed earlier attempt still counts against the provider
+                if attempt:
+                    raise failed
+                raise Cancelled() from error
+            if started:
+                raise error
+            self._retry_or_raise(error, attempt, retry_after, cancel)
+            failed = error
+            attempt += 1
+        # Only a record_lead call came back: send its result and stream the text instead
+        try:
+            for delta in self.stream_chat_completion(calls.follow_up(payload), cancel):
+                started = True
+                yield delta
+        except LLMError as e:
+            if started:
+                raise
+            logger.warning("%s: no text after a record_lead call: %s", self.config.name, e.message)
+        yield calls.tail(started)
+
+    async def achat_completion(self, payload: dict) -> dict:
+        payload = {"model": self.config.model, **payload}
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                response = await self.async_client.post("/chat/completions", json=payload)
+                response.raise_for_status()
+                data = response.json()
+                self.record_usage(data)
+                return data
+            except httpx.HTTPStatusError as e:
+                error = self._error_for(e)
+                retry_after = _retry_after(e.response)
+            except (httpx.TransportError, ValueError) as e:
+                error = self._error_for(e)
+            await self._aretry_or_raise(error, attempt, retry_after)
+            attempt += 1
+
+    async def astream_chat_completion(self, payload: dict) -> AsyncIterator[str]:
+        payload = {"model": self.config.model, **payload, "stream": True, "stream_options": {"include_usage": True}}
+        attempt = 0
+        started = False
+        while True:
+            retry_after = None
+            calls = LeadToolCalls()
+            try:
+                async with self.async_client.stream("POST", "/chat/completions", json=payload) as response:
+                    if response.is_error:
+                        await response.aread()
+                        response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            # Read on to the end of the body, so the connection goes back to the pool
+                            continue
+                        chunk = json.loads(data)
+                        self.record_usage(chunk)
+                        calls.feed(_delta_tool_calls(chunk))
+                        delta = _delta_text(chunk)
+                        if delta:
+                            started = True
+                            yield delta
+                if calls.wants_follow_up(started, payload):
+                    break
+                tail = calls.tail(started)
+                if tail:
+                    yield tail
+                return
+            except httpx.HTTPStatusError as e:
+                error = self._error_for(e)
+                retry_after = _retry_after(e.response)
+            except (httpx.TransportError, ValueError) as e:
+                error = self._error_for(e)
+            if started:
+                raise error
+            await self._aretry_or_raise(error, attempt, retry_after)
+            attempt += 1
+        try:
+            async for delta in self.astream_chat_completion(calls.follow_up(payload)):
+                started = True
+                yield delta
+        except LLMError as e:
+            if started:
+                raise
+            logger.warning("%s: no text after a record_lead call: %s", self.config.name, e.message)
+        yield calls.tail(started)
+
+    async def _aretry_or_raise(self, error: LLMError, attempt: int, retry_after: Optional[float] = None):
+        await asyncio.sleep(self._retry_delay(error, attempt, retry_after))
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def aclose(self):
+        for client in self._async_clients:
+            await client.aclose()
+        self._async_clients = []
+
+
+deepseek = ProviderClient(ProviderConfig.from_env("deepseek", "DeepSeek", DEESEEK_BASE_URL, DEESEEK_API_KEY, "deepseek-chat"))
+chatgpt = ProviderClient(ProviderConfig.from_env("openai", "ChatGPT", OPENAI_BASE_URL, OPENAI_API_KEY, "gpt-4.1"))
+
+
+class LeadToolCalls:
+    """
+    record_lead arguments from a completion, whole or streamed in fragments.
+    They are turned into a <<JSON>> block appended to the reply, the format
+    the rest of the app stores and parses, so no text has to be scraped.
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.names = {}
+        self.arguments = {}  # tool call index -> argument text so far
+
+    def feed(self, tool_calls):
+        for n, call in enumerate(tool_calls or ()):
+            index = call.get("index", n)
+            if call.get("id"):
+                self.ids[index] = call["id"]
+            function = call.get("function") or {}
+            if function.get("name"):
+                self.names[index] = function["name"]
+            self.arguments[index] = self.arguments.get(index, "") + (function.get("arguments") or "")
+
+    def fields(self) -> Optional[dict]:
+        fields = {}
+        for index, arguments in self.arguments.items():
+            if self.names.get(index) == LEAD_TOOL:
+                # Arguments cut short (max_tokens) still give up what is readable
+                parsed, _ = parse_block(arguments)
+                fields.update(parsed or {})
+        return fields or None
+
+    def wants_follow_up(self, has_text: bool, payload: dict) -> bool:
+        """
+        Whether the reply was only a record_lead call. Models often answer a
+        call with no text, so the call's result is sent back to get it.
+        """
+        return not has_text and payload.get("tool_choice") != "none" and self.fields() is not None
+
+    def follow_up(self, payload: dict) -> dict:
+        """`payload` plus the calls and their results, asking for text only."""
+        calls = [{"id": self.ids.get(index, f"call_{index}"), "type": "function",
+                  "function": {"name": self.names.get(index, ""), "arguments": self.arguments[index]}}
+                 for index in sorted(self.arguments)]
+        results = [{"role": "tool", "tool_call_id": call["id"], "content": TOOL_RESULT} for call in calls]
+        messages = [*payload["messages"], {"role": "assistant", "content": None, "tool_calls": calls}, *results]
+        return {**payload, "messages": messages, "tool_choice": "none"}
+
+    def tail(self, has_text: bool) -> str:
+        """What to append to the reply text: the lead block, if any fields came back."""
+        fields = self.fields()
+        if not fields:
+            return ""
+        # No separator: whitespace before the block would reach streaming clients as a delta
+        return ("" if has_text else TOOL_ONLY_REPLY) + lead_block(fields)
+
+
+def _payload(provider: ProviderClient, messages: List[dict], tools: Optional[list] = None) -> dict:
+    payload = {"messages": messages}
+    if tools and provider.config.lead_tools:
+        payload["tools"] = tools
+    return payload
+
+
+def _reply(data: dict, provider: ProviderClient) -> tuple:
+    """(text, LeadToolCalls) of a completion."""
+    try:
+        message = data["choices"][0]["message"]
+        text = (message.get("content") or "").strip()
+        calls = LeadToolCalls()
+        calls.feed(message.get("tool_calls"))
+    except (KeyError, IndexError, TypeError, AttributeError):
+        raise LLMError(provider.config.name, "malformed completion response")
+    return text, calls
+
+
+def _reply_text(text: str, calls: LeadToolCalls, provider: ProviderClient) -> str:
+    tail = calls.tail(bool(text))
+    if not text and not tail:
+        raise LLMError(provider.config.name, "malformed completion response")
+    return text + tail
+
+
+def _generate(provider: ProviderClient, messages: List[dict], tools: Optional[list]) -> str:
+    payload = _payload(provider, messages, tools)
+    text, calls = _reply(provider.chat_completion(payload), provider)
+    if calls.wants_follow_up(bool(text), payload):
+        try:
+            text, _ = _reply(provider.chat_completion(calls.follow_up(payload)), provider)
+        except LLMError as e:
+            logger.warning("%s: no text after a record_lead call: %s", provider.config.name, e.message)
+    return _reply_text(text, calls, provider)
+
+
+async def _agenerate(provider: ProviderClient, messages: List[dict], tools: Optional[list]) -> str:
+    payload = _payload(provider, messages, tools)
+    text, calls = _reply(await provider.achat_completion(payload), provider)
+    if calls.wants_follow_up(bool(text), payload):
+        try:
+            text, _ = _reply(await provider.achat_completion(calls.follow_up(payload)), provider)
+        except LLMError as e:
+            logger.warning("%s: no text after a record_lead call: %s", provider.config.name, e.message)
+    return _reply_text(text, calls, provider)
+
+
+def _delta_text(chunk: dict) -> str:
+    try:
+        return chunk["choices"][0]["delta"].get("content") or ""
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return ""
+
+
+def _delta_tool_calls(chunk: dict) -> Optional[list]:
+    try:
+        return chunk["choices"][0]["delta"].get("tool_calls")
+    except (KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+
+def generate_deepseek_reply(messages: List[dict], tools: Optional[list] = None) -> str:
+    return _generate(deepseek, messages, tools)
+
+
+def generate_chatgpt_reply(messages: List[dict], tools: Optional[list] = None) -> str:
+    return _generate(chatgpt, messages, tools)
+
+
+def stream_deepseek_reply(messages: List[dict], tools: Optional[list] = None,
+                          cancel: Optional[Cancellation] = None) -> Iterator[str]:
+    return deepseek.stream_chat_completion(_payload(deepseek, messages, tools), cancel)
+
+
+def stream_chatgpt_reply(messages: List[dict], tools: Optional[list] = None,
+                         cancel: Optional[Cancellation] = None) -> Iterator[str]:
+    return chatgpt.stream_chat_completion(_payload(chatgpt, messages, tools), cancel)
+
+
+async def agenerate_deepseek_reply(messages: List[dict], tools: Optional[list] = None) -> str:
+    return await _agenerate(deepseek, messages, tools)
+
+
+async def agenerate_chatgpt_reply(messages: List[dict], tools: Optional[list] = None) -> str:
+    return await _agenerate(chatgpt, messages, tools)
+
+
+def astream_deepseek_reply(messages: List[dict], tools: Optional[list] = None) -> AsyncIterator[str]:
+    return deepseek.astream_chat_completion(_payload(deepseek, messages, tools))
+
+
+def astream_chatgpt_reply(messages: List[dict], tools: Optional[list] = None) -> AsyncIterator[str]:
+    return chatgpt.astream_chat_completion(_payload(chatgpt, messages, tools))
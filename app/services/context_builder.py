@@ -1,4 +1,5 @@
-from datetime import datetime
+import hashlib
+import json
 
 BASE_TEMPLATE = """
 You are a professional career coaching consultant. Please conduct one-on-one career exploration interviews with users. Your goal is to help users discover their core strengths by sharing specific stories.
@@ -27,7 +28,8 @@ You are a professional career coaching consultant. Please conduct one-on-one car
 - Emphasize “digging deep” and “synthesizing” to help users recognize their strengths aren't random but consistently emerge across contexts.
 
 ### IMPORTANT JSON INSTRUCTIONS
-- Every time one or more fields is completed, **produce JSON exactly in this format**:
+- Every time one or more fields is completed, call the `record_lead` tool with them if it is available, and still write your message to the user as usual.
+- Without that tool, **produce JSON exactly in this format**:
 <<JSON>>
 {fields_json}
 <<ENDJSON>>
@@ -40,22 +42,77 @@ You are a professional career coaching consultant. Please conduct one-on-one car
 Please structure it as a dialogue script: AI → User → AI Summary/Follow-up and let's start the conversation. The name of the AI Bot is “Coach Jade”.
 """
 
+RESPOND_INSTRUCTION = "Please respond as the business assistant."
+GREETING_INSTRUCTION = "User hasn't said anything yet. Generate a friendly, professional welcome message for career coaching."
+
+_system_prompts = {}
+MAX_CACHED_PROMPTS = 1024
+
+# Function the model calls with captured lead fields, on providers that support tools
+LEAD_TOOL = "record_lead"
+_lead_tools = {}
+
+
+def setup_hash(setup: dict) -> str:
+    """Stable version id of a setup; changes whenever any setup field changes."""
+    raw = json.dumps(setup, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
 def build_context(setup: dict) -> str:
-    today = datetime.now().strftime("%Y-%m-%d")
-    
+    """
+    The system prompt for a setup. It is byte-identical for a given setup
+    version, so it is compiled once per (page_id, setup hash) and reused,
+    which lets provider-side prefix caching hit on every later turn.
+    """
+    key = (setup.get("page_id"), setup_hash(setup))
+    prompt = _system_prompts.get(key)
+    if prompt is None:
+        if len(_system_prompts) >= MAX_CACHED_PROMPTS:
+            _system_prompts.clear()
+        prompt = _system_prompts[key] = _compile_context(setup)
+    return prompt
+
+
+def _compile_context(setup: dict) -> str:
     # Extract only the relevant fields
     fields = setup.get("field", [])
     steps = " → ".join(fields) if fields else "Collect necessary information politely"
     if fields:
-        fields_json = ""
-        for i, f in enumerate(fields):
-            comma = "," if i < len(fields) - 1 else ""
-            fields_json += f'    "{f}": "..." {comma}\n'
+        fields_json = ",\n".join(f'    "{f}": "..." ' for f in fields) + "\n"
     else:
         fields_json = '    "name": "..." ,\n    "email": "..."'
 
-
     return BASE_TEMPLATE.format(
         fields_json=fields_json,
         steps=steps
     )
+
+
+def lead_tools(setup: dict):
+    """
+    The `tools` list asking for lead fields as a `record_lead` call whose
+    arguments follow a JSON schema built from the setup's field list, or
+    None when the setup collects no fields.
+    """
+    fields = tuple(setup.get("field") or ())
+    if not fields:
+        return None
+    tools = _lead_tools.get(fields)
+    if tools is None:
+        if len(_lead_tools) >= MAX_CACHED_PROMPTS:
+            _lead_tools.clear()
+        tools = _lead_tools[fields] = [{
+            "type": "function",
+            "function": {
+                "name": LEAD_TOOL,
+                "description": "Record the lead details the user has given so far. "
+                               "Include only fields with a known value.",
+                "parameters": {
+                    "type": "object",
+                    "properties": {f: {"type": "string"} for f in fields},
+                    "additionalProperties": False,
+                },
+            },
+        }]
+    return tools
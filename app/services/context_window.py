@@ -0,0 +1,210 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field as dc_field
+from typing import List, Optional
+
+from app.services import metrics
+from app.services.context_builder import build_context, RESPOND_INSTRUCTION, GREETING_INSTRUCTION
+from app.services.parser import parse_booking_confirmation
+
+logger = logging.getLogger(__name__)
+
+# Most recent messages always sent verbatim
+HISTORY_MAX_TURNS = int(os.environ.get("HISTORY_MAX_TURNS", "8"))
+# Token budget for the verbatim part; older messages beyond it are summarized
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "2500"))
+# Token budget for the rolling summary; the oldest summary lines drop out first
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("SUMMARY_TOKEN_BUDGET", "800"))
+# Minimum messages kept verbatim even when they exceed the budget
+MIN_VERBATIM = 2
+# Conversations whose window state is kept, least recently used dropped first;
+# defaults to the conversation cache's size, so both hold the same sessions
+HISTORY_CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", os.environ.get("CONVERSATION_CACHE_SIZE", "10000")))
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # tiktoken is optional
+    _encoding = None
+
+_JSON_BLOCK = re.compile(r"<<JSON>>.*?(<<ENDJSON>>|$)", re.DOTALL)
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s")
+
+
+def count_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # ~4 characters per token for ASCII text, ~1 per character otherwise
+    non_ascii = len(text) - len(text.encode("ascii", "ignore"))
+    return (len(text) - non_ascii + 3) // 4 + non_ascii
+
+
+def format_message(m: dict) -> str:
+    return f"{m['role'].capitalize()}: {m['message']}"
+
+
+def _summary_line(m: dict) -> Optional[str]:
+    text = _JSON_BLOCK.sub("", m.get("message", "")).strip()
+    if not text:
+        return None
+    if m.get("role") == "bot":
+        # The coach's turns are mostly questions; the last sentence is the one that matters
+        sentences = [s for s in _SENTENCE_END.split(text) if s.strip()]
+        text = sentences[-1] if sentences else text
+        limit = 160
+    else:
+        limit = 400
+    text = " ".join(text.split())
+    if len(text) > limit:
+        text = text[:limit].rstrip() + "…"
+    return f"{m['role'].capitalize()}: {text}"
+
+
+@dataclass
+class _ConversationCache:
+    first: Optional[dict] = None
+    folded: int = 0
+    last_folded: Optional[dict] = None
+    summary_lines: List[str] = dc_field(default_factory=list)
+    summary_tokens: List[int] = dc_field(default_factory=list)
+    message_tokens: List[int] = dc_field(default_factory=list)
+    last_counted: Optional[dict] = None
+    lead_scanned: int = 0
+    lead_fields: Optional[dict] = None
+
+
+@dataclass
+class HistoryWindow:
+    summary: str
+    recent: List[dict]
+    lead_fields: Optional[dict]
+    tokens_before: int
+
+
+# A dropped entry only costs a rebuild from the history on that conversation's next turn
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cache_for(conv_key: str, history: List[dict]) -> _ConversationCache:
+    with _cache_lock:
+        cache = _cache.get(conv_key)
+        if cache is not None:
+            _cache.move_to_end(conv_key)
+        # Histories are append-only; anything else means the conversation was reset
+        stale = cache is None or (history and cache.first != history[0]) or cache.folded > len(history) \
+            or (cache.folded and history[cache.folded - 1] != cache.last_folded) \
+            or len(cache.message_tokens) > len(history) or cache.lead_scanned > len(history) \
+            or (cache.message_tokens and history[len(cache.message_tokens) - 1] != cache.last_counted)
+        if stale:
+            cache = _cache[conv_key] = _ConversationCache(first=history[0] if history else None)
+            while len(_cache) > HISTORY_CACHE_SIZE:
+                _cache.popitem(last=False)
+        return cache
+
+
+def forget(conv_key: str):
+    with _cache_lock:
+        _cache.pop(conv_key, None)
+
+
+def build_history_window(conv_key: str, history: List[dict]) -> HistoryWindow:
+    """
+    Split `history` into a verbatim tail and a rolling summary of everything
+    older. The summary and per-message token counts are cached per
+    conversation and only extended by the messages that changed since the
+    previous turn.
+    """
+    cache = _cache_for(conv_key, history)
+
+    for m in history[len(cache.message_tokens):]:
+        cache.message_tokens.append(count_tokens(format_message(m)) + 1)
+    if history:
+        cache.last_counted = history[-1]
+
+    # --- Verbatim tail: last N messages, shrunk to the token budget ---
+    keep = min(len(history), HISTORY_MAX_TURNS)
+    tail_tokens = sum(cache.message_tokens[len(history) - keep:])
+    while keep > MIN_VERBATIM and tail_tokens > HISTORY_TOKEN_BUDGET:
+        tail_tokens -= cache.message_tokens[len(history) - keep]
+        keep -= 1
+    fold_upto = len(history) - keep
+
+    # --- Rolling summary: fold only messages that newly fell out of the tail ---
+    if fold_upto > cache.folded:
+        for m in history[cache.folded:fold_upto]:
+            line = _summary_line(m)
+            if line:
+                cache.summary_lines.append(line)
+                cache.summary_tokens.append(count_tokens(line) + 1)
+        while cache.summary_lines and sum(cache.summary_tokens) > SUMMARY_TOKEN_BUDGET:
+            cache.summary_lines.pop(0)
+            cache.summary_tokens.pop(0)
+        cache.folded = fold_upto
+        cache.last_folded = history[fold_upto - 1]
+    # Folded messages stay in the summary, so the tail is everything after them
+    recent = history[cache.folded:]
+
+    # --- Latest captured lead fields, from the newest bot JSON block ---
+    for m in reversed(history[cache.lead_scanned:]):
+        if m.get("role") == "bot" and "<<JSON>>" in m.get("message", ""):
+            fields = parse_booking_confirmation(m["message"])
+            if fields:
+                # Blank values in a newer block never erase an earlier answer
+                filled = {k: v for k, v in fields.items() if v not in ("", None)}
+                cache.lead_fields = {**(cache.lead_fields or {}), **filled}
+                break
+    cache.lead_scanned = len(history)
+
+    summary = "\n".join(cache.summary_lines)
+    return HistoryWindow(summary, recent, cache.lead_fields, sum(cache.message_tokens))
+
+
+def log_prompt_tokens(conv_key: str, context: str, window: HistoryWindow, prompt: str):
+    """Per-turn prompt size metric: full history vs the trimmed prompt actually sent."""
+    context_tokens = count_tokens(context)
+    before = context_tokens + window.tokens_before
+    after = count_tokens(prompt)
+    logger.info("prompt tokens conv=%s before=%d after=%d saved=%d", conv_key, before, after, before - after)
+    metrics.inc(metrics.PROMPT_TOKENS, before, kind="full_history")
+    metrics.inc(metrics.PROMPT_TOKENS, after, kind="sent")
+    return before, after
+
+
+# --- Provider payloads, shared by the chat routes and the replay tool ---
+def greeting_messages(setup):
+    with metrics.span("context"):
+        context = build_context(setup)
+    return [
+        {"role": "system", "content": context},
+        {"role": "system", "content": GREETING_INSTRUCTION},
+    ]
+
+
+def reply_messages(setup, conv_key, history):
+    """
+    Chat payload for the next reply. The system prompt comes first and is
+    byte-identical for a setup version, so provider prompt caching can reuse
+    it; everything that changes per turn follows it.
+    """
+    # Only the last turns go in verbatim; older ones are folded into a summary
+    with metrics.span("history"):
+        window = build_history_window(conv_key, history)
+    with metrics.span("context"):
+        context = build_context(setup)
+    messages = [{"role": "system", "content": context}]
+    if window.summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{window.summary}"})
+    for m in window.recent:
+        messages.append({"role": "assistant" if m["role"] == "bot" else "user", "content": m["message"]})
+    instruction = RESPOND_INSTRUCTION
+    if window.lead_fields:
+        instruction = ("Information already captured (keep these values unless the user corrects them):\n"
+                       + json.dumps(window.lead_fields, ensure_ascii=False, indent=1) + "\n\n" + instruction)
+    messages.append({"role": "system", "content": instruction})
+    log_prompt_tokens(conv_key, context, window, "\n\n".join(m["content"] for m in messages))
+    return messages
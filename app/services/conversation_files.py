@@ -0,0 +1,405 @@
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import quote, unquote
+
+from app.services import metrics
+from app.services.journal import (
+    FSYNC_INTERVAL, FSYNC_POLICY, WRITE_BATCH_SIZE, WRITE_BEHIND, WRITE_INTERVAL, WRITE_RETRY_MAX,
+)
+from app.services.storage.base import ConversationBackend
+from app.services.storage.session_cache import SessionCache, messages_size
+
+logger = logging.getLogger(__name__)
+
+# Keys whose quoted form is longer than this get a hashed file name instead
+MAX_NAME = 200
+# _encode() never produces "%%", so hashed names cannot collide with quoted ones
+HASHED_PREFIX = "%%"
+SUFFIX = ".jsonl"
+# Written to the directory once a legacy store has been imported into it
+IMPORT_MARKER = "legacy-import.json"
+
+# Open stores, flushed and closed at interpreter exit
+_open_stores = weakref.WeakSet()
+
+
+def _encode(text):
+    # Percent-encoding, with A-Z escaped too so keys differing in case stay
+    # distinct on case-insensitive filesystems. Done per character, so the
+    # encoding of a key prefix is a prefix of the key's encoding.
+    return "".join(f"%{ord(c):02X}" if "A" <= c <= "Z" else quote(c, safe="") for c in text)
+
+
+def file_name(conv_key) -> str:
+    name = _encode(conv_key)
+    if len(name) > MAX_NAME:
+        return HASHED_PREFIX + hashlib.sha256(conv_key.encode("utf-8")).hexdigest() + SUFFIX
+    return name + SUFFIX
+
+
+class _Session:
+    __slots__ = ("messages", "written")
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.written = len(messages)  # messages[:written] are in the file
+
+
+class ConversationFileStore(ConversationBackend):
+    """
+    One append-only JSON-lines file per conversation, hydrated on first use.
+
+    Nothing is read at startup: a conversation is loaded the first time its
+    key is touched and kept in a SessionCache, which evicts the least
+    recently used ones once a count, memory or idle bound is crossed.
+    Startup time and baseline memory therefore do not depend on how much
+    history is on disk.
+
+    New messages are written behind the request like the journaled stores
+    (same JOURNAL_* settings): a writer thread appends the unwritten tail of
+    every dirty conversation, outside the lock requests take. A conversation
+    evicted before that happens stays queued, and is served from the queue
+    if touched again, until it is written. A failed write is cut back off
+    the file and retried with backoff. A crash can lose at most the tail of
+    a conversation not yet flushed; each file stays a prefix of its
+    conversation, and a torn last line is cut off when the file is loaded.
+
+    `legacy_path` names a snapshot + journal from ConversationStore; if it
+    exists, it is split into files once, and IMPORT_MARKER in the directory
+    records that. The legacy files are left as they are.
+    """
+
+    def __init__(self, directory, legacy_path=None, cache=None, fsync=FSYNC_POLICY, write_behind=WRITE_BEHIND,
+                 batch_size=WRITE_BATCH_SIZE, write_interval=WRITE_INTERVAL, fsync_interval=FSYNC_INTERVAL):
+        if fsync not in ("always", "interval", "never"):
+            raise ValueError(f"Unknown fsync policy: {fsync!r}")
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.write_behind = write_behind
+        self.batch_size = batch_size
+        self.write_interval = write_interval
+
+        # Every cache call is made under _lock, which on_evict also needs.
+        # Files are written under _io_lock, which is taken before _lock.
+        self._lock = threading.RLock()
+        self._io_lock = threading.Lock()
+        self.cache = cache if cache is not None else SessionCache()
+        self.cache.on_evict = self._write_back
+        self._dirty = {}  # conv_key -> _Session with unwritten messages
+        self._writing = {}  # the dirty sessions a drain is writing out
+        self._unsynced = set()  # paths written since the last fsync
+        self._last_fsync = time.monotonic()
+        self._wake = threading.Event()
+        self._closed = False
+
+        if legacy_path is not None:
+            self._import_legacy(Path(legacy_path))
+        self._writer = None
+        if write_behind:
+            self._writer = threading.Thread(target=self._run_writer, name=f"{self.directory.name}-writer", daemon=True)
+            self._writer.start()
+        _open_stores.add(self)
+
+    # --- Read access ---
+    def __contains__(self, conv_key):
+        with self._lock:
+            return self._session(conv_key) is not None
+
+    def get(self, conv_key, default=None):
+        with self._lock:
+            session = self._session(conv_key)
+            return list(session.messages) if session is not None else default
+
+    def keys(self):
+        """Every stored conv_key; lists the directory, so meant for tools rather than requests."""
+        with self._lock:
+            keys = {key for key, _ in self.cache.items()}.union(self._dirty, self._writing)
+        return sorted(keys.union(key for key, _ in self._scan()))
+
+    def iter_all(self):
+        """Yield (conv_key, messages) for every conversation without filling the cache."""
+        self.flush()
+        for conv_key in self.keys():
+            with self._lock:
+                session = self._cached(conv_key)
+                messages = list(session.messages) if session is not None else self._read(conv_key)
+            if messages:
+                yield conv_key, messages
+
+    # --- Mutations ---
+    def append(self, conv_key, message):
+        self.extend(conv_key, [message])
+
+    def extend(self, conv_key, messages):
+        if not messages:
+            return
+        with self._lock:
+            session = self._session(conv_key, create=True)
+            session.messages.extend(messages)
+            self.cache.grow(conv_key, messages_size(messages))
+            self._dirty[conv_key] = session
+            write_through = not self.write_behind or self._closed
+            if not write_through and len(self._dirty) >= self.batch_size:
+                self._wake.set()
+        if write_through:
+            self._drain()
+
+    def delete_prefix(self, prefix):
+        # _io_lock too, so no drain re-creates a file deleted here
+        with self._io_lock, self._lock:
+            deleted = {key for key, _ in self.cache.items() if key.startswith(prefix)}
+            self.cache.discard_prefix(prefix)
+            for key in [k for k in self._dirty if k.startswith(prefix)]:
+                del self._dirty[key]
+            for key, path in self._scan(_encode(prefix)):
+                if key.startswith(prefix):
+                    path.unlink(missing_ok=True)
+                    deleted.add(key)
+            return len(deleted)
+
+    def clear(self):
+        with self._io_lock, self._lock:
+            self.cache.clear()
+            self._dirty.clear()
+            for _, path in self._scan():
+                path.unlink(missing_ok=True)
+
+    # --- Lifecycle ---
+    def flush(self):
+        """Write (and, unless the policy is "never", fsync) every message added so far."""
+        self._drain(force_fsync=self.fsync != "never")
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        if self._writer is not None:
+            self._writer.join()
+        self.flush()
+        _open_stores.discard(self)
+
+    # --- Cache ---
+    def _session(self, conv_key, create=False):
+        """The hydrated session, read from disk on a miss. Called with self._lock held."""
+        session = self.cache.get(conv_key)
+        if session is None:
+            # Evicted before the writer got to it: that copy is ahead of the file
+            session = self._dirty.get(conv_key) or self._writing.get(conv_key)
+            if session is None:
+                messages = self._read(conv_key, repair=True)
+                if messages is None and not create:
+                    return None
+                session = _Session(messages or [])
+            self.cache.put(conv_key, session, messages_size(session.messages))
+        return session
+
+    def _cached(self, conv_key):
+        """The in-memory session, if any, without reading the file. Called with self._lock held."""
+        return self.cache.get(conv_key) or self._dirty.get(conv_key) or self._writing.get(conv_key)
+
+    def _write_back(self, conv_key, session):
+        # on_evict: runs under self._lock, so the write is left to the writer
+        if conv_key in self._dirty:
+            self._wake.set()
+
+    # --- Files ---
+    def _path(self, conv_key):
+        return self.directory / file_name(conv_key)
+
+    def _read(self, conv_key, repair=False):
+        """Messages in the conversation's file, or None if it has none."""
+        path = self._path(conv_key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        end = data.rfind(b"\n") + 1
+        if repair and end < len(data):
+            # A torn last line from a crash mid-write: cut it so appends start on a fresh line
+            logger.warning("Dropping torn last line of %s", path)
+            os.truncate(path, end)
+        messages = []
+        for line in data[:end].splitlines():
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning("Skipping unreadable line in %s", path)
+                continue
+            if "key" not in record:  # the header line of a hashed file name
+                messages.append(record)
+        return messages
+
+    def _append(self, conv_key, messages):
+        """Append messages to the conversation's file in one write. Called with self._io_lock held."""
+        path = self._path(conv_key)
+        data = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages).encode("utf-8")
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        try:
+            size = os.fstat(fd).st_size
+            if size == 0 and path.name.startswith(HASHED_PREFIX):
+                data = (json.dumps({"key": conv_key}, ensure_ascii=False) + "\n").encode("utf-8") + data
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+                if self.fsync == "always":
+                    os.fsync(fd)
+            except OSError:
+                # Messages retried after a torn line would be glued to it and lost
+                try:
+                    os.ftruncate(fd, size)
+                except OSError as e:
+                    logger.error("%s: could not cut back a failed write: %s", path, e)
+                raise
+        finally:
+            os.close(fd)
+        metrics.inc(metrics.BYTES_WRITTEN, len(data), store=self.directory.name)
+        if self.fsync == "always" and size == 0:
+            self._sync_directory()
+        elif self.fsync == "interval":
+            self._unsynced.add(path)
+
+    def _scan(self, name_prefix=""):
+        """(conv_key, path) for every conversation file whose name starts with `name_prefix`."""
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                name = entry.name
+                if not name.endswith(SUFFIX):
+                    continue
+                if name.startswith(HASHED_PREFIX):
+                    key = self._hashed_key(Path(entry.path))
+                    if key is not None:
+                        yield key, Path(entry.path)
+                elif name.startswith(name_prefix):
+                    yield unquote(name[:-len(SUFFIX)]), Path(entry.path)
+
+    @staticmethod
+    def _hashed_key(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.loads(f.readline())["key"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _sync_directory(self):
+        # New file names are only durable once the directory entry is synced (POSIX only)
+        if hasattr(os, "O_DIRECTORY"):
+            fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    # --- Writer ---
+    def _run_writer(self):
+        backoff = 0.0
+        while not self._closed:
+            deadline = time.monotonic() + (backoff or self.write_interval)
+            # New messages wake the writer early, but not out of a retry backoff
+            while not self._closed and time.monotonic() < deadline:
+                if self._wake.wait(deadline - time.monotonic()) and not backoff:
+                    break
+                self._wake.clear()
+            self._wake.clear()
+            try:
+                self._drain()
+                backoff = 0.0
+            except OSError as e:
+                backoff = min(max(backoff * 2, self.write_interval, 0.1), WRITE_RETRY_MAX)
+                logger.error("%s: write failed, %d conversations kept for a retry in %.1fs: %s",
+                             self.directory, len(self._dirty), backoff, e)
+            with self._lock:
+                self.cache.expire()
+
+    def _drain(self, force_fsync=False):
+        with self._io_lock:
+            # Tails are taken under _lock, which requests need, and written outside it
+            with self._lock:
+                self._writing, self._dirty = self._dirty, {}
+                tails = [(key, session, session.messages[session.written:])
+                         for key, session in self._writing.items()]
+            try:
+                for conv_key, session, messages in tails:
+                    if messages:
+                        self._append(conv_key, messages)
+                        session.written += len(messages)
+            finally:
+                with self._lock:
+                    # Whatever was not written stays dirty, so the next drain retries it
+                    for key, session in self._writing.items():
+                        if session.written < len(session.messages):
+                            self._dirty.setdefault(key, session)
+                    self._writing = {}
+            due = self._unsynced and (force_fsync or time.monotonic() - self._last_fsync >= self.fsync_interval)
+            unsynced = self._unsynced if due else set()
+            if due:
+                self._unsynced = set()
+        # fsync outside the lock; the files may be appended to meanwhile, which is fine
+        for path in unsynced:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue  # deleted since
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        if unsynced:
+            self._sync_directory()
+            self._last_fsync = time.monotonic()
+
+    # --- Legacy import ---
+    def _import_legacy(self, legacy_path):
+        from app.services.conversation_store import ConversationStore
+
+        marker = self.directory / IMPORT_MARKER
+        journal = legacy_path.with_name(legacy_path.name + ".journal")
+        rotated = legacy_path.with_name(legacy_path.name + ".journal.old")
+        if marker.exists() or not any(p.exists() for p in (legacy_path, journal, rotated)):
+            return
+        started = time.perf_counter()
+        legacy = ConversationStore(legacy_path, read_only=True)
+        try:
+            for conv_key in legacy.keys():
+                # Written whole, so an interrupted import is simply redone on the next start
+                data = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in legacy[conv_key])
+                path = self._path(conv_key)
+                if path.name.startswith(HASHED_PREFIX):
+                    data = json.dumps({"key": conv_key}, ensure_ascii=False) + "\n" + data
+                with open(path, "w", encoding="utf-8") as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+            count = len(legacy)
+        finally:
+            legacy.close()
+        self._sync_directory()
+        # Written last: an import cut short is redone whole on the next start
+        tmp = marker.with_name(marker.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"source": str(legacy_path.resolve()), "conversations": count,
+                       "imported_at": datetime.now(timezone.utc).isoformat(timespec="seconds")}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, marker)
+        self._sync_directory()
+        logger.info("Imported %d conversations from %s in %.1fs", count, legacy_path, time.perf_counter() - started)
+
+
+@atexit.register
+def _close_open_stores():
+    # Flush-on-shutdown: write out whatever the writer threads still hold
+    for store in list(_open_stores):
+        store.close()
@@ -0,0 +1,79 @@
+from app.services.journal import JournaledStore
+from app.services.storage.base import ConversationBackend
+
+
+class ConversationStore(JournaledStore, ConversationBackend):
+    """
+    Conversation history kept in memory and persisted as a snapshot plus an
+    append-only journal, so saving a turn costs O(message size) instead of
+    rewriting every conversation.
+
+    Every conversation is loaded at startup; the app now uses
+    ConversationFileStore, which imports this format once.
+    """
+
+    snapshot_key = "conversations"
+
+    def __init__(self, path, **kwargs):
+        self._data = {}
+        super().__init__(path, **kwargs)
+
+    # --- Read access ---
+    def __contains__(self, conv_key):
+        return conv_key in self._data
+
+    def __getitem__(self, conv_key):
+        return self._data[conv_key]
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, conv_key, default=None):
+        return self._data.get(conv_key, default)
+
+    def keys(self):
+        return list(self._data.keys())
+
+    # --- Mutations ---
+    def append(self, conv_key, message):
+        with self._lock:
+            self._data.setdefault(conv_key, []).append(message)
+            self._write({"op": "append", "key": conv_key, "message": message})
+
+    def extend(self, conv_key, messages):
+        with self._lock:
+            self._data.setdefault(conv_key, []).extend(messages)
+            self._write({"op": "extend", "key": conv_key, "messages": messages})
+
+    def delete_prefix(self, prefix):
+        with self._lock:
+            keys = [k for k in self._data if k.startswith(prefix)]
+            for k in keys:
+                del self._data[k]
+            if keys:
+                self._write({"op": "delete_prefix", "prefix": prefix})
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._write({"op": "clear"})
+
+    # --- Journal hooks ---
+    def _restore(self, payload):
+        self._data.update(payload)
+
+    def _dump(self):
+        return {k: list(v) for k, v in self._data.items()}
+
+    def _apply(self, record):
+        op = record.get("op")
+        if op == "append":
+            self._data.setdefault(record["key"], []).append(record["message"])
+        elif op == "extend":
+            self._data.setdefault(record["key"], []).extend(record["messages"])
+        elif op == "delete_prefix":
+            for k in [k for k in self._data if k.startswith(record["prefix"])]:
+                del self._data[k]
+        elif op == "clear":
+            self._data.clear()
@@ -1,7 +1,8 @@
 from pathlib import Path
 import json
 
-import os
+from app.services import metrics
+from app.services.storage.base import SetupBackend
 
 # --- Helper Functions ---
 def load_json(path, default=None):
@@ -17,40 +18,39 @@ def save_json(path, data):
     path.parent.mkdir(parents=True, exist_ok=True)
     with open(path, "w", encoding="utf-8") as f:
         json.dump(data, f, indent=4)
-
-# --- Data Loading ---
-setups_by_user = load_json(Path("data/setups.json"), default={})
-leads = load_json(Path("data/leads.json"), default=[])
-
-page_to_setup_map = {}
-
-def build_page_map():
-    global page_to_setup_map
-    page_to_setup_map = {}
-    for user_id, setup in setups_by_user.items():
-        if not isinstance(setup, dict):
-            continue
-        page_id = setup.get("page_id")
-        if page_id:
-            page_to_setup_map[page_id] = {**setup, "user_id": user_id}
-
-# Call on load
-build_page_map()
-
-# --- Save Helpers ---
-def save_setups():
-    save_json(Path("data/setups.json"), setups_by_user)
-    build_page_map()  # Keep map in sync
-
-def save_leads():
-    save_json(Path("data/leads.json"), leads)
-# --- Clear Leads Helper ---
-
-
-def clear_leads():
-    global leads
-    leads = []
-
-    leads_file = Path("data/leads.json")
-    if leads_file.exists():
-        os.remove(leads_file)  # delete the file
\ No newline at end of file
+        f.flush()
+        metrics.inc(metrics.BYTES_WRITTEN, f.buffer.tell(), store=path.name)
+
+
+class JsonSetupStore(SetupBackend):
+    """Setups kept in data/setups.json as {user_id: setup}, with a page_id index."""
+
+    def __init__(self, path=Path("data/setups.json")):
+        self.path = Path(path)
+        self.setups_by_user = load_json(self.path, default={})
+        self.page_to_setup_map = {}
+        self.build_page_map()
+
+    def build_page_map(self):
+        page_to_setup_map = {}
+        for user_id, setup in self.setups_by_user.items():
+            if not isinstance(setup, dict):
+                continue
+            page_id = setup.get("page_id")
+            if page_id:
+                page_to_setup_map[page_id] = {**setup, "user_id": user_id}
+        self.page_to_setup_map = page_to_setup_map
+
+    def get(self, user_id):
+        return self.setups_by_user.get(user_id)
+
+    def get_for_page(self, page_id):
+        return self.page_to_setup_map.get(page_id)
+
+    def all(self):
+        return dict(self.setups_by_user)
+
+    def save(self, setup: dict):
+        self.setups_by_user[setup["user_id"]] = setup
+        save_json(self.path, self.setups_by_user)
+        self.build_page_map()  # Keep map in sync
@@ -0,0 +1,84 @@
+import logging
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app.services.context_builder import setup_hash
+
+logger = logging.getLogger(__name__)
+
+# Pre-generated welcome variants kept per (page_id, setup hash, model)
+GREETING_POOL_SIZE = int(os.environ.get("GREETING_POOL_SIZE", "3"))
+# Models warmed in the background when a setup is saved
+GREETING_PREWARM_MODELS = [m.strip() for m in os.environ.get("GREETING_PREWARM_MODELS", "chatgpt").split(",") if m.strip()]
+
+
+class GreetingCache:
+    """
+    Pool of opening messages so a new conversation starts without an LLM
+    round trip. Entries are keyed by setup hash, so a changed setup never
+    serves an old greeting; `prewarm()` drops the page's stale pools and
+    refills them in the background.
+    """
+
+    def __init__(self, generate, build_messages, pool_size=GREETING_POOL_SIZE):
+        self.generate = generate
+        self.build_messages = build_messages
+        self.pool_size = pool_size
+        self._pools = {}
+        self._refilling = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="greeting-refill")
+
+    @staticmethod
+    def key(setup, model):
+        return (setup.get("page_id"), setup_hash(setup), model)
+
+    def take(self, setup, model):
+        """A cached greeting, or None on a miss (a refill is then scheduled)."""
+        key = self.key(setup, model)
+        with self._lock:
+            pool = self._pools.get(key)
+            greeting = random.choice(pool) if pool else None
+        if greeting is None or len(pool) < self.pool_size:
+            self._schedule_refill(setup, model)
+        return greeting
+
+    def add(self, setup, model, greeting):
+        key = self.key(setup, model)
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            if len(pool) < self.pool_size and greeting not in pool:
+                pool.append(greeting)
+
+    def invalidate(self, page_id, keep_hash=None):
+        with self._lock:
+            for key in [k for k in self._pools if k[0] == page_id and k[1] != keep_hash]:
+                del self._pools[key]
+
+    def prewarm(self, setup, models=None):
+        self.invalidate(setup.get("page_id"), keep_hash=setup_hash(setup))
+        for model in models or GREETING_PREWARM_MODELS:
+            self._schedule_refill(setup, model)
+
+    def _schedule_refill(self, setup, model):
+        key = self.key(setup, model)
+        with self._lock:
+            if key in self._refilling:
+                return
+            self._refilling.add(key)
+        self._executor.submit(self._refill, key, dict(setup), model)
+
+    def _refill(self, key, setup, model):
+        try:
+            # Bounded, in case the model keeps returning a greeting already pooled
+            for _ in range(self.pool_size * 2):
+                if len(self._pools.get(key, ())) >= self.pool_size:
+                    break
+                self.add(setup, model, self.generate(model, self.build_messages(setup)))
+        except Exception as e:
+            logger.warning("greeting refill failed for %s: %s", key, e)
+        finally:
+            with self._lock:
+                self._refilling.discard(key)
@@ -0,0 +1,326 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+from pathlib import Path
+
+from app.services import metrics
+
+logger = logging.getLogger(__name__)
+
+# Number of journal records after which the snapshot is rebuilt in the background
+COMPACT_EVERY = int(os.environ.get("JOURNAL_COMPACT_EVERY", os.environ.get("CONVERSATION_COMPACT_EVERY", "5000")))
+# When to fsync the journal: "always" (every group commit), "interval" (at most
+# every JOURNAL_FSYNC_INTERVAL seconds) or "never" (leave it to the OS).
+# The old boolean values still work: "1" is "always", "0" is "never".
+_fsync_env = os.environ.get("JOURNAL_FSYNC", os.environ.get("CONVERSATION_FSYNC", "never"))
+FSYNC_POLICY = {"1": "always", "0": "never"}.get(_fsync_env, _fsync_env)
+FSYNC_INTERVAL = float(os.environ.get("JOURNAL_FSYNC_INTERVAL", "1.0"))
+# Records are handed to a background writer instead of being written inside
+# the request; set to "0" to write synchronously
+WRITE_BEHIND = os.environ.get("JOURNAL_WRITE_BEHIND", "1") == "1"
+# The writer commits as soon as this many records are queued...
+WRITE_BATCH_SIZE = int(os.environ.get("JOURNAL_WRITE_BATCH_SIZE", "256"))
+# ...or when the oldest queued record is this old
+WRITE_INTERVAL = float(os.environ.get("JOURNAL_WRITE_INTERVAL_MS", "50")) / 1000
+# Longest wait between retries after a failed write (ENOSPC, EIO); queued records are kept meanwhile
+WRITE_RETRY_MAX = float(os.environ.get("JOURNAL_WRITE_RETRY_MAX", "5"))
+
+# Open stores, flushed and closed at interpreter exit
+_open_stores = weakref.WeakSet()
+
+
+class JournaledStore:
+    """
+    In-memory state persisted as a snapshot plus an append-only journal.
+
+    Every change is written to `<snapshot>.journal` as one JSON line, so a
+    write costs O(record size) instead of rewriting the whole file. Once the
+    journal holds `compact_every` records a background thread folds it into
+    a fresh snapshot. On startup the snapshot is loaded and the journal tail
+    is replayed on top of it.
+
+    With write-behind on, a mutation only updates memory and queues its
+    record; a writer thread appends queued records in one write (a group
+    commit) once `batch_size` are waiting or `write_interval` has passed.
+    `flush()` blocks until everything queued so far is on disk.
+
+    With `read_only` the state is loaded and nothing is created, opened for
+    writing or compacted; mutations raise.
+
+    Subclasses define `snapshot_key`, `_restore()`, `_dump()` and `_apply()`.
+    """
+
+    snapshot_key = "data"
+
+    def __init__(self, path, compact_every=COMPACT_EVERY, fsync=FSYNC_POLICY, write_behind=WRITE_BEHIND,
+                 batch_size=WRITE_BATCH_SIZE, write_interval=WRITE_INTERVAL, fsync_interval=FSYNC_INTERVAL,
+                 read_only=False):
+        if fsync not in ("always", "interval", "never"):
+            raise ValueError(f"Unknown fsync policy: {fsync!r}")
+        self.path = Path(path)
+        self.journal_path = self.path.with_name(self.path.name + ".journal")
+        self.rotated_path = self.path.with_name(self.path.name + ".journal.old")
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.write_behind = write_behind
+        self.batch_size = batch_size
+        self.write_interval = write_interval
+        self.read_only = read_only
+
+        # Lock order: _io_lock before _lock. _lock guards memory and the queue,
+        # _io_lock the journal file handle.
+        self._lock = threading.RLock()
+        self._io_lock = threading.Lock()
+        self._seq = 0
+        self._pending = 0
+        self._compactor = None
+        self._queue = []
+        self._written_seq = 0
+        self._last_fsync = time.monotonic()
+        self._unsynced = False
+        self._wake = threading.Event()
+        self._flushed = threading.Condition(threading.Lock())
+        self._closed = False
+
+        self._load()
+        self._written_seq = self._seq
+        if read_only:
+            # Born closed: close() and flush() have nothing to do
+            self._closed = True
+            self._writer = None
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._writer = None
+        if write_behind:
+            self._writer = threading.Thread(target=self._run_writer, name=f"{self.path.name}-writer", daemon=True)
+            self._writer.start()
+        _open_stores.add(self)
+        if self._pending >= self.compact_every:
+            self._schedule_compaction()
+
+    # --- Subclass hooks ---
+    def _restore(self, payload):
+        """Load the snapshot payload (new format or legacy bare file)."""
+        raise NotImplementedError
+
+    def _dump(self):
+        """JSON-serializable copy of the current state; called under the lock."""
+        raise NotImplementedError
+
+    def _apply(self, record):
+        """Re-apply one journal record during replay."""
+        raise NotImplementedError
+
+    def flush(self):
+        """Write (and, unless the policy is "never", fsync) every record queued so far."""
+        with self._lock:
+            target = self._seq
+        self._drain(force_fsync=self.fsync != "never")
+        with self._flushed:
+            while self._written_seq < target and not self._closed:
+                self._flushed.wait(0.1)
+
+    def close(self):
+        if self._closed:
+            return
+        compactor = self._compactor
+        if compactor is not None:
+            compactor.join()
+        self._closed = True
+        self._wake.set()
+        if self._writer is not None:
+            self._writer.join()
+        self._drain(force_fsync=self.fsync != "never")
+        with self._io_lock:
+            if not self._journal.closed:
+                self._journal.close()
+        _open_stores.discard(self)
+
+    # --- Journal ---
+    def _write(self, record):
+        """Called with self._lock held."""
+        if self.read_only:
+            raise RuntimeError(f"{self.path} was opened read-only")
+        if self._closed:
+            # Reopening the journal here would leak the handle and write behind the owner's back
+            raise RuntimeError(f"{self.path} is closed")
+        self._seq += 1
+        record["seq"] = self._seq
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        if self.write_behind:
+            self._queue.append(line)
+            if len(self._queue) >= self.batch_size:
+                self._wake.set()
+        else:
+            # Compaction swaps the file under self._lock too, so the handle is safe here
+            self._append([line], self._seq)
+        self._pending += 1
+        if self._pending >= self.compact_every:
+            self._schedule_compaction()
+
+    def _run_writer(self):
+        backoff = 0.0
+        while not self._closed:
+            deadline = time.monotonic() + (backoff or self.write_interval)
+            # New records wake the writer early, but not out of a retry backoff
+            while not self._closed and time.monotonic() < deadline:
+                if self._wake.wait(deadline - time.monotonic()) and not backoff:
+                    break
+                self._wake.clear()
+            self._wake.clear()
+            try:
+                self._drain()
+                backoff = 0.0
+            except OSError as e:
+                backoff = min(max(backoff * 2, self.write_interval, 0.1), WRITE_RETRY_MAX)
+                logger.error("%s: write failed, %d records kept for a retry in %.1fs: %s",
+                             self.journal_path, len(self._queue), backoff, e)
+
+    def _drain(self, force_fsync=False):
+        with self._io_lock:
+            self._write_queued()
+            if self._unsynced and (force_fsync or (
+                    self.fsync == "interval" and time.monotonic() - self._last_fsync >= self.fsync_interval)):
+                self._sync()
+
+    def _write_queued(self):
+        """Append every queued record; on failure they go back in front of the queue. Needs _io_lock."""
+        with self._lock:
+            lines, self._queue = self._queue, []
+            seq = self._seq
+        if not lines:
+            return
+        try:
+            self._append(lines, seq)
+        except OSError:
+            with self._lock:
+                self._queue[:0] = lines
+            raise
+
+    def _append(self, lines, seq):
+        """One write (and at most one fsync) for a batch of records ending at `seq`."""
+        data = "".join(lines)
+        if self._journal.closed:
+            # A failed write dropped the handle
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        size = os.fstat(self._journal.fileno()).st_size
+        try:
+            self._journal.write(data)
+            self._journal.flush()
+        except OSError:
+            self._drop_partial_write(size)
+            raise
+        if metrics.ENABLED:
+            metrics.BYTES_WRITTEN.inc(len(data.encode("utf-8")), store=self.journal_path.name)
+        self._unsynced = True
+        if self.fsync == "always":
+            self._sync()
+        with self._flushed:
+            self._written_seq = max(self._written_seq, seq)
+            self._flushed.notify_all()
+
+    def _drop_partial_write(self, size):
+        """
+        Cut a failed write back off the journal: replay stops at a torn line,
+        so records retried after one would never be read back.
+        """
+        try:
+            self._journal.close()
+        except OSError:
+            pass  # the rest of the failed write, still buffered; it goes with the handle
+        try:
+            os.truncate(self.journal_path, size)
+        except OSError as e:
+            logger.error("%s: could not cut back a failed write: %s", self.journal_path, e)
+
+    def _sync(self):
+        os.fsync(self._journal.fileno())
+        self._unsynced = False
+        self._last_fsync = time.monotonic()
+
+    def _replay(self, path, snapshot_seq):
+        if not path.exists():
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn final line from a crash mid-write; nothing after it is valid
+                    break
+                seq = record.get("seq", 0)
+                if seq <= snapshot_seq:
+                    continue
+                self._apply(record)
+                self._seq = seq
+                self._pending += 1
+
+    def _load(self):
+        snapshot_seq = 0
+        if self.path.exists():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    snapshot = json.load(f)
+            except json.JSONDecodeError:
+                snapshot = None
+            if isinstance(snapshot, dict) and "seq" in snapshot and self.snapshot_key in snapshot:
+                snapshot_seq = snapshot["seq"]
+                self._restore(snapshot[self.snapshot_key])
+            elif snapshot is not None:
+                # Legacy format: the file is the bare payload
+                self._restore(snapshot)
+        self._seq = snapshot_seq
+        # A rotated journal only survives if a compaction was interrupted
+        self._replay(self.rotated_path, snapshot_seq)
+        self._replay(self.journal_path, snapshot_seq)
+
+    # --- Compaction ---
+    def _schedule_compaction(self):
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        self._compactor = threading.Thread(target=self.compact, name=f"{self.path.name}-compactor", daemon=True)
+        self._compactor.start()
+
+    def compact(self):
+        with self._io_lock, self._lock:
+            # Queued records go to the journal being rotated out, so it stays a strict prefix
+            self._write_queued()
+            if self._unsynced and self.fsync != "never":
+                self._sync()
+            if self.rotated_path.exists():
+                # Previous compaction never finished; let this one include its records
+                with open(self.rotated_path, "a", encoding="utf-8") as old, \
+                        open(self.journal_path, "r", encoding="utf-8") as cur:
+                    old.write(cur.read())
+                self._journal.close()
+                os.remove(self.journal_path)
+            else:
+                self._journal.close()
+                os.replace(self.journal_path, self.rotated_path)
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+            self._unsynced = False
+            seq = self._seq
+            self._pending = 0
+            snapshot = self._dump()
+
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"seq": seq, self.snapshot_key: snapshot}, f, ensure_ascii=False)
+            f.flush()
+            metrics.inc(metrics.BYTES_WRITTEN, f.buffer.tell(), store=self.path.name)
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        os.remove(self.rotated_path)
+
+
+@atexit.register
+def _flush_open_stores():
+    # Flush-on-shutdown: write out whatever the background writers still hold
+    for store in list(_open_stores):
+        store.close()
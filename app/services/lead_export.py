@@ -0,0 +1,52 @@
+import csv
+import io
+import json
+
+# Leading CSV columns; captured fields follow in first-seen order
+BASE_COLUMNS = ["page_id", "user_id", "updated_at"]
+# Last CSV column: fields the header pass did not see (added to leads meanwhile), as a JSON object
+EXTRA_COLUMN = "extra"
+
+
+def iter_json_array(store, page_id=None, updated_since=None):
+    """The leads as one JSON array, produced lead by lead."""
+    yield "["
+    first = True
+    for _, lead in store.iter_leads(page_id, updated_since):
+        yield ("" if first else ",") + json.dumps(lead, ensure_ascii=False)
+        first = False
+    yield "]"
+
+
+def iter_ndjson(store, page_id=None, updated_since=None):
+    for _, lead in store.iter_leads(page_id, updated_since):
+        yield json.dumps(lead, ensure_ascii=False) + "\n"
+
+
+def iter_csv(store, page_id=None, updated_since=None):
+    # Leads have different field sets, so one cheap pass collects the header
+    columns = list(BASE_COLUMNS)
+    seen = set(columns)
+    for _, lead in store.iter_leads(page_id, updated_since):
+        for key in lead:
+            if key not in seen:
+                seen.add(key)
+                columns.append(key)
+
+    extra = EXTRA_COLUMN
+    while extra in seen:
+        extra = "_" + extra
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns + [extra])
+    writer.writeheader()
+    for _, lead in store.iter_leads(page_id, updated_since):
+        row = {key: value for key, value in lead.items() if key in seen}
+        unseen = {key: value for key, value in lead.items() if key not in seen}
+        if unseen:
+            row[extra] = json.dumps(unseen, ensure_ascii=False)
+        writer.writerow(row)
+        if buffer.tell() > 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
@@ -0,0 +1,107 @@
+from datetime import datetime, timezone
+
+from app.services.journal import JournaledStore
+from app.services.storage.base import LeadBackend
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+class LeadStore(JournaledStore, LeadBackend):
+    """
+    Leads indexed by (page_id, user_id). Upserts are O(1) and persisted as
+    one journal record each; reads page through per-page insertion order
+    without copying the whole list.
+    """
+
+    snapshot_key = "leads"
+
+    def __init__(self, path, **kwargs):
+        self._leads = {}
+        self._order = []
+        self._by_page = {}
+        super().__init__(path, **kwargs)
+
+    def __len__(self):
+        return len(self._leads)
+
+    def get(self, page_id, user_id):
+        # A copy: upserts update the stored dict in place
+        with self._lock:
+            lead = self._leads.get((page_id, user_id))
+            return dict(lead) if lead is not None else None
+
+    # --- Mutations ---
+    def upsert(self, page_id, user_id, fields):
+        """Merge `fields` into the lead for (page_id, user_id), creating it if needed."""
+        with self._lock:
+            updated_at = _now()
+            lead = self._upsert(page_id, user_id, fields, updated_at)
+            self._write({"op": "upsert", "page_id": page_id, "user_id": user_id,
+                         "fields": fields, "updated_at": updated_at})
+            return lead
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+            self._write({"op": "clear"})
+
+    def _upsert(self, page_id, user_id, fields, updated_at):
+        key = (page_id, user_id)
+        lead = self._leads.get(key)
+        if lead is None:
+            lead = self._leads[key] = {}
+            self._order.append(key)
+            self._by_page.setdefault(page_id, []).append(key)
+        lead.update(fields)
+        lead["user_id"] = user_id
+        lead["page_id"] = page_id
+        lead["updated_at"] = updated_at
+        return lead
+
+    def _reset(self):
+        self._leads = {}
+        self._order = []
+        self._by_page = {}
+
+    # --- Reads ---
+    def _keys_for(self, page_id):
+        return self._order if page_id is None else self._by_page.get(page_id, [])
+
+    def iter_leads(self, page_id=None, updated_since=None, start=0):
+        """
+        Yield (position, lead) in insertion order. Keys are only ever appended
+        (or all cleared), so walking by index is safe while writers run; each
+        lead is copied under the lock, since upserts update it in place.
+        """
+        keys = self._keys_for(page_id)
+        position = start
+        while position < len(keys):
+            with self._lock:
+                lead = self._leads.get(keys[position])
+                lead = dict(lead) if lead is not None else None
+            position += 1
+            if lead is None:
+                continue
+            if updated_since and lead.get("updated_at", "") < updated_since:
+                continue
+            yield position, lead
+
+    # --- Journal hooks ---
+    def _restore(self, payload):
+        # Legacy leads.json is a plain list without updated_at
+        for lead in payload:
+            if isinstance(lead, dict):
+                fields = {k: v for k, v in lead.items() if k not in ("page_id", "user_id", "updated_at")}
+                self._upsert(lead.get("page_id"), lead.get("user_id"), fields, lead.get("updated_at", ""))
+
+    def _dump(self):
+        return [dict(self._leads[k]) for k in self._order]
+
+    def _apply(self, record):
+        op = record.get("op")
+        if op == "upsert":
+            self._upsert(record["page_id"], record["user_id"], record["fields"], record["updated_at"])
+        elif op == "clear":
+            self._reset()
@@ -0,0 +1,484 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Iterator, List, Optional
+
+from app.services import metrics
+from app.services.ai_client import (
+    Cancellation, Cancelled, LLMError,
+    generate_deepseek_reply, generate_chatgpt_reply, stream_deepseek_reply, stream_chatgpt_reply,
+    agenerate_deepseek_reply, agenerate_chatgpt_reply, astream_deepseek_reply, astream_chatgpt_reply,
+)
+
+logger = logging.getLogger(__name__)
+
+# Fire the alternate provider when the primary has not answered (or, when
+# streaming, sent its first token) by its recent LLM_HEDGE_PERCENTILE latency,
+# clamped to [LLM_HEDGE_MIN_MS, LLM_HEDGE_MAX_MS]
+HEDGE_ENABLED = os.environ.get("LLM_HEDGE", "1") == "1"
+HEDGE_PERCENTILE = float(os.environ.get("LLM_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_MS = float(os.environ.get("LLM_HEDGE_MIN_MS", "1500"))
+HEDGE_MAX_MS = float(os.environ.get("LLM_HEDGE_MAX_MS", "20000"))
+# Deadline used until a provider has MIN_SAMPLES latencies
+HEDGE_DEFAULT_MS = float(os.environ.get("LLM_HEDGE_DEFAULT_MS", "8000"))
+MIN_SAMPLES = 20
+# Send the request to the other provider when the chosen one fails outright
+FALLBACK_ENABLED = os.environ.get("LLM_FALLBACK", "1") == "1"
+# Consecutive failures that open a provider's circuit, and seconds before a probe
+BREAKER_FAILURES = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.environ.get("LLM_BREAKER_RESET", "30"))
+EWMA_ALPHA = float(os.environ.get("LLM_EWMA_ALPHA", "0.2"))
+LATENCY_WINDOW = 200
+# Latencies are kept per kind of call: whole completions, and time to the first streamed token
+CALL_KINDS = ("generate", "stream")
+# Threads that run blocking hedge and fallback calls; the primary runs in the caller's thread
+ROUTER_THREADS = int(os.environ.get("LLM_ROUTER_THREADS", "128"))
+
+# Errors caused by the request itself say nothing about the provider's health
+REQUEST_ERRORS = {400, 413, 422}
+
+PROVIDER_SECONDS = metrics.histogram(
+    "llm_provider_seconds", "Provider latency (to the first token for stream calls), by call kind and outcome.",
+    ["provider", "kind", "outcome"])
+HEDGES = metrics.counter("llm_hedges_total", "Requests sent to another provider after a hedge deadline.", ["provider"])
+FALLBACKS = metrics.counter("llm_fallbacks_total", "Requests sent to another provider after a failure.", ["provider"])
+
+
+class ProviderHealth:
+    """Rolling latency/error averages and a circuit breaker for one provider."""
+
+    def __init__(self, name, failures=BREAKER_FAILURES, reset_after=BREAKER_RESET, alpha=EWMA_ALPHA):
+        self.name = name
+        self.failure_threshold = failures
+        self.reset_after = reset_after
+        self.alpha = alpha
+        self.latency_ewma = dict.fromkeys(CALL_KINDS)
+        self.error_ewma = 0.0
+        self.state = "closed"
+        self._samples = {kind: deque(maxlen=LATENCY_WINDOW) for kind in CALL_KINDS}
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        """Whether a request may be sent now. An open circuit admits one probe after `reset_after`."""
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_after:
+                self.state = "half_open"
+            if self.state == "half_open":
+                return not self._probing
+            return self.state == "closed"
+
+    def begin(self):
+        with self._lock:
+            if self.state == "half_open":
+                self._probing = True
+
+    def record_success(self, latency_ms, kind="generate"):
+        with self._lock:
+            self._samples[kind].append(latency_ms)
+            ewma = self.latency_ewma[kind]
+            self.latency_ewma[kind] = latency_ms if ewma is None else (
+                self.alpha * latency_ms + (1 - self.alpha) * ewma)
+            self.error_ewma *= 1 - self.alpha
+            self._failures = 0
+            self._probing = False
+            if self.state != "closed":
+                logger.info("%s circuit closed", self.name)
+            self.state = "closed"
+
+    def record_failure(self, error: LLMError):
+        if error.status_code in REQUEST_ERRORS:
+            self.abandon()
+            return
+        with self._lock:
+            self.error_ewma = self.alpha + (1 - self.alpha) * self.error_ewma
+            self._failures += 1
+            self._probing = False
+            if self.state == "half_open" or (self.state == "closed" and self._failures >= self.failure_threshold):
+                logger.warning("%s circuit opened after %d failures: %s", self.name, self._failures, error.message)
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+    def abandon(self):
+        """A request that ended without a verdict (cancelled, or a bad request)."""
+        with self._lock:
+            self._probing = False
+
+    def percentile(self, pct, kind="generate"):
+        with self._lock:
+            samples = sorted(self._samples[kind])
+        if len(samples) < MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+    def snapshot(self) -> dict:
+        return {
+            "state": self.state,
+            "latency_ewma_ms": dict(self.latency_ewma),
+            "error_ewma": self.error_ewma,
+            "p95_ms": {kind: self.percentile(95, kind) for kind in CALL_KINDS},
+        }
+
+
+def _observe(name, kind, outcome, start) -> float:
+    """Record a finished provider call; returns its latency in ms."""
+    elapsed = time.perf_counter() - start
+    if metrics.ENABLED:
+        PROVIDER_SECONDS.observe(elapsed, provider=name, kind=kind, outcome=outcome)
+    return elapsed * 1000
+
+
+class _Timers:
+    """One daemon thread that runs short callbacks at a deadline (hedge launches)."""
+
+    def __init__(self):
+        self._heap = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def call_later(self, delay, fn) -> list:
+        entry = [time.monotonic() + delay, next(self._order), fn]
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="llm-hedge-timer", daemon=True)
+                self._thread.start()
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._cond.notify()
+        return entry
+
+    @staticmethod
+    def cancel(entry):
+        # Left in the heap and skipped when due
+        entry[2] = None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, fn = heapq.heappop(self._heap)
+            if fn is not None:
+                try:
+                    fn()
+                except Exception:
+                    logger.exception("hedge timer callback failed")
+
+
+_timers = _Timers()
+
+
+class _Race:
+    """State shared by the threads of one blocking LLMRouter._race()."""
+
+    def __init__(self, order, kind):
+        self.queue = list(order)
+        self.kind = kind
+        self.cond = threading.Condition()
+        self.running = {}  # provider -> Cancellation
+        self.errors = []
+        self.winner = None
+
+    def claim(self, hedge=False) -> Optional[tuple]:
+        """
+        The next provider to ask and its Cancellation, or None once the race is
+        decided or out of providers. A hedge is only claimed while a call is running.
+        """
+        with self.cond:
+            if self.winner is not None or not self.queue or (hedge and not self.running):
+                return None
+            name = self.queue.pop(0)
+            cancel = self.running[name] = Cancellation()
+            return name, cancel
+
+    def finish(self, name, result=None, error=None, won=False) -> bool:
+        """Record how `name` ended; returns False if it won after the race was decided."""
+        with self.cond:
+            self.running.pop(name, None)
+            if error is not None:
+                self.errors.append(error)
+            first = won and self.winner is None
+            if first:
+                self.winner = (name, result)
+                losers = list(self.running.values())
+            self.cond.notify_all()
+        for cancel in losers if first else ():
+            cancel.cancel()
+        return first or not won
+
+    def stop(self):
+        """Ask no one else and cancel whatever is still running."""
+        with self.cond:
+            self.queue.clear()
+            running = list(self.running.values())
+        for cancel in running:
+            cancel.cancel()
+
+
+@dataclass
+class Route:
+    name: str
+    # Each is called as fn(messages, tools); providers without tool support ignore `tools`.
+    # `stream` also takes an optional Cancellation as a third argument
+    generate: Callable[..., str]
+    stream: Callable[..., Iterator[str]]
+    agenerate: Callable
+    astream: Callable[..., AsyncIterator[str]]
+
+
+class LLMRouter:
+    """
+    Sends each reply to the requested provider, hedged against the others:
+
+    - a provider whose circuit is open is skipped while another is available;
+    - if the primary has not answered by its hedge deadline the next provider
+      is asked too, and the first answer wins;
+    - if the primary fails outright the next provider is asked at once.
+
+    Blocking calls run the primary in the caller's thread; hedges and
+    fallbacks behind it use a small pool. A raced blocking call is streamed
+    and joined, so the loser can be cut off: its socket is shut down (or,
+    if it has not been sent yet, it never is). Async losers are cancelled.
+    For streams the deadline applies to the first token; after that the
+    winner streams alone.
+    """
+
+    def __init__(self, routes: List[Route], hedge=HEDGE_ENABLED, fallback=FALLBACK_ENABLED):
+        self.routes = {route.name: route for route in routes}
+        self.health = {route.name: ProviderHealth(route.name) for route in routes}
+        self.hedge = hedge
+        self.fallback = fallback
+        self._pool = ThreadPoolExecutor(max_workers=ROUTER_THREADS, thread_name_prefix="llm-router")
+
+    def _order(self, preferred) -> List[str]:
+        primary = preferred if preferred in self.routes else next(iter(self.routes))
+        names = [primary] + ([n for n in self.routes if n != primary] if self.fallback else [])
+        usable = [n for n in names if self.health[n].available()]
+        # Every circuit open: still try the requested provider rather than fail outright
+        return usable or [primary]
+
+    def hedge_delay(self, name, kind="generate") -> float:
+        """Seconds to wait for `name` before asking the next provider, from its latencies for `kind` calls."""
+        p = self.health[name].percentile(HEDGE_PERCENTILE, kind)
+        delay_ms = HEDGE_DEFAULT_MS if p is None else min(max(p, HEDGE_MIN_MS), HEDGE_MAX_MS)
+        return delay_ms / 1000
+
+    def snapshot(self) -> dict:
+        return {name: health.snapshot() for name, health in self.health.items()}
+
+    # --- Blocking ---
+    def _timed(self, name, fn, kind):
+        health = self.health[name]
+        health.begin()
+        start = time.perf_counter()
+        try:
+            result = fn()
+        except LLMError as e:
+            health.record_failure(e)
+            _observe(name, kind, "error", start)
+            raise
+        except BaseException:
+            health.abandon()
+            raise
+        health.record_success(_observe(name, kind, "ok", start), kind)
+        return result
+
+    def _run(self, race, name, cancel, start, discard=None):
+        """Run one racer in the current thread and record its outcome in `race`."""
+        if cancel.cancelled:
+            race.finish(name)
+            return
+        try:
+            result = self._timed(name, lambda: start(name, cancel), race.kind)
+        except Cancelled:
+            race.finish(name)
+        except BaseException as e:
+            race.finish(name, error=e)
+            if not isinstance(e, Exception):
+                raise
+        else:
+            if not race.finish(name, result, won=True) and discard is not None:
+                discard(name, result)
+
+    def _hedge(self, race, first, start, discard):
+        claimed = race.claim(hedge=True)
+        if claimed is None:
+            return
+        logger.info("%s passed its hedge deadline, asking %s", first, claimed[0])
+        metrics.inc(HEDGES, provider=claimed[0])
+        try:
+            self._pool.submit(self._run, race, *claimed, start, discard)
+        except RuntimeError:
+            # Pool shut down (interpreter exit): the hedge is simply not sent
+            race.finish(claimed[0])
+
+    def _race(self, order, start, kind, discard=None):
+        """
+        Run start(name, cancel) for order[0] in this thread, adding the next
+        provider on a deadline or failure. Returns the first successful result;
+        the others are cancelled, and discard(name, result) gets any answer
+        that still arrives. With a single provider `cancel` is None. Latencies
+        are recorded, and the deadline picked, for `kind` calls.
+        """
+        if len(order) == 1:
+            return order[0], self._timed(order[0], lambda: start(order[0], None), kind)
+        race = _Race(order, kind)
+        first, cancel = race.claim()
+        timer = None
+        if self.hedge and race.queue:
+            timer = _timers.call_later(self.hedge_delay(first, kind), lambda: self._hedge(race, first, start, discard))
+        try:
+            try:
+                self._run(race, first, cancel, start, discard)
+            finally:
+                if timer is not None:
+                    _timers.cancel(timer)
+            while True:
+                with race.cond:
+                    while race.winner is None and race.running:
+                        race.cond.wait()
+                    if race.winner is not None:
+                        return race.winner
+                    unexpected = [e for e in race.errors if not isinstance(e, LLMError)]
+                if unexpected:
+                    raise unexpected[0]
+                claimed = race.claim()
+                if claimed is None:
+                    raise race.errors[0]
+                metrics.inc(FALLBACKS, provider=claimed[0])
+                self._run(race, *claimed, start, discard)
+        finally:
+            race.stop()
+
+    def generate(self, preferred, messages: List[dict], tools: Optional[list] = None) -> str:
+        def start(name, cancel):
+            route = self.routes[name]
+            if cancel is None:
+                return route.generate(messages, tools)
+            reply = "".join(route.stream(messages, tools, cancel)).strip()
+            if not reply:
+                raise LLMError(name, "empty completion")
+            return reply
+
+        _, reply = self._race(self._order(preferred), start, "generate")
+        return reply
+
+    def stream(self, preferred, messages: List[dict], tools: Optional[list] = None) -> Iterator[str]:
+        order = self._order(preferred)
+        streams = {}
+
+        def first_delta(name, cancel):
+            stream = streams[name] = self.routes[name].stream(messages, tools, cancel)
+            return next(stream, "")
+
+        # A loser whose first token came in after the winner's is closed at once
+        name, delta = self._race(order, first_delta, "stream", lambda loser, _: streams[loser].close())
+        if delta:
+            yield delta
+        yield from streams[name]
+
+    # --- Async ---
+    async def _atimed(self, name, coro, kind):
+        health = self.health[name]
+        health.begin()
+        start = time.perf_counter()
+        try:
+            result = await coro
+        except LLMError as e:
+            health.record_failure(e)
+            _observe(name, kind, "error", start)
+            raise
+        except BaseException:
+            health.abandon()
+            raise
+        health.record_success(_observe(name, kind, "ok", start), kind)
+        return result
+
+    async def _arace(self, order, start, kind):
+        """_race() for coroutines; losers are cancelled."""
+        pending = {}
+        queue = list(order)
+        errors = []
+
+        def launch():
+            name = queue.pop(0)
+            pending[asyncio.ensure_future(self._atimed(name, start(name), kind))] = name
+            return name
+
+        first = launch()
+        deadline = self.hedge_delay(first, kind) if self.hedge and queue else None
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=deadline, return_when=asyncio.FIRST_COMPLETED)
+                deadline = None
+                if not done:
+                    logger.info("%s passed its hedge deadline, asking %s", first, queue[0])
+                    hedge = launch()
+                    metrics.inc(HEDGES, provider=hedge)
+                    continue
+                for task in done:
+                    name = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except LLMError as e:
+                        errors.append(e)
+                        if queue and not pending:
+                            fallback = launch()
+                            metrics.inc(FALLBACKS, provider=fallback)
+                        continue
+                    return name, result
+            raise errors[0]
+        finally:
+            for task in pending:
+                task.cancel()
+            # Let the losers unwind (closing their connections) before returning
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def agenerate(self, preferred, messages: List[dict], tools: Optional[list] = None) -> str:
+        order = self._order(preferred)
+        _, reply = await self._arace(order, lambda name: self.routes[name].agenerate(messages, tools), "generate")
+        return reply
+
+    async def astream(self, preferred, messages: List[dict], tools: Optional[list] = None) -> AsyncIterator[str]:
+        order = self._order(preferred)
+        streams = {}
+
+        async def first_delta(name):
+            stream = streams[name] = self.routes[name].astream(messages, tools)
+            try:
+                return await stream.__anext__()
+            except StopAsyncIteration:
+                return ""
+
+        try:
+            name, delta = await self._arace(order, first_delta, "stream")
+        except BaseException:
+            for stream in streams.values():
+                await stream.aclose()
+            raise
+        for other, stream in streams.items():
+            if other != name:
+                await stream.aclose()
+        if delta:
+            yield delta
+        async for delta in streams[name]:
+            yield delta
+
+
+router = LLMRouter([
+    Route("chatgpt", generate_chatgpt_reply, stream_chatgpt_reply, agenerate_chatgpt_reply, astream_chatgpt_reply),
+    Route("deepseek", generate_deepseek_reply, stream_deepseek_reply, agenerate_deepseek_reply, astream_deepseek_reply),
+])
+
+metrics.gauge("llm_circuit_open", "1 while a provider's circuit is open or probing.", ["provider"],
+              lambda: [((name,), int(h.state != "closed")) for name, h in router.health.items()])
@@ -0,0 +1,210 @@
+import contextvars
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Callable, Iterable, Optional, Tuple
+
+# In-process counters and histograms, served in the Prometheus text format
+# on /metrics. Each worker process keeps its own; scrape every worker.
+ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+# Add a Server-Timing header with the stage timings of each request
+SERVER_TIMING = ENABLED and os.environ.get("SERVER_TIMING", "0") == "1"
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, values, extra="") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(tuple(labels[n] for n in self.labelnames), 0)
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_label_text(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[n] for n in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_label_text(self.labelnames, key, le)} {cumulative}"
+            labels = _label_text(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {total}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge:
+    """A value read at scrape time: `collect()` yields (label values, value)."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels, collect: Callable[[], Iterable[Tuple[tuple, float]]]):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labels)
+        self.collect = collect
+
+    def samples(self) -> Iterable[str]:
+        for key, value in self.collect():
+            yield f"{self.name}{_label_text(self.labelnames, key)} {value}"
+
+
+_registry = []
+
+
+def _register(metric):
+    _registry.append(metric)
+    return metric
+
+
+def counter(name, help_text, labels=()) -> Counter:
+    return _register(Counter(name, help_text, labels))
+
+
+def histogram(name, help_text, labels=(), buckets=LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help_text, labels, buckets))
+
+
+def gauge(name, help_text, labels, collect) -> Gauge:
+    return _register(Gauge(name, help_text, labels, collect))
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+# --- Hot-path metrics ---
+STAGE_SECONDS = histogram("chat_stage_seconds", "Time spent in each stage of a chat turn.", ["stage"])
+REQUEST_SECONDS = histogram("http_request_seconds", "Time to the response headers, per endpoint.",
+                            ["endpoint", "status"])
+LLM_TOKENS = counter("llm_tokens_total", "Tokens reported in provider usage fields.", ["provider", "kind"])
+PROMPT_TOKENS = counter("prompt_tokens_total",
+                        "Estimated prompt tokens: the full history vs the trimmed prompt sent.", ["kind"])
+BYTES_WRITTEN = counter("storage_bytes_written_total",
+                        "Bytes written by the persistence layer, per file or SQLite table.", ["store"])
+LEAD_PARSE = counter("lead_parse_total", "Replies by lead block parse result: ok, repaired, failed or missing.",
+                     ["result"])
+
+
+# --- Stage timing ---
+class _RequestTimings:
+    __slots__ = ("start", "stages")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+
+
+_request = contextvars.ContextVar("metrics_request", default=None)
+
+
+class _Span:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(elapsed, stage=self.stage)
+        timings = _request.get()
+        if timings is not None:
+            timings.stages[self.stage] = timings.stages.get(self.stage, 0.0) + elapsed
+        return False
+
+
+_NULL_SPAN = nullcontext()
+
+
+def span(stage):
+    """Time a block as `stage` of the current request; a shared no-op when metrics are off."""
+    if not ENABLED:
+        return _NULL_SPAN
+    return _Span(stage)
+
+
+def inc(metric: Counter, amount=1, **labels):
+    if ENABLED:
+        metric.inc(amount, **labels)
+
+
+def start_request():
+    if ENABLED:
+        _request.set(_RequestTimings())
+
+
+def finish_request(response, endpoint: Optional[str]):
+    """Record the request duration and add Server-Timing; works for Flask and Quart responses."""
+    timings = _request.get() if ENABLED else None
+    if timings is None:
+        return response
+    _request.set(None)
+    elapsed = time.perf_counter() - timings.start
+    REQUEST_SECONDS.observe(elapsed, endpoint=endpoint or "unknown", status=str(response.status_code))
+    if SERVER_TIMING:
+        entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.stages.items()]
+        entries.append(f"total;dur={elapsed * 1000:.1f}")
+        response.headers["Server-Timing"] = ", ".join(entries)
+    return response
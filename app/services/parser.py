@@ -1,48 +1,220 @@
 
-import re
 import json
-import os
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+JSON_START = "<<JSON>>"
+JSON_END = "<<ENDJSON>>"
+
+_decoder = json.JSONDecoder()
+_SKIP = " \t\r\n,{}[]"
+
+
+@dataclass
+class ParsedReply:
+    """
+    A bot reply split into what the user sees and the lead fields its
+    <<JSON>> blocks carried. `status` is "ok" (strict JSON), "repaired"
+    (recovered by the tolerant scan), "failed" (a block with nothing
+    readable in it) or "missing" (no block).
+    """
+    visible: str
+    fields: Optional[dict]
+    status: str
+
+
+def parse_reply(text: str) -> ParsedReply:
+    """
+    Strip every <<JSON>> block from `text` and parse the fields they hold,
+    in one pass. A block without <<ENDJSON>> runs to the end of the text,
+    as in JsonBlockFilter; later blocks win over earlier ones.
+    """
+    if JSON_START not in text:
+        return ParsedReply(text.strip(), None, "missing")
+    visible = []
+    fields = None
+    status = "failed"
+    position = 0
+    while True:
+        start = text.find(JSON_START, position)
+        if start == -1:
+            visible.append(text[position:])
+            break
+        visible.append(text[position:start])
+        end = text.find(JSON_END, start)
+        content = text[start + len(JSON_START):end if end != -1 else len(text)]
+        block, block_status = parse_block(content)
+        if block is not None:
+            fields = {**(fields or {}), **block}
+            status = "repaired" if "repaired" in (status, block_status) else "ok"
+        if end == -1:
+            break
+        position = end + len(JSON_END)
+    if fields is None:
+        logger.warning("lead JSON block could not be read: %r", text[text.find(JSON_START):][:500])
+    return ParsedReply("".join(visible).strip(), fields, status)
+
 
 def parse_booking_confirmation(text: str):
+    """Lead fields from a bot reply's <<JSON>> block(s), or None."""
+    return parse_reply(text).fields
+
+
+def parse_block(content: str):
     """
-    Extract lead info from bot reply JSON block.
-    Handles:
-    - leading/trailing commas
-    - missing braces
-    - extra braces
-    Returns a dictionary if parsing succeeds, else None.
-    """
-    # Extract <<JSON>> block
-    pattern = re.compile(r"<<JSON>>(.*?)<<ENDJSON>>", re.DOTALL)
-    match = pattern.search(text)
-    if not match:
-        return None
-
-    content = match.group(1).strip()
-
-    # Remove any leading commas
-    content = re.sub(r'^\s*,+', '', content)
-    # Remove any trailing commas
-    content = re.sub(r',+\s*$', '', content)
-    # Ensure wrapped in braces
-    if not content.startswith("{"):
-        content = "{\n" + content + "\n}"
-    if not content.endswith("}"):
-        content = content + "\n}"
-
-    # Remove trailing commas before closing brace
-    content = re.sub(r',(\s*})', r'\1', content)
-
-    # Remove any repeated opening braces
-    content = re.sub(r'^\{+', '{', content)
-    # Remove any repeated closing braces
-    content = re.sub(r'\}+$', '}', content)
+    (fields, "ok" | "repaired") for the inside of one block, or (None, None).
+
+    Strict JSON is tried first. Anything else goes through a tolerant scan
+    that reads `key: value` pairs and ignores missing, extra or unbalanced
+    braces, stray or trailing commas, bare or single-quoted keys and values,
+    and an unterminated last string.
+    """
+    content = content.strip()
+    if content.startswith("{") and content.endswith("}"):
+        try:
+            data = json.loads(content)
+        except json.JSONDecodeError:
+            pass
+        else:
+            if isinstance(data, dict):
+                return data, "ok"
+    data = _scan_pairs(content)
+    return (data, "repaired") if data else (None, None)
+
+
+def _scan_pairs(content: str) -> dict:
+    fields = {}
+    i, n = 0, len(content)
+    while i < n:
+        if content[i] in _SKIP:
+            i += 1
+            continue
+        key, i = _scan_scalar(content, i, ":,}\n")
+        while i < n and content[i] in " \t":
+            i += 1
+        if i >= n or content[i] != ":" or not isinstance(key, str) or not key:
+            # Not a pair: skip to the next separator
+            while i < n and content[i] not in ",\n":
+                i += 1
+            continue
+        i += 1
+        while i < n and content[i] in " \t\r\n":
+            i += 1
+        value, i = _scan_value(content, i)
+        fields[key] = value
+    return fields
 
+
+def _scan_value(content, i):
+    if i >= len(content):
+        return "", i
+    if content[i] in "[{":
+        try:
+            return _decoder.raw_decode(content, i)
+        except json.JSONDecodeError:
+            pass
+    return _scan_scalar(content, i, ",}\n")
+
+
+def _scan_scalar(content, i, stops):
+    """A quoted string, or a bare word up to one of `stops` (numbers and literals decoded)."""
+    quote = content[i]
+    if quote == '"':
+        try:
+            return _decoder.raw_decode(content, i)
+        except json.JSONDecodeError:
+            pass
+    if quote in "\"'":
+        end = content.find(quote, i + 1)
+        line_end = content.find("\n", i + 1)
+        if end == -1 or (line_end != -1 and line_end < end):
+            # Unterminated: take the rest of the line, minus a trailing comma
+            end = line_end if line_end != -1 else len(content)
+            return content[i + 1:end].rstrip().rstrip(",").rstrip(), end
+        return content[i + 1:end], end + 1
+    end = i
+    while end < len(content) and content[end] not in stops:
+        end += 1
+    word = content[i:end].strip()
     try:
-        data = json.loads(content)
-        return data
-    except json.JSONDecodeError as e:
-        print("JSON decode error:", e)
-        print("Problematic JSON string:\n", content)
-        return None
+        value = json.loads(word)
+    except json.JSONDecodeError:
+        value = word
+    return value, end
+
+
+def lead_updates(fields: Optional[dict], current: Optional[dict]) -> dict:
+    """
+    The part of `fields` that changes the stored lead: blank values never
+    erase an earlier answer, and unchanged values are not written again.
+    """
+    if not fields:
+        return {}
+    current = current or {}
+    return {k: v for k, v in fields.items()
+            if v not in ("", None) and k not in ("page_id", "user_id", "updated_at") and current.get(k) != v}
+
+
+def lead_block(fields: dict) -> str:
+    """`fields` in the reply's <<JSON>> block format."""
+    return f"{JSON_START}\n{json.dumps(fields, ensure_ascii=False)}\n{JSON_END}"
+
+
+def _partial_marker_len(text: str, marker: str) -> int:
+    """Length of the longest suffix of `text` that is a proper prefix of `marker`."""
+    for n in range(min(len(text), len(marker) - 1), 0, -1):
+        if marker.startswith(text[-n:]):
+            return n
+    return 0
+
+
+class JsonBlockFilter:
+    """
+    Incrementally removes <<JSON>>...<<ENDJSON>> blocks from streamed text.
+    Text that could be the start of a marker split across chunks is held
+    back until the next chunk decides it. An unterminated block is dropped.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.in_block = False
+        self.started = False
+
+    def feed(self, chunk: str) -> str:
+        self.buffer += chunk
+        out = []
+        while self.buffer:
+            if self.in_block:
+                end = self.buffer.find(JSON_END)
+                if end == -1:
+                    # Only the tail can still be part of the end marker
+                    self.buffer = self.buffer[-(len(JSON_END) - 1):]
+                    break
+                self.buffer = self.buffer[end + len(JSON_END):]
+                self.in_block = False
+            else:
+                start = self.buffer.find(JSON_START)
+                if start == -1:
+                    keep = _partial_marker_len(self.buffer, JSON_START)
+                    out.append(self.buffer[:len(self.buffer) - keep])
+                    self.buffer = self.buffer[len(self.buffer) - keep:]
+                    break
+                out.append(self.buffer[:start])
+                self.buffer = self.buffer[start + len(JSON_START):]
+                self.in_block = True
+        return self._visible("".join(out))
+
+    def finish(self) -> str:
+        rest = "" if self.in_block else self.buffer
+        self.buffer = ""
+        return self._visible(rest)
 
+    def _visible(self, text: str) -> str:
+        # Match the non-streaming reply, which is .strip()ped: drop leading whitespace
+        if not self.started:
+            text = text.lstrip()
+            self.started = bool(text)
+        return text
@@ -0,0 +1,376 @@
+"""
+Offline batch replay of chat sessions through the reply pipeline:
+
+    python -m app.services.replay sessions.jsonl --out results.jsonl
+    python -m app.services.replay conversations.json --workers 8 --concurrency 32 --rate 20
+    python -m app.services.replay data/conversations --fields name,email,phone --summary report.json
+
+Each session's user turns are sent in order the way /clinicchat sends them:
+reply_messages() builds the prompt from the setup and the history window,
+the router calls the provider (with the record_lead tool), and parse_reply
+and lead_updates merge the lead. Nothing is written to the stores; the
+history and the lead live only as long as the session.
+
+Input is either a .jsonl file of scripted sessions, one per line:
+
+    {"id": "s1", "page_id": "612142091972168", "turns": ["Hi, I'm Sam", "sam@example.com"]}
+
+with an optional inline "setup" (otherwise the page's setup is read from
+--setups), or recorded conversations (a conversations directory or a legacy
+conversations.json, read without opening anything for writing), whose user
+messages are replayed against the page's current setup. `--fields` and `--template` override the field list and the
+prompt template, to compare variants on the same sessions.
+
+Sessions are dealt out in chunks to `--workers` processes; each one runs up
+to `--concurrency` sessions at a time on its own event loop and gets an
+equal share of `--rate` provider requests per second. A result line per
+session is appended to `--out` as each chunk finishes, and the report gives,
+per setup, the share of sessions that filled every field, the turns that
+took, and the tokens spent.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from app.services import context_builder
+from app.services.context_builder import lead_tools, setup_hash
+from app.services.context_window import forget, greeting_messages, reply_messages
+from app.services.parser import lead_updates, parse_reply
+from app.services.storage import SETUPS_FILE
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_CONCURRENCY = 32
+# Chunks per worker: enough to keep every worker busy until the end of the run
+CHUNKS_PER_WORKER = 4
+
+
+class RateLimiter:
+    """Token bucket for an event loop: `rate` acquisitions per second, bursts of up to `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        # Waiters queue on the lock, so they are served in arrival order
+        async with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._updated = time.monotonic()
+                self._tokens = 1
+            self._tokens -= 1
+
+
+# --- Inputs ---
+def scripted_sessions(path):
+    """Sessions from a JSONL file of {"id", "page_id", "turns", "setup"?} lines."""
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f):
+            if line.strip():
+                session = json.loads(line)
+                session.setdefault("id", str(session.get("user_id", n)))
+                yield session
+
+
+def recorded_sessions(path):
+    """Sessions from a conversations directory or a legacy conversations.json: the user turns of each."""
+    from app.services.storage.sqlite_backend import split_conv_key
+
+    path = Path(path)
+    if path.is_dir():
+        from app.services.conversation_files import ConversationFileStore
+        store = ConversationFileStore(path, write_behind=False)
+        conversations = store.iter_all()
+    else:
+        from app.services.conversation_store import ConversationStore
+        store = ConversationStore(path, read_only=True)
+        conversations = ((k, store.get(k)) for k in store.keys())
+    try:
+        for conv_key, messages in conversations:
+            turns = [m["message"] for m in messages if m.get("role") == "user" and m.get("message")]
+            if turns:
+                yield {"id": conv_key, "page_id": split_conv_key(conv_key)[0], "turns": turns}
+    finally:
+        store.close()
+
+
+def load_sessions(source, setups_file, fields=None, limit=None):
+    """
+    (sessions, setups by label, skipped): each session names its setup by a
+    "page_id@hash" label, so a worker receives every setup once.
+    """
+    from app.services.file_store import JsonSetupStore
+
+    store = JsonSetupStore(setups_file)
+    sessions = scripted_sessions(source) if str(source).endswith(".jsonl") else recorded_sessions(source)
+    chosen, setups, skipped = [], {}, 0
+    for session in sessions:
+        if limit is not None and len(chosen) >= limit:
+            break
+        setup = session.pop("setup", None) or store.get_for_page(session.get("page_id"))
+        if not setup or not session.get("turns"):
+            skipped += 1
+            continue
+        if fields is not None:
+            setup = {**setup, "field": fields}
+        label = f"{setup.get('page_id')}@{setup_hash(setup)[:8]}"
+        setups.setdefault(label, setup)
+        session["setup"] = label
+        chosen.append(session)
+    return chosen, setups, skipped
+
+
+# --- Worker side: one event loop per process, reused for every chunk ---
+_worker = {}
+
+
+def _init_worker(setups, options):
+    # Room for every session in flight plus hedges, unless configured; the
+    # provider clients read these (and their keys and URLs) when first imported
+    os.environ.setdefault("LLM_MAX_CONNECTIONS", str(max(options["concurrency"] * 2, 20)))
+    os.environ.setdefault("LLM_MAX_KEEPALIVE", str(max(options["concurrency"] * 2, 10)))
+    # Smaller pools than the app's: httpx scans a pool's connections on every request
+    os.environ.setdefault("LLM_POOL_SHARD_SIZE", "8")
+    from app.services.llm_router import router
+
+    if options.get("template"):
+        context_builder.BASE_TEMPLATE = options["template"]
+        context_builder._system_prompts.clear()
+    # Parse outcomes are counted in each result; the per-reply warnings would drown the output
+    logging.getLogger("app.services.parser").setLevel(logging.ERROR)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    _worker.update(setups=setups, options=options, router=router, loop=loop,
+                   limiter=RateLimiter(options["rate"]), semaphore=asyncio.Semaphore(options["concurrency"]))
+
+
+def _run_chunk(chunk):
+    return _worker["loop"].run_until_complete(
+        asyncio.gather(*(_bounded_session(index, session) for index, session in chunk)))
+
+
+async def _bounded_session(index, session):
+    async with _worker["semaphore"]:
+        return await replay_session(index, session)
+
+
+async def _call(messages, tools=None):
+    await _worker["limiter"].acquire()
+    return await _worker["router"].agenerate(_worker["options"]["model"], messages, tools)
+
+
+async def replay_session(index, session):
+    """Replay one session's turns and return its result record."""
+    from app.services.ai_client import usage_sink
+
+    setup = _worker["setups"][session["setup"]]
+    options = _worker["options"]
+    fields = list(setup.get("field") or ())
+    conv_key = f"{setup.get('page_id')}_replay{index}"
+    usage = {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+    usage_sink.set(usage)  # gather() runs each session in its own task, so this is per session
+    result = {"id": session["id"], "page_id": setup.get("page_id"), "setup": session["setup"], "turns": 0,
+              "completed": False, "turns_to_completion": None, "expected": len(fields), "filled": 0,
+              "lead": {}, "parse": {}, "usage": usage, "error": None}
+    replies = []
+    history = []
+    lead = {}
+    start = time.perf_counter()
+    try:
+        if options["greeting"]:
+            greeting = await _call(greeting_messages(setup))
+            history.append({"role": "bot", "message": greeting})
+            replies.append(parse_reply(greeting).visible)
+        for user_message in session["turns"]:
+            history.append({"role": "user", "message": user_message})
+            bot_reply = await _call(reply_messages(setup, conv_key, history), lead_tools(setup))
+            history.append({"role": "bot", "message": bot_reply})
+            result["turns"] += 1
+
+            parsed = parse_reply(bot_reply)
+            result["parse"][parsed.status] = result["parse"].get(parsed.status, 0) + 1
+            replies.append(parsed.visible)
+            lead.update(lead_updates(parsed.fields, lead))
+            if fields and result["turns_to_completion"] is None and all(lead.get(f) not in ("", None) for f in fields):
+                result["turns_to_completion"] = result["turns"]
+    except Exception as e:  # one failed session is a result, not the end of the run
+        result["error"] = str(e) or type(e).__name__
+    finally:
+        forget(conv_key)
+    result["completed"] = result["turns_to_completion"] is not None
+    result["filled"] = sum(lead.get(f) not in ("", None) for f in fields)
+    result["lead"] = lead
+    result["latency_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    if options["transcripts"]:
+        result["replies"] = replies
+    return result
+
+
+# --- Report ---
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class Report:
+    """Per-setup aggregates of session results."""
+
+    def __init__(self, setups):
+        self.setups = setups
+        self._groups = {}
+
+    def add(self, result):
+        group = self._groups.setdefault(result["setup"], {
+            "sessions": 0, "errors": 0, "completed": 0, "filled": 0, "expected": 0, "turns_to_completion": [],
+            "field_counts": dict.fromkeys(self.setups[result["setup"]].get("field") or (), 0),
+            "usage": {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0},
+        })
+        group["sessions"] += 1
+        group["errors"] += result["error"] is not None
+        group["completed"] += result["completed"]
+        group["filled"] += result["filled"]
+        group["expected"] += result["expected"]
+        if result["completed"]:
+            group["turns_to_completion"].append(result["turns_to_completion"])
+        for f in group["field_counts"]:
+            group["field_counts"][f] += result["lead"].get(f) not in ("", None)
+        for k, v in result["usage"].items():
+            group["usage"][k] += v
+
+    def summary(self) -> dict:
+        out = {}
+        for label, g in sorted(self._groups.items()):
+            n = g["sessions"]
+            turns = g["turns_to_completion"]
+            out[label] = {
+                "business_name": self.setups[label].get("business_name"),
+                "sessions": n,
+                "errors": g["errors"],
+                "completion_rate": round(g["completed"] / n, 4),
+                "field_fill": round(g["filled"] / g["expected"], 4) if g["expected"] else None,
+                "turns_to_completion_p50": _percentile(turns, 50),
+                "turns_to_completion_mean": round(sum(turns) / len(turns), 2) if turns else None,
+                "tokens_per_session": {k.replace("_tokens", ""): round(v / n, 1) for k, v in g["usage"].items()},
+                "tokens": g["usage"],
+                "fields": {f: round(c / n, 4) for f, c in g["field_counts"].items()},
+            }
+        return out
+
+
+def print_summary(summary):
+    # Token columns are per session
+    header = f"{'setup':<34} {'sessions':>8} {'errors':>6} {'complete':>8} {'fill':>6} " \
+             f"{'turns p50':>9} {'mean':>5} {'prompt':>9} {'cached':>9} {'output':>8}"
+    print(header)
+    print("-" * len(header))
+    for label, s in summary.items():
+        t = s["tokens_per_session"]
+        fill = f"{s['field_fill']:.0%}" if s["field_fill"] is not None else "-"
+        p50 = s["turns_to_completion_p50"] if s["turns_to_completion_p50"] is not None else "-"
+        mean = s["turns_to_completion_mean"] if s["turns_to_completion_mean"] is not None else "-"
+        print(f"{label[:34]:<34} {s['sessions']:>8} {s['errors']:>6} {s['completion_rate']:>8.0%} {fill:>6} "
+              f"{p50:>9} {mean:>5} {t['prompt']:>9} {t['cached']:>9} {t['completion']:>8}")
+
+
+# --- Driver ---
+def _chunks(sessions, size):
+    for i in range(0, len(sessions), size):
+        yield list(enumerate(sessions[i:i + size], start=i))
+
+
+def replay(sessions, setups, out=None, model="chatgpt", workers=DEFAULT_WORKERS, concurrency=DEFAULT_CONCURRENCY,
+           rate=0.0, greeting=True, transcripts=False, template=None):
+    """Replay `sessions`, append a result line per session to `out`, and return the Report."""
+    report = Report(setups)
+    options = {"model": model, "concurrency": concurrency, "rate": rate / max(workers, 1), "greeting": greeting,
+               "transcripts": transcripts, "template": template}
+    size = max(1, min(concurrency * CHUNKS_PER_WORKER, math.ceil(len(sessions) / (max(workers, 1) * CHUNKS_PER_WORKER))))
+    sink = open(out, "w", encoding="utf-8") if out else None
+
+    def collect(results):
+        for result in results:
+            report.add(result)
+            if sink:
+                sink.write(json.dumps(result, ensure_ascii=False) + "\n")
+        if sink:
+            sink.flush()
+
+    try:
+        if workers <= 0:
+            _init_worker(setups, {**options, "rate": rate})
+            try:
+                for chunk in _chunks(sessions, size):
+                    collect(_run_chunk(chunk))
+            finally:
+                _worker.pop("loop").close()
+        else:
+            with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(setups, options)) as pool:
+                futures = [pool.submit(_run_chunk, chunk) for chunk in _chunks(sessions, size)]
+                for future in as_completed(futures):
+                    collect(future.result())
+    finally:
+        if sink:
+            sink.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded or scripted chat sessions through the reply pipeline")
+    parser.add_argument("source", help="sessions .jsonl, a conversations directory, or a legacy conversations.json")
+    parser.add_argument("--setups", default=str(SETUPS_FILE))
+    parser.add_argument("--out", default="replay_results.jsonl", help="result line per session ('' to skip)")
+    parser.add_argument("--summary", help="also write the per-setup report to this JSON file")
+    parser.add_argument("--model", default="chatgpt", choices=["chatgpt", "deepseek"], help="preferred provider")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="processes; 0 runs in this one")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="sessions in flight per worker")
+    parser.add_argument("--rate", type=float, default=0.0, help="provider requests per second overall; 0 for no limit")
+    parser.add_argument("--limit", type=int)
+    parser.add_argument("--fields", help="comma-separated field list to use for every setup")
+    parser.add_argument("--template", help="file replacing the system prompt template ({fields_json}, {steps})")
+    parser.add_argument("--no-greeting", action="store_true", help="start each session at its first user turn")
+    parser.add_argument("--transcripts", action="store_true", help="include the visible replies in each result")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.WARNING)
+
+    fields = [f.strip() for f in args.fields.split(",") if f.strip()] if args.fields else None
+    template = Path(args.template).read_text(encoding="utf-8") if args.template else None
+    sessions, setups, skipped = load_sessions(args.source, args.setups, fields, args.limit)
+    if skipped:
+        print(f"{skipped} sessions skipped (no setup for the page, or no user turns)")
+
+    started = time.perf_counter()
+    report = replay(sessions, setups, args.out, args.model, args.workers, args.concurrency, args.rate,
+                    greeting=not args.no_greeting, transcripts=args.transcripts, template=template)
+    elapsed = time.perf_counter() - started
+    summary = report.summary()
+    print_summary(summary)
+    turns = sum(len(s["turns"]) for s in sessions)
+    print(f"{len(sessions)} sessions ({turns} turns) replayed in {elapsed:.2f}s "
+          f"({len(sessions) / elapsed if elapsed else 0:.0f} sessions/s)" + (f", results in {args.out}" if args.out else ""))
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump({"sessions": len(sessions), "skipped": skipped, "elapsed_s": round(elapsed, 3),
+                       "setups": summary}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
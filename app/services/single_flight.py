@@ -0,0 +1,96 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Coalesces identical calls. The first caller for a key runs the work;
+    callers arriving while it runs wait for its result instead of repeating
+    it, and for `ttl` seconds afterwards the result is replayed to retries
+    (unless completed with `replay=False`). Failures are shared with the
+    callers already waiting but never kept.
+
+    Results travel in a concurrent.futures.Future, so threads wait with
+    `.result()` and coroutines with `asyncio.wrap_future()`.
+    """
+
+    def __init__(self, ttl=10.0, max_entries=10_000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._recent = OrderedDict()  # key -> (expires_at, result)
+
+    def join(self, key):
+        """
+        (future, leader). The leader must run the work and call complete();
+        everyone else waits on the future, which is already resolved when a
+        recent result is replayed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            hit = self._recent.get(key)
+            if hit is not None:
+                if hit[0] > now:
+                    future = Future()
+                    future.set_result(hit[1])
+                    return future, False
+                del self._recent[key]
+            future = self._inflight.get(key)
+            if future is not None:
+                return future, False
+            future = self._inflight[key] = Future()
+            return future, True
+
+    def complete(self, key, future, result=None, error=None, replay=True):
+        with self._lock:
+            self._inflight.pop(key, None)
+            if error is None and replay and self.ttl > 0:
+                self._recent[key] = (time.monotonic() + self.ttl, result)
+                self._recent.move_to_end(key)
+                self._evict()
+        if error is None:
+            future.set_result(result)
+        else:
+            future.set_exception(error)
+
+    def discard(self, key):
+        """Stop replaying `key`, e.g. once a newer turn made its result stale."""
+        with self._lock:
+            self._recent.pop(key, None)
+
+    def _evict(self):
+        now = time.monotonic()
+        while self._recent:
+            key, (expires_at, _) = next(iter(self._recent.items()))
+            if expires_at > now and len(self._recent) <= self.max_entries:
+                break
+            del self._recent[key]
+
+    def do(self, key, fn, replay=True):
+        future, leader = self.join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.complete(key, future, error=e)
+            raise
+        self.complete(key, future, result, replay=replay)
+        return result
+
+    async def ado(self, key, fn, replay=True):
+        """do() for a coroutine function; waiting never blocks the event loop."""
+        future, leader = self.join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.complete(key, future, error=e)
+            raise
+        self.complete(key, future, result, replay=replay)
+        return result
@@ -0,0 +1,55 @@
+import os
+import threading
+from pathlib import Path
+
+from app.services.storage.base import (
+    SetupBackend, ConversationBackend, LeadBackend, Storage, encode_cursor, decode_cursor
+)
+
+# "json" (files under data/, the default) or "sqlite". The JSON stores keep
+# their state in process memory, so deployments with several worker processes
+# need "sqlite": its stores re-read what other workers changed, see sqlite_backend.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json").lower()
+SQLITE_PATH = os.getenv("SQLITE_PATH", "data/app.db")
+
+# One file per conversation; CONVERSATIONS_FILE is the older single-file
+# store, imported into CONVERSATIONS_DIR the first time the app starts
+CONVERSATIONS_DIR = Path("data/conversations")
+CONVERSATIONS_FILE = "conversations.json"
+SETUPS_FILE = Path("data/setups.json")
+LEADS_FILE = Path("data/leads.json")
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def create_storage(backend=None) -> Storage:
+    """Build the stores for `backend`. Backends are imported lazily so neither pulls in the other."""
+    backend = (backend or STORAGE_BACKEND).lower()
+    if backend == "json":
+        from app.services.conversation_files import ConversationFileStore
+        from app.services.file_store import JsonSetupStore
+        from app.services.lead_store import LeadStore
+        conversations = ConversationFileStore(CONVERSATIONS_DIR, legacy_path=CONVERSATIONS_FILE)
+        return Storage(JsonSetupStore(SETUPS_FILE), conversations, LeadStore(LEADS_FILE))
+    if backend == "sqlite":
+        from app.services.storage.sqlite_backend import create_sqlite_storage
+        Path(SQLITE_PATH).parent.mkdir(parents=True, exist_ok=True)
+        return create_sqlite_storage(SQLITE_PATH)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {backend!r}")
+
+
+def get_storage() -> Storage:
+    """The process-wide storage, created on first use."""
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage()
+    return _storage
+
+
+__all__ = [
+    "SetupBackend", "ConversationBackend", "LeadBackend", "Storage",
+    "encode_cursor", "decode_cursor", "create_storage", "get_storage",
+]
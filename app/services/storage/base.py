@@ -0,0 +1,138 @@
+import base64
+from abc import ABC, abstractmethod
+
+from app.services.storage.locks import KeyedLock
+
+# Default conversation locks: enough for backends that live in one process
+_local_locks = KeyedLock()
+
+
+def encode_cursor(position: int) -> str:
+    return base64.urlsafe_b64encode(str(position).encode("ascii")).decode("ascii")
+
+
+def decode_cursor(cursor) -> int:
+    if not cursor:
+        return 0
+    try:
+        return max(0, int(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii")))
+    except (ValueError, UnicodeError):
+        raise ValueError("invalid cursor")
+
+
+class SetupBackend(ABC):
+    """Business setups, keyed by owner user_id and looked up by page_id."""
+
+    @abstractmethod
+    def get(self, user_id):
+        ...
+
+    @abstractmethod
+    def get_for_page(self, page_id):
+        ...
+
+    @abstractmethod
+    def all(self):
+        """{user_id: setup} for every stored setup."""
+
+    @abstractmethod
+    def save(self, setup: dict):
+        ...
+
+    def close(self):
+        pass
+
+
+class ConversationBackend(ABC):
+    """Per-conversation message lists, keyed by conv_key ("<page_id>_<user_id>")."""
+
+    @abstractmethod
+    def __contains__(self, conv_key):
+        ...
+
+    @abstractmethod
+    def get(self, conv_key, default=None):
+        ...
+
+    def __getitem__(self, conv_key):
+        messages = self.get(conv_key)
+        if messages is None:
+            raise KeyError(conv_key)
+        return messages
+
+    @abstractmethod
+    def append(self, conv_key, message):
+        ...
+
+    def extend(self, conv_key, messages):
+        for message in messages:
+            self.append(conv_key, message)
+
+    @abstractmethod
+    def delete_prefix(self, prefix):
+        ...
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+    def lock(self, conv_key):
+        """
+        Lock serializing turns of one conversation: use as a context manager,
+        or acquire()/release() when the holder moves between threads.
+        """
+        return _local_locks(conv_key)
+
+    def close(self):
+        pass
+
+
+class LeadBackend(ABC):
+    """Leads keyed by (page_id, user_id); fields are merged on every upsert."""
+
+    @abstractmethod
+    def get(self, page_id, user_id):
+        ...
+
+    @abstractmethod
+    def upsert(self, page_id, user_id, fields):
+        ...
+
+    @abstractmethod
+    def clear(self):
+        ...
+
+    @abstractmethod
+    def iter_leads(self, page_id=None, updated_since=None, start=0):
+        """
+        Yield (position, lead) in a stable order. `position` is an opaque
+        resume point: iter_leads(start=position) continues after that lead.
+        """
+
+    def page(self, cursor=None, limit=100, page_id=None, updated_since=None):
+        """One page of leads and the cursor for the next one (None at the end)."""
+        items = []
+        last = None
+        for position, lead in self.iter_leads(page_id, updated_since, decode_cursor(cursor)):
+            if len(items) == limit:
+                return items, encode_cursor(last)
+            items.append(dict(lead))
+            last = position
+        return items, None
+
+    def close(self):
+        pass
+
+
+class Storage:
+    """The three stores the app persists, from one backend."""
+
+    def __init__(self, setups: SetupBackend, conversations: ConversationBackend, leads: LeadBackend):
+        self.setups = setups
+        self.conversations = conversations
+        self.leads = leads
+
+    def close(self):
+        self.conversations.close()
+        self.leads.close()
+        self.setups.close()
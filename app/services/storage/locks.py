@@ -0,0 +1,127 @@
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to process-local locking
+    fcntl = None
+
+# Lock files keys hash onto for cross-process locks; keys sharing one only
+# queue behind each other now and then
+LOCK_BUCKETS = int(os.environ.get("CONVERSATION_LOCK_BUCKETS", "4096"))
+
+
+def _bucket(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big") % LOCK_BUCKETS
+
+
+class KeyLock:
+    """The lock for one key; a context manager, or acquire()/release() across threads."""
+
+    __slots__ = ("owner", "key")
+
+    def __init__(self, owner, key):
+        self.owner = owner
+        self.key = key
+
+    def acquire(self, blocking=True) -> bool:
+        return self.owner.acquire(self.key, blocking)
+
+    def release(self):
+        self.owner.release(self.key)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class KeyedLock:
+    """
+    One non-reentrant lock per key inside this process. Locks are created on
+    first use and dropped once nobody holds or waits for them, so holding one
+    for a whole turn only ever blocks requests for the same key.
+    """
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        self._locks = {}  # key -> [lock, holders and waiters]
+
+    def __call__(self, key) -> KeyLock:
+        return KeyLock(self, key)
+
+    def acquire(self, key, blocking=True) -> bool:
+        with self._guard:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [threading.Lock(), 0]
+            entry[1] += 1
+        if entry[0].acquire(blocking):
+            return True
+        self._leave(key)
+        return False
+
+    def release(self, key):
+        with self._guard:
+            self._locks[key][0].release()
+        self._leave(key)
+
+    def _leave(self, key):
+        with self._guard:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def close(self):
+        pass
+
+
+class FileKeyedLock(KeyedLock):
+    """
+    Per-key locks shared by every process that uses the same lock directory.
+    The in-process lock orders this process's threads; an flock() on the
+    key's lock file (picked by hashing the key) orders the processes. Each
+    holder opens the file itself: flock() belongs to that open file, not to
+    the process, so threads of two workers waiting on each other's keys are
+    never mistaken for a deadlock, as POSIX record locks would be.
+    """
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._fds = {}  # key -> descriptor holding its flock(); guarded by the key's thread lock
+
+    def acquire(self, key, blocking=True) -> bool:
+        if not super().acquire(key, blocking):
+            return False
+        if fcntl is None:
+            return True
+        try:
+            fd = os.open(self.directory / f"{_bucket(key)}.lock", os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BaseException:
+                os.close(fd)
+                raise
+        except BlockingIOError:
+            super().release(key)
+            return False
+        except BaseException:
+            super().release(key)
+            raise
+        self._fds[key] = fd
+        return True
+
+    def release(self, key):
+        fd = self._fds.pop(key, None)
+        if fd is not None:
+            # Closing the descriptor drops its flock()
+            os.close(fd)
+        super().release(key)
@@ -0,0 +1,89 @@
+"""
+One-shot copy of the JSON stores into SQLite:
+
+    python -m app.services.storage.migrate [--sqlite data/app.db]
+
+Conversations are read through the per-conversation file store, which
+first imports a legacy conversations.json if one is left, and leads through
+their journaled store, so records not yet compacted into the snapshot are
+included. Rows are written in batched transactions; the JSON files are left
+untouched (apart from that one-time import) and re-running the migration
+overwrites what it copied before.
+"""
+import argparse
+import time
+
+from app.services.storage import CONVERSATIONS_DIR, CONVERSATIONS_FILE, SETUPS_FILE, LEADS_FILE, SQLITE_PATH
+from app.services.storage.sqlite_backend import create_sqlite_storage
+
+BATCH_SIZE = 1000
+
+
+def _batches(items, size=BATCH_SIZE):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def migrate(sqlite_path=SQLITE_PATH, conversations_dir=CONVERSATIONS_DIR, setups_file=SETUPS_FILE,
+            leads_file=LEADS_FILE, conversations_file=CONVERSATIONS_FILE):
+    from app.services.conversation_files import ConversationFileStore
+    from app.services.file_store import JsonSetupStore
+    from app.services.lead_store import LeadStore
+
+    target = create_sqlite_storage(sqlite_path)
+    counts = {}
+    try:
+        setups = JsonSetupStore(setups_file).all()
+        target.setups.save_many(setups)
+        counts["setups"] = len(setups)
+
+        conversations = ConversationFileStore(conversations_dir, legacy_path=conversations_file, write_behind=False)
+        try:
+            # Messages are appended, so start from empty to keep re-runs idempotent
+            target.conversations.clear()
+            counts["conversations"] = counts["messages"] = 0
+            for batch in _batches(conversations.iter_all()):
+                chunk = dict(batch)
+                target.conversations.extend_many(chunk)
+                counts["conversations"] += len(chunk)
+                counts["messages"] += sum(len(m) for m in chunk.values())
+        finally:
+            conversations.close()
+
+        leads = LeadStore(leads_file, compact_every=float("inf"))
+        try:
+            counts["leads"] = 0
+            for batch in _batches(lead for _, lead in leads.iter_leads()):
+                target.leads.insert_many(batch)
+                counts["leads"] += len(batch)
+        finally:
+            leads.close()
+    finally:
+        target.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy the JSON stores into an SQLite database")
+    parser.add_argument("--sqlite", default=SQLITE_PATH)
+    parser.add_argument("--conversations", default=str(CONVERSATIONS_DIR))
+    parser.add_argument("--legacy-conversations", default=CONVERSATIONS_FILE,
+                        help="single-file store imported into --conversations first, if present")
+    parser.add_argument("--setups", default=str(SETUPS_FILE))
+    parser.add_argument("--leads", default=str(LEADS_FILE))
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    counts = migrate(args.sqlite, args.conversations, args.setups, args.leads, args.legacy_conversations)
+    elapsed = time.perf_counter() - started
+    print(", ".join(f"{n} {name}" for name, n in counts.items()) + f" copied to {args.sqlite} in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
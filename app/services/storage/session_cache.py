@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Hydrated conversations a worker keeps in memory: at most this many...
+CONVERSATION_CACHE_SIZE = int(os.getenv("CONVERSATION_CACHE_SIZE", "10000"))
+# ...holding at most this many MB of message text (an estimate, not a hard limit)...
+CONVERSATION_CACHE_MB = float(os.getenv("CONVERSATION_CACHE_MB", "256"))
+# ...and none left untouched for longer than this many seconds (0 keeps idle ones)
+CONVERSATION_IDLE_SECONDS = float(os.getenv("CONVERSATION_IDLE_SECONDS", "1800"))
+
+# Rough per-message overhead of the dict and strings on top of the text itself
+MESSAGE_OVERHEAD = 200
+
+
+def messages_size(messages) -> int:
+    """Estimated bytes a message list keeps resident."""
+    return sum(len(m.get("message", "")) + MESSAGE_OVERHEAD for m in messages)
+
+
+class SessionCache:
+    """
+    LRU of hydrated conversations, bounded by entry count, estimated bytes
+    and idle time. Every entry has a size; owners report growth with
+    `grow()`. Bounds are enforced on every insert or growth, oldest entry
+    first, and idle entries are also dropped by `expire()`.
+
+    Before an entry leaves the cache for being over a bound,
+    `on_evict(key, value)` is called: that is where dirty sessions are
+    written back. Entries removed with `pop()`, `discard_prefix()` or
+    `clear()` are dropped as they are. `on_evict` runs with the cache lock
+    held, so an owner that also locks in `on_evict` must hold its own lock
+    around every cache call.
+    """
+
+    def __init__(self, max_entries=CONVERSATION_CACHE_SIZE, max_mb=CONVERSATION_CACHE_MB,
+                 idle_seconds=CONVERSATION_IDLE_SECONDS, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 2 ** 20)
+        self.idle_seconds = idle_seconds
+        self.on_evict = on_evict
+        self.bytes = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> [value, size, last access]
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            entry[2] = time.monotonic()
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = [value, size, time.monotonic()]
+            self.bytes += size
+            self._evict(keep=key)
+
+    def grow(self, key, delta):
+        """Account for `delta` more bytes in an entry that was appended to."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            self.bytes += delta
+            entry[1] += delta
+            entry[2] = time.monotonic()
+            self._entries.move_to_end(key)
+            self._evict(keep=key)
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self.bytes -= entry[1]
+            return entry[0]
+
+    def discard_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._entries if k.startswith(prefix)]:
+                self.pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def items(self):
+        with self._lock:
+            return [(key, entry[0]) for key, entry in self._entries.items()]
+
+    def expire(self):
+        """Evict entries idle for longer than `idle_seconds`; owners call this periodically."""
+        with self._lock:
+            self._evict()
+
+    def _evict(self, keep=None):
+        """Oldest first, while over a bound. `keep` (just used) is never evicted."""
+        deadline = time.monotonic() - self.idle_seconds if self.idle_seconds else None
+        while self._entries:
+            key, (value, size, last_access) = next(iter(self._entries.items()))
+            over = len(self._entries) > self.max_entries or self.bytes > self.max_bytes
+            idle = deadline is not None and last_access < deadline
+            if key == keep or not (over or idle):
+                break
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+            self.pop(key)
+            self.evictions += 1
@@ -0,0 +1,407 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+from app.services import metrics
+from app.services.storage.base import SetupBackend, ConversationBackend, LeadBackend, Storage
+from app.services.storage.locks import FileKeyedLock
+from app.services.storage.session_cache import SessionCache, messages_size
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS setups (
+    user_id    TEXT PRIMARY KEY,
+    page_id    TEXT,
+    data       TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_setups_page ON setups(page_id);
+
+CREATE TABLE IF NOT EXISTS conversations (
+    conv_key   TEXT PRIMARY KEY,
+    page_id    TEXT,
+    user_id    TEXT,
+    created_at TEXT NOT NULL,
+    base       INTEGER,
+    version    INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_page_user ON conversations(page_id, user_id);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id       INTEGER PRIMARY KEY AUTOINCREMENT,
+    conv_key TEXT NOT NULL,
+    role     TEXT NOT NULL,
+    message  TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_conv ON messages(conv_key, id);
+
+CREATE TABLE IF NOT EXISTS leads (
+    seq        INTEGER PRIMARY KEY AUTOINCREMENT,
+    page_id    TEXT,
+    user_id    TEXT,
+    data       TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    UNIQUE (page_id, user_id)
+);
+CREATE INDEX IF NOT EXISTS idx_leads_page ON leads(page_id, seq);
+CREATE INDEX IF NOT EXISTS idx_leads_updated ON leads(updated_at);
+
+CREATE TABLE IF NOT EXISTS generations (
+    name  TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Rows fetched per round trip when streaming leads
+ITER_BATCH = 500
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def _count_bytes(table, *values):
+    # Payload bytes handed to SQLite; page and WAL overhead are not included
+    if metrics.ENABLED:
+        metrics.BYTES_WRITTEN.inc(sum(len(v.encode("utf-8")) for v in values), store=f"sqlite:{table}")
+
+
+def split_conv_key(conv_key):
+    # conv_key is f"{page_id}_{user_id}"; page ids never contain "_"
+    page_id, _, user_id = conv_key.partition("_")
+    return page_id, user_id
+
+
+def _prefix_range(prefix):
+    # `key >= prefix AND key < prefix + U+10FFFF` is an index range scan, unlike LIKE
+    return prefix, prefix + "\U0010ffff"
+
+
+class SqliteDatabase:
+    """
+    One SQLite file in WAL mode with a connection per thread. WAL lets
+    readers proceed while a writer commits; statements use bound parameters
+    so sqlite3's statement cache reuses their prepared form.
+    """
+
+    def __init__(self, path, timeout=30.0):
+        self.path = str(path)
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self.conn.executescript(SCHEMA)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                   check_same_thread=False, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def transaction(self):
+        return _Transaction(self.conn)
+
+    def generation(self, name):
+        row = self.conn.execute("SELECT value FROM generations WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    @staticmethod
+    def bump(conn, name):
+        """Advance a generation inside the writer's transaction, telling other workers to reload."""
+        conn.execute(
+            "INSERT INTO generations (name, value) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1", (name,)
+        )
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back on error. Takes the write lock up front."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+class SqliteSetupStore(SetupBackend):
+    """
+    Setups are few and read on every chat request, so each worker keeps them
+    all in memory and reloads only when the shared "setups" generation moves.
+    """
+
+    def __init__(self, db: SqliteDatabase):
+        self.db = db
+        self._lock = threading.Lock()
+        self._generation = None
+        self._by_user = {}
+        self._by_page = {}
+
+    def _fresh(self):
+        generation = self.db.generation("setups")
+        if generation != self._generation:
+            with self._lock:
+                if generation != self._generation:
+                    by_user, by_page = {}, {}
+                    for user_id, page_id, data in self.db.conn.execute(
+                        "SELECT user_id, page_id, data FROM setups ORDER BY updated_at"
+                    ):
+                        setup = by_user[user_id] = json.loads(data)
+                        if page_id:
+                            by_page[page_id] = {**setup, "user_id": user_id}
+                    self._by_user, self._by_page, self._generation = by_user, by_page, generation
+        return self
+
+    def get(self, user_id):
+        return self._fresh()._by_user.get(user_id)
+
+    def get_for_page(self, page_id):
+        return self._fresh()._by_page.get(page_id)
+
+    def all(self):
+        return dict(self._fresh()._by_user)
+
+    def save(self, setup: dict):
+        data = json.dumps(setup, ensure_ascii=False)
+        with self.db.transaction() as conn:
+            conn.execute(
+                "INSERT INTO setups (user_id, page_id, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET page_id = excluded.page_id, data = excluded.data, "
+                "updated_at = excluded.updated_at",
+                (setup["user_id"], setup.get("page_id"), data, _now()),
+            )
+            self.db.bump(conn, "setups")
+        _count_bytes("setups", data)
+
+    def save_many(self, setups):
+        now = _now()
+        with self.db.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO setups (user_id, page_id, data, updated_at) VALUES (?, ?, ?, ?)",
+                [(user_id, s.get("page_id"), json.dumps(s, ensure_ascii=False), now) for user_id, s in setups.items()],
+            )
+            self.db.bump(conn, "setups")
+
+    def close(self):
+        # Storage closes setups last, so the shared connections go with it
+        self.db.close()
+
+
+class SqliteConversationStore(ConversationBackend):
+    """
+    Messages are append-only, so each conversation row carries the id of its
+    first message (`base`) and of its latest one (`version`). A worker's cached
+    copy is checked with one indexed lookup and topped up with only the
+    messages it has not seen; a different base means the conversation was
+    deleted and started again. The cache is bounded like the JSON store's
+    (CONVERSATION_CACHE_*); its entries are never dirty, so eviction just
+    drops them.
+    """
+
+    def __init__(self, db: SqliteDatabase, lock_path=None, cache=None):
+        self.db = db
+        self._cache = cache if cache is not None else SessionCache()  # conv_key -> (base, version, messages)
+        # Held around check-then-put, so a stale reader cannot overwrite a newer entry
+        self._cache_lock = threading.Lock()
+        self._locks = FileKeyedLock(lock_path or f"{db.path}.locks")
+
+    def lock(self, conv_key):
+        return self._locks(conv_key)
+
+    def __contains__(self, conv_key):
+        return self.db.conn.execute("SELECT 1 FROM conversations WHERE conv_key = ?", (conv_key,)).fetchone() is not None
+
+    def get(self, conv_key, default=None):
+        conn = self.db.conn
+        row = conn.execute("SELECT base, version FROM conversations WHERE conv_key = ?", (conv_key,)).fetchone()
+        if row is None:
+            with self._cache_lock:
+                self._cache.pop(conv_key)
+            return default
+        base, version = row
+        with self._cache_lock:
+            cached = self._cache.get(conv_key)
+        if cached and cached[0] == base and cached[1] == version:
+            messages = cached[2]
+        else:
+            # Bounded by `version` so a write landing between the two reads is picked up next time
+            seen = cached[1] if cached and cached[0] == base else 0
+            rows = conn.execute(
+                "SELECT role, message FROM messages WHERE conv_key = ? AND id > ? AND id <= ? ORDER BY id",
+                (conv_key, seen, version),
+            )
+            messages = (cached[2] if seen else []) + [{"role": role, "message": message} for role, message in rows]
+            self._remember(conv_key, base, version, messages)
+        return list(messages)
+
+    def _remember(self, conv_key, base, version, messages):
+        with self._cache_lock:
+            cached = self._cache.get(conv_key)
+            if cached and cached[0] == base and cached[1] > version:
+                return  # a concurrent reader already cached something newer
+            self._cache.put(conv_key, (base, version, messages), messages_size(messages))
+
+    def append(self, conv_key, message):
+        self.extend(conv_key, [message])
+
+    def extend(self, conv_key, messages):
+        if not messages:
+            return
+        with self.db.transaction() as conn:
+            previous, base, version = self._insert(conn, conv_key, messages)
+        _count_bytes("messages", *(m.get("message", "") for m in messages))
+        with self._cache_lock:
+            cached = self._cache.get(conv_key)
+        if cached and cached[0] == base and cached[1] == previous:
+            self._remember(conv_key, base, version, cached[2] + list(messages))
+
+    def extend_many(self, conversations):
+        """Batched import: {conv_key: [messages]} in one transaction."""
+        with self.db.transaction() as conn:
+            for conv_key, messages in conversations.items():
+                if messages:
+                    self._insert(conn, conv_key, messages)
+
+    def _insert(self, conn, conv_key, messages):
+        """Append inside the caller's write transaction; returns (previous version, base, new version)."""
+        row = conn.execute("SELECT base, version FROM conversations WHERE conv_key = ?", (conv_key,)).fetchone()
+        if row is None:
+            page_id, user_id = split_conv_key(conv_key)
+            conn.execute(
+                "INSERT INTO conversations (conv_key, page_id, user_id, created_at) VALUES (?, ?, ?, ?)",
+                (conv_key, page_id, user_id, _now()),
+            )
+            row = (None, 0)
+        conn.executemany(
+            "INSERT INTO messages (conv_key, role, message) VALUES (?, ?, ?)",
+            [(conv_key, m.get("role", ""), m.get("message", "")) for m in messages],
+        )
+        # The write lock is held, so AUTOINCREMENT ids for this batch are consecutive
+        version = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        base = row[0] if row[0] is not None else version - len(messages) + 1
+        conn.execute("UPDATE conversations SET base = ?, version = ? WHERE conv_key = ?", (base, version, conv_key))
+        return row[1], base, version
+
+    def delete_prefix(self, prefix):
+        low, high = _prefix_range(prefix)
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM messages WHERE conv_key >= ? AND conv_key < ?", (low, high))
+            deleted = conn.execute("DELETE FROM conversations WHERE conv_key >= ? AND conv_key < ?", (low, high)).rowcount
+        with self._cache_lock:
+            self._cache.discard_prefix(prefix)
+        return deleted
+
+    def clear(self):
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM messages")
+            conn.execute("DELETE FROM conversations")
+        with self._cache_lock:
+            self._cache.clear()
+
+    def iter_all(self):
+        """Yield (conv_key, messages) for every conversation."""
+        keys = [row[0] for row in self.db.conn.execute("SELECT conv_key FROM conversations ORDER BY conv_key")]
+        for conv_key in keys:
+            yield conv_key, self.get(conv_key, [])
+
+    def close(self):
+        self._locks.close()
+
+
+class SqliteLeadStore(LeadBackend):
+    def __init__(self, db: SqliteDatabase):
+        self.db = db
+
+    @staticmethod
+    def _lead(page_id, user_id, data, updated_at):
+        return {**json.loads(data), "user_id": user_id, "page_id": page_id, "updated_at": updated_at}
+
+    def get(self, page_id, user_id):
+        row = self.db.conn.execute(
+            "SELECT data, updated_at FROM leads WHERE page_id = ? AND user_id = ?", (page_id, user_id)
+        ).fetchone()
+        return self._lead(page_id, user_id, *row) if row else None
+
+    def upsert(self, page_id, user_id, fields):
+        with self.db.transaction() as conn:
+            row = conn.execute(
+                "SELECT data FROM leads WHERE page_id = ? AND user_id = ?", (page_id, user_id)
+            ).fetchone()
+            data = {**(json.loads(row[0]) if row else {}), **fields}
+            for key in ("user_id", "page_id", "updated_at"):
+                data.pop(key, None)
+            updated_at = _now()
+            encoded = json.dumps(data, ensure_ascii=False)
+            conn.execute(
+                "INSERT INTO leads (page_id, user_id, data, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(page_id, user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (page_id, user_id, encoded, updated_at),
+            )
+            self.db.bump(conn, "leads")
+        _count_bytes("leads", encoded)
+        return self._lead(page_id, user_id, json.dumps(data), updated_at)
+
+    def insert_many(self, leads):
+        """Batched import of complete lead dicts (as stored in leads.json)."""
+        rows = []
+        for lead in leads:
+            data = {k: v for k, v in lead.items() if k not in ("page_id", "user_id", "updated_at")}
+            rows.append((lead.get("page_id"), lead.get("user_id"), json.dumps(data, ensure_ascii=False),
+                         lead.get("updated_at") or _now()))
+        with self.db.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO leads (page_id, user_id, data, updated_at) VALUES (?, ?, ?, ?)", rows
+            )
+            self.db.bump(conn, "leads")
+
+    def clear(self):
+        with self.db.transaction() as conn:
+            conn.execute("DELETE FROM leads")
+            self.db.bump(conn, "leads")
+
+    def iter_leads(self, page_id=None, updated_since=None, start=0):
+        # Keyset pagination on seq: each batch is a short indexed read, no open cursor between yields
+        sql = "SELECT seq, page_id, user_id, data, updated_at FROM leads WHERE seq > ?"
+        params = []
+        if page_id is not None:
+            sql += " AND page_id = ?"
+            params.append(page_id)
+        if updated_since:
+            sql += " AND updated_at >= ?"
+            params.append(updated_since)
+        sql += " ORDER BY seq LIMIT ?"
+        position = start
+        while True:
+            rows = self.db.conn.execute(sql, (position, *params, ITER_BATCH)).fetchall()
+            for seq, row_page_id, user_id, data, updated_at in rows:
+                position = seq
+                yield seq, self._lead(row_page_id, user_id, data, updated_at)
+            if len(rows) < ITER_BATCH:
+                return
+
+
+def create_sqlite_storage(path, lock_path=None) -> Storage:
+    db = SqliteDatabase(path)
+    storage = Storage(SqliteSetupStore(db), SqliteConversationStore(db, lock_path), SqliteLeadStore(db))
+    storage.db = db
+    return storage
@@ -0,0 +1,45 @@
+from quart import Quart, Response, request
+from quart_cors import cors
+from dotenv import load_dotenv
+
+# Load .env variables
+load_dotenv()
+
+# ASGI entry point: same routes as main.py, served by async handlers.
+# Run with: hypercorn asgi:app --bind 0.0.0.0:8000
+def create_asgi_app():
+    app = Quart(__name__)
+
+    # Enable CORS
+    app = cors(app, allow_origin=[
+        "http://localhost:5173",
+        "http://localhost:5174",
+        "https://nepwoop.com"
+    ], allow_credentials=True)
+
+    from app.routes.async_bot_routes import bot_bp
+    app.register_blueprint(bot_bp, url_prefix="/api")
+
+    from app.services import metrics
+
+    @app.route("/")
+    async def health_check():
+        return {"message": "Backend is running!"}
+
+    # Hooks are async so the timings live in the request's own task context
+    if metrics.ENABLED:
+        @app.before_request
+        async def start_timing():
+            metrics.start_request()
+
+        @app.after_request
+        async def record_timing(response):
+            return metrics.finish_request(response, request.endpoint)
+
+        @app.route("/metrics")
+        async def metrics_endpoint():
+            return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    return app
+
+app = create_asgi_app()
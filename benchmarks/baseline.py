@@ -0,0 +1,98 @@
+"""
+Latency summaries and JSON baselines shared by the benchmark scripts.
+
+A baseline file maps a case name to its summary (`p50_ms`, `p95_ms`,
+`p99_ms`, `per_s`, ...). `compare()` flags a case whose latency grew, or
+whose throughput fell, by more than `tolerance` (a fraction) against the
+saved baseline; cases or keys the baseline does not have are skipped.
+"""
+import json
+import platform
+import sys
+import time
+from pathlib import Path
+
+# Summary keys compared against a baseline, by which direction is a regression
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "p99_ms", "rss_mb", "rss_mb_per_1k", "disk_mb_per_1k")
+HIGHER_IS_BETTER = ("per_s",)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def summarize(timings_ms, wall_s=None) -> dict:
+    """p50/p95/p99 of per-operation timings in ms, and operations/s over `wall_s` (or their sum)."""
+    wall_s = wall_s if wall_s is not None else sum(timings_ms) / 1000
+    return {
+        "n": len(timings_ms),
+        "p50_ms": round(percentile(timings_ms, 50), 4),
+        "p95_ms": round(percentile(timings_ms, 95), 4),
+        "p99_ms": round(percentile(timings_ms, 99), 4),
+        "per_s": round(len(timings_ms) / wall_s, 1) if wall_s else None,
+    }
+
+
+def print_table(results: dict):
+    print(f"{'case':>34} {'n':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'per s':>10}")
+    for name, r in results.items():
+        per_s = f"{r['per_s']:>10.1f}" if r.get("per_s") else f"{'-':>10}"
+        print(f"{name:>34} {r['n']:>7} {r['p50_ms']:>10.3f} {r['p95_ms']:>10.3f} {r['p99_ms']:>10.3f} {per_s}")
+        extra = {k: v for k, v in r.items() if k not in ("n", "p50_ms", "p95_ms", "p99_ms", "per_s")}
+        if extra:
+            print(f"{'':>34} " + "  ".join(f"{k}={v}" for k, v in extra.items()))
+
+
+def save(path, results: dict, args=None):
+    payload = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "machine": platform.machine(),
+        "args": vars(args) if args is not None else {},
+        "results": results,
+    }
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(payload, f, indent=2)
+    print(f"baseline saved to {path}")
+
+
+def compare(path, results: dict, tolerance=0.2) -> list:
+    """Regressions of `results` against the baseline at `path`, as printable lines."""
+    with open(path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    for name, current in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        for key in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+            old, new = before.get(key), current.get(key)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change > tolerance if key in LOWER_IS_BETTER else change < -tolerance
+            if worse:
+                regressions.append(f"{name} {key}: {old} -> {new} ({change:+.0%})")
+    return regressions
+
+
+def finish(results: dict, args):
+    """Print, then --save and/or --compare; exits 1 when --compare finds a regression."""
+    print_table(results)
+    if args.compare:
+        regressions = compare(args.compare, results, args.tolerance)
+        for line in regressions:
+            print("REGRESSION " + line)
+        if regressions:
+            sys.exit(1)
+        print(f"no regressions against {args.compare} (tolerance {args.tolerance:.0%})")
+    if args.save:
+        save(args.save, results, args)
+
+
+def add_arguments(parser):
+    parser.add_argument("--save", help="write the results to this JSON baseline")
+    parser.add_argument("--compare", help="fail if results regress against this JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression, as a fraction")
@@ -0,0 +1,93 @@
+"""
+Pooled provider client against the local mock server.
+
+    python benchmarks/bench_ai_client.py --calls 200
+
+Compares the pooled keep-alive client with a one-shot `httpx.post` per call
+(the previous behaviour), reports how many TCP connections each opened, and
+checks that transient 503s are retried instead of surfacing to the caller,
+while a 429 whose Retry-After is longer than the backoff cap is raised at
+once (for the router to fail over) rather than retried early.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("OPENAI_API", "mock-key")
+os.environ.setdefault("DEEPSEEK_API", "mock-key")
+
+import httpx  # noqa: E402
+
+from app.services.ai_client import LLMError, ProviderClient, ProviderConfig  # noqa: E402
+from benchmarks.mock_llm import MockConfig, start_mock_server  # noqa: E402
+
+PAYLOAD = {"messages": [{"role": "system", "content": "Say hello."}]}
+
+
+def timed(fn, calls):
+    timings = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    server = start_mock_server(MockConfig())
+    provider = ProviderClient(ProviderConfig("Mock", server.base_url, "mock-key", "mock-model"))
+
+    before = server.stats["connections"]
+    one_shot = timed(lambda: httpx.post(f"{server.base_url}/chat/completions", json=PAYLOAD, timeout=10).json(), args.calls)
+    one_shot_conns = server.stats["connections"] - before
+
+    before = server.stats["connections"]
+    pooled = timed(lambda: provider.chat_completion(PAYLOAD), args.calls)
+    pooled_conns = server.stats["connections"] - before
+
+    print(f"{'client':>10} {'p50 ms':>8} {'p95 ms':>8} {'connections':>12}")
+    for name, timings, conns in (("one-shot", one_shot, one_shot_conns), ("pooled", pooled, pooled_conns)):
+        p95 = sorted(timings)[int(len(timings) * 0.95)]
+        print(f"{name:>10} {statistics.median(timings):>8.2f} {p95:>8.2f} {conns:>12}")
+
+    # Transient errors: every call should still succeed thanks to retries
+    server.config.error_rate = 0.3
+    server.config.retry_after = 0
+    flaky = ProviderClient(ProviderConfig("Mock", server.base_url, "mock-key", "mock-model", max_retries=5, backoff_base=0.01))
+    failures = 0
+    for _ in range(args.calls):
+        try:
+            flaky.chat_completion(PAYLOAD)
+        except LLMError:
+            failures += 1
+    print(f"30% injected 503s -> {failures}/{args.calls} calls surfaced an error after retries")
+
+    # Retry-After past backoff_max: no retry before the time asked for, so the 429 surfaces at once
+    server.config.error_status = 429
+    server.config.retry_after = 30
+    requests, failures, slowest = server.stats["requests"], 0, 0.0
+    for _ in range(args.calls):
+        start = time.perf_counter()
+        try:
+            flaky.chat_completion(PAYLOAD)
+        except LLMError as e:
+            failures += e.retryable
+        slowest = max(slowest, time.perf_counter() - start)
+    print(f"30% injected 429s with Retry-After 30s -> {failures}/{args.calls} raised as retryable, "
+          f"{server.stats['requests'] - requests} requests, slowest call {slowest * 1000:.0f} ms")
+
+    provider.close()
+    flaky.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Per-turn write latency of the conversation stores as they grow.
+
+    python benchmarks/bench_conversation_store.py --conversations 100000
+
+Each checkpoint times `--samples` appends to fresh conversations in:
+
+- files:   ConversationFileStore behind a SessionCache of `--cache-size`
+           entries, the store the app writes to;
+- journal: the single-file journaled ConversationStore, now only read to
+           import a legacy conversations.json (`--no-journal` skips it).
+
+The p50/p99 of both should stay flat from 1k to 100k conversations; the
+legacy full-rewrite column grows linearly with the store. `--sync` writes
+inside append() instead of handing the write to the write-behind writer.
+"""
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.services.conversation_files import ConversationFileStore  # noqa: E402
+from app.services.conversation_store import ConversationStore  # noqa: E402
+from app.services.storage.session_cache import CONVERSATION_CACHE_SIZE, SessionCache  # noqa: E402
+
+MESSAGE = {"role": "user", "message": "I studied computer engineering and worked on BOM tooling for five years."}
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def legacy_save(path, conversations):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(conversations, f, indent=2, ensure_ascii=False)
+
+
+def sample(store, target, samples):
+    """`samples` appends to fresh conversations, in microseconds."""
+    timings = []
+    for i in range(samples):
+        start = time.perf_counter()
+        store.append(f"page_sample{target}_{i}", MESSAGE)
+        timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+def columns(timings):
+    return f"{statistics.median(timings):>9.1f} {percentile(timings, 99):>9.1f} {max(timings):>9.1f}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=100_000)
+    parser.add_argument("--samples", type=int, default=500)
+    parser.add_argument("--legacy-samples", type=int, default=3)
+    parser.add_argument("--cache-size", type=int, default=CONVERSATION_CACHE_SIZE)
+    parser.add_argument("--compact-every", type=int, default=20_000)
+    parser.add_argument("--fsync", choices=["always", "interval", "never"], default="never")
+    parser.add_argument("--sync", action="store_true", help="disable write-behind")
+    parser.add_argument("--no-journal", action="store_true", help="only measure the conversation files")
+    args = parser.parse_args()
+
+    checkpoints = [c for c in (1_000, 10_000, 50_000, 100_000) if c <= args.conversations]
+    if args.conversations not in checkpoints:
+        checkpoints.append(args.conversations)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = ConversationFileStore(Path(tmp) / "conversations", cache=SessionCache(max_entries=args.cache_size),
+                                      fsync=args.fsync, write_behind=not args.sync)
+        stores = {"files": files}
+        if not args.no_journal:
+            stores["journal"] = ConversationStore(Path(tmp) / "conversations.json", compact_every=args.compact_every,
+                                                  fsync=args.fsync, write_behind=not args.sync)
+        legacy_path = Path(tmp) / "legacy.json"
+        filled = 0
+        header = "".join(f" {name + ' p50 us':>15} {'p99 us':>9} {'max us':>9}" for name in stores)
+        print(f"{'conversations':>13}{header} {'legacy ms':>10}")
+        for target in checkpoints:
+            while filled < target:
+                for store in stores.values():
+                    store.append(f"page_user{filled}", MESSAGE)
+                filled += 1
+
+            results = "".join(f" {columns(sample(store, target, args.samples)):>35}" for store in stores.values())
+
+            snapshot = dict(files.iter_all())
+            legacy = []
+            for _ in range(args.legacy_samples):
+                start = time.perf_counter()
+                legacy_save(legacy_path, snapshot)
+                legacy.append((time.perf_counter() - start) * 1e3)
+
+            print(f"{target:>13}{results} {statistics.median(legacy):>10.1f}")
+        for store in stores.values():
+            store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Micro-benchmarks of the per-turn CPU and persistence work, no provider involved.
+
+    python benchmarks/bench_micro.py --iterations 5000 --save benchmarks/baselines/micro.json
+    python benchmarks/bench_micro.py --compare benchmarks/baselines/micro.json
+
+Cases:
+- build_context: a compiled-prompt cache hit, and a cold compile of a new setup;
+- parse_booking_confirmation: a clean block, a malformed block that needs
+  repair, a reply without a block, and a long reply;
+- persistence: one turn appended to a conversation and one lead upsert,
+  for the JSON (conversation files, lead journal) and SQLite stores.
+
+The stores run in a temporary directory with the configured defaults
+(JOURNAL_*, CONVERSATION_CACHE_*, ...) so env settings can be compared.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from app.services.context_builder import build_context  # noqa: E402
+from app.services.parser import parse_booking_confirmation  # noqa: E402
+from app.services.storage import create_storage  # noqa: E402
+from benchmarks import baseline  # noqa: E402
+from benchmarks.mock_llm import LEAD_REPLIES  # noqa: E402
+
+SETUP = {
+    "page_id": "bench_page", "user_id": "bench_owner", "business_name": "Bench Clinic",
+    "business_address": "1 Main St", "offerings": "Career coaching", "business_hours": "9-5",
+    "field": ["name", "email", "phone", "education", "experience", "goal"],
+    "services": [{"name": f"Session {i}", "price": str(50 + i), "negotiable": "0"} for i in range(10)],
+}
+CLEAN = LEAD_REPLIES[3]
+MALFORMED = 'Got it!\n<<JSON>>\n,"name": "Sam", "email": "sam@example.com",,\n<<ENDJSON>>'
+NO_BLOCK = LEAD_REPLIES[0]
+LONG = ("Thanks for sharing that story. " * 60) + CLEAN
+TURN = [{"role": "user", "message": "I studied computer engineering and worked on BOM tooling for five years."},
+        {"role": "bot", "message": CLEAN}]
+
+
+def timed(fn, iterations, warmup=50):
+    for i in range(min(warmup, iterations)):
+        fn(i)
+    timings = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        fn(i)
+        timings.append((time.perf_counter() - t) * 1000)
+    return baseline.summarize(timings, time.perf_counter() - start)
+
+
+def bench_cpu(iterations):
+    results = {}
+    results["build_context.cached"] = timed(lambda i: build_context(SETUP), iterations)
+    results["build_context.cold"] = timed(lambda i: build_context({**SETUP, "business_name": f"Clinic {i}"}),
+                                          iterations)
+    for name, text in (("clean", CLEAN), ("malformed", MALFORMED), ("no_block", NO_BLOCK), ("long", LONG)):
+        results[f"parse_booking_confirmation.{name}"] = timed(lambda i: parse_booking_confirmation(text), iterations)
+    return results
+
+
+def bench_persistence(backend, iterations):
+    storage = create_storage(backend)
+    try:
+        # Spread turns over many conversations and leads, as live traffic would
+        users = max(1, iterations // 10)
+        results = {
+            f"{backend}.conversation_turn": timed(
+                lambda i: storage.conversations.extend(f"bench_u{i % users}", TURN), iterations),
+            f"{backend}.lead_upsert": timed(
+                lambda i: storage.leads.upsert("bench", f"u{i % users}", {"name": "Sam", "turn": str(i)}), iterations),
+        }
+    finally:
+        storage.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=5000)
+    parser.add_argument("--backends", default="json,sqlite")
+    baseline.add_arguments(parser)
+    args = parser.parse_args()
+    save = args.save and os.path.abspath(args.save)
+    compare = args.compare and os.path.abspath(args.compare)
+
+    results = bench_cpu(args.iterations)
+    with tempfile.TemporaryDirectory() as tmp:
+        # The stores use paths relative to the working directory
+        os.chdir(tmp)
+        for backend in filter(None, args.backends.split(",")):
+            results.update(bench_persistence(backend, args.iterations))
+        os.chdir(ROOT)
+
+    args.save, args.compare = save, compare
+    baseline.finish(results, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Throughput of the offline replay (app.services.replay) against the mock provider.
+
+    python benchmarks/bench_replay.py --sessions 5000 --workers 8
+    python benchmarks/bench_replay.py --tool-calls --save benchmarks/baselines/replay.json
+
+Scripted sessions of `--turns` user messages (load_sessions.MESSAGES) over
+`--pages` inline setups asking for name/email/phone are replayed through a
+local mock that walks through LEAD_REPLIES, so every session with three or
+more turns should complete its lead at turn 3. The run fails if any session
+errors or any setup's completion rate falls short of that.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks import baseline  # noqa: E402
+from benchmarks.load_sessions import MESSAGES, setup_for  # noqa: E402
+from benchmarks.mock_llm import LEAD_REPLIES, MockConfig, start_mock_server  # noqa: E402
+
+EXPECTED_TURNS = 3
+
+
+def write_sessions(path, sessions, turns, pages):
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(sessions):
+            session = {"id": f"s{i}", "setup": setup_for(i % pages),
+                       "turns": [MESSAGES[t % len(MESSAGES)] for t in range(turns)]}
+            f.write(json.dumps(session) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--rate", type=float, default=0.0)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--tool-calls", action="store_true", help="mock answers with record_lead tool calls")
+    parser.add_argument("--tool-only", action="store_true", help="tool calls with no text beside them")
+    baseline.add_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_mock_server(MockConfig(latency_ms=args.latency_ms, replies=LEAD_REPLIES,
+                                          tool_calls=args.tool_calls, tool_only=args.tool_only))
+    os.environ.update({
+        "OPENAI_API": "mock-key", "DEEPSEEK_API": "mock-key",
+        "OPENAI_BASE_URL": server.base_url, "DEEPSEEK_BASE_URL": server.base_url,
+        "LLM_MAX_CONNECTIONS": str(max(args.concurrency * 2, 20)),
+        "LLM_MAX_KEEPALIVE": str(max(args.concurrency * 2, 10)),
+    })
+    from app.services.replay import load_sessions, replay, print_summary
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / "sessions.jsonl"
+        write_sessions(source, args.sessions, args.turns, args.pages)
+        sessions, setups, _ = load_sessions(source, Path(tmp) / "setups.json")
+        out = Path(tmp) / "results.jsonl"
+        start = time.perf_counter()
+        report = replay(sessions, setups, out, workers=args.workers, concurrency=args.concurrency, rate=args.rate)
+        wall = time.perf_counter() - start
+        with open(out, "r", encoding="utf-8") as f:
+            latencies = [json.loads(line)["latency_ms"] for line in f]
+    server.shutdown()
+
+    summary = report.summary()
+    print_summary(summary)
+    print(f"{args.sessions} sessions in {wall:.2f}s: {args.sessions / wall:.0f} sessions/s, "
+          f"{args.sessions * (args.turns + 1) / wall:.0f} provider calls/s")
+    baseline.finish({"session": baseline.summarize(latencies, wall)}, args)
+
+    complete = args.turns >= EXPECTED_TURNS
+    failed = [label for label, s in summary.items()
+              if s["errors"] or s["completion_rate"] < complete
+              or (complete and s["turns_to_completion_p50"] != EXPECTED_TURNS)]
+    if len(latencies) != args.sessions or failed:
+        print(f"FAILED: {len(latencies)}/{args.sessions} results; setups off: {failed[:5]}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
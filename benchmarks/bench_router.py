@@ -0,0 +1,132 @@
+"""
+Tail latency and failover of the provider router against two mock providers.
+
+    python benchmarks/bench_router.py --calls 300 --slow-rate 0.05 --slow-ms 5000
+
+ChatGPT (the requested model) answers in `--latency-ms`, but `--slow-rate` of
+its requests stall for another `--slow-ms`; DeepSeek is steady. Each
+scenario prints p50/p95/p99/max:
+
+- direct:  the provider alone, as before the router;
+- hedged:  the router, blocking and async, which asks DeepSeek once ChatGPT
+           passes its p95 deadline and cancels the loser;
+- stream:  time to the first token of router.stream(), whose deadline comes
+           from first-token latencies rather than whole completions;
+- outage:  ChatGPT answers 503 to everything; after the circuit opens
+           requests go straight to DeepSeek.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.mock_llm import MockConfig, start_mock_server  # noqa: E402
+
+MESSAGES = [{"role": "system", "content": "Say hello."}]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report(name, timings, extra=""):
+    print(f"{name:>14} {statistics.median(timings):>8.0f} {percentile(timings, 95):>8.0f} "
+          f"{percentile(timings, 99):>8.0f} {max(timings):>8.0f}  {extra}")
+
+
+def timed_calls(fn, calls, concurrency):
+    def one(_):
+        start = time.perf_counter()
+        fn()
+        return (time.perf_counter() - start) * 1000
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(one, range(calls)))
+
+
+async def atimed_calls(fn, calls, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await fn()
+            return (time.perf_counter() - start) * 1000
+
+    return await asyncio.gather(*(one() for _ in range(calls)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=200)
+    parser.add_argument("--slow-rate", type=float, default=0.05)
+    parser.add_argument("--slow-ms", type=float, default=5000)
+    args = parser.parse_args()
+
+    primary = start_mock_server(MockConfig(latency_ms=args.latency_ms, jitter_ms=args.latency_ms / 4,
+                                           slow_rate=args.slow_rate, slow_ms=args.slow_ms))
+    alternate = start_mock_server(MockConfig(latency_ms=args.latency_ms * 1.5, jitter_ms=args.latency_ms / 4))
+    os.environ.update({
+        "OPENAI_API": "mock-key", "DEEPSEEK_API": "mock-key",
+        "OPENAI_BASE_URL": primary.base_url, "DEEPSEEK_BASE_URL": alternate.base_url,
+        "LLM_HEDGE_MIN_MS": str(args.latency_ms), "LLM_HEDGE_DEFAULT_MS": str(args.latency_ms * 3),
+        "LLM_BACKOFF_BASE": "0.02", "LLM_BREAKER_RESET": "60",
+    })
+    from app.services import ai_client
+    from app.services.llm_router import router
+
+    print(f"{'scenario':>14} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    report("direct", timed_calls(lambda: ai_client.generate_chatgpt_reply(MESSAGES), args.calls, args.concurrency))
+
+    before = dict(alternate.stats)
+    # Warm the latency window so the deadline tracks the measured p95
+    timed_calls(lambda: router.generate("chatgpt", MESSAGES), 50, args.concurrency)
+    timings = timed_calls(lambda: router.generate("chatgpt", MESSAGES), args.calls, args.concurrency)
+    report("hedged", timings, f"hedges={alternate.stats['requests'] - before['requests']} "
+                              f"deadline={router.hedge_delay('chatgpt') * 1000:.0f}ms")
+
+    def first_token():
+        stream = router.stream("chatgpt", MESSAGES)
+        next(stream, None)
+        stream.close()
+
+    before = dict(alternate.stats)
+    timed_calls(first_token, 50, args.concurrency)
+    timings = timed_calls(first_token, args.calls, args.concurrency)
+    report("stream", timings, f"hedges={alternate.stats['requests'] - before['requests']} "
+                              f"deadline={router.hedge_delay('chatgpt', 'stream') * 1000:.0f}ms")
+
+    async def run_async():
+        timings = await atimed_calls(lambda: router.agenerate("chatgpt", MESSAGES), args.calls, args.concurrency)
+        await ai_client.chatgpt.aclose()
+        await ai_client.deepseek.aclose()
+        return timings
+
+    before = primary.stats["cancelled"]
+    timings = asyncio.run(run_async())
+    # Stalled requests only notice the hang-up once their delay is over
+    time.sleep(args.slow_ms / 1000 + 0.5)
+    report("hedged async", timings, f"losers cancelled at provider={primary.stats['cancelled'] - before}")
+
+    primary.config.error_rate = 1.0
+    before = primary.stats["requests"]
+    timings = timed_calls(lambda: router.generate("chatgpt", MESSAGES), args.calls, args.concurrency)
+    report("outage", timings, f"chatgpt requests={primary.stats['requests'] - before} "
+                              f"circuit={router.health['chatgpt'].state}")
+
+    time.sleep(args.slow_ms / 1000 + 0.5)
+    primary.shutdown()
+    alternate.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Startup time and memory of the conversation store against history size.
+
+    python benchmarks/bench_startup.py --sizes 1000,10000,100000
+    python benchmarks/bench_startup.py --save benchmarks/baselines/startup.json
+
+For each size, conversations of `--messages` messages are written once in
+both layouts: per-conversation files (ConversationFileStore, what the app
+uses) and the legacy single snapshot (ConversationStore). Each store is then
+opened `--repeat` times in a fresh process, which reports how long opening
+took, the RSS it added, and the latency of the first read of one
+conversation. The file store's figures should stay flat as the size grows.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks import baseline  # noqa: E402
+from benchmarks.load_sessions import rss_mb  # noqa: E402
+
+LAYOUTS = ("files", "legacy")
+
+
+def conversation(i, messages):
+    return [{"role": "user" if n % 2 else "bot", "message": f"Message {n} of conversation {i}. " * 4}
+            for n in range(messages)]
+
+
+def write_history(directory, size, messages):
+    from app.services.conversation_files import file_name
+
+    files = Path(directory) / "conversations"
+    files.mkdir()
+    snapshot = {}
+    for i in range(size):
+        conv_key = f"page{i % 100}_user{i}"
+        history = conversation(i, messages)
+        snapshot[conv_key] = history
+        with open(files / file_name(conv_key), "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(m, ensure_ascii=False) + "\n" for m in history)
+    with open(Path(directory) / "conversations.json", "w", encoding="utf-8") as f:
+        json.dump({"seq": 0, "conversations": snapshot}, f, ensure_ascii=False)
+
+
+def child(layout, directory, size):
+    """Open one store and print {"open_ms", "rss_mb", "first_get_ms"} as JSON."""
+    from app.services.conversation_files import ConversationFileStore
+    from app.services.conversation_store import ConversationStore
+
+    before = rss_mb()
+    start = time.perf_counter()
+    if layout == "files":
+        store = ConversationFileStore(Path(directory) / "conversations", write_behind=False)
+    else:
+        store = ConversationStore(Path(directory) / "conversations.json", write_behind=False,
+                                  compact_every=float("inf"))
+    opened = time.perf_counter()
+    rss = rss_mb() - before
+    i = random.randrange(size)
+    get_start = time.perf_counter()
+    store.get(f"page{i % 100}_user{i}")
+    first_get = time.perf_counter() - get_start
+    store.close()
+    print(json.dumps({"open_ms": (opened - start) * 1000, "rss_mb": rss, "first_get_ms": first_get * 1000}))
+
+
+def measure(layout, directory, size):
+    out = subprocess.run([sys.executable, __file__, "--child", layout, directory, str(size)],
+                         check=True, capture_output=True, text=True).stdout
+    return json.loads(out.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000,100000", help="conversation counts, comma-separated")
+    parser.add_argument("--messages", type=int, default=6, help="messages per conversation")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    baseline.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.child:
+        layout, directory, size = args.child
+        child(layout, directory, int(size))
+        return
+
+    results = {}
+    for size in [int(s) for s in args.sizes.split(",") if s]:
+        with tempfile.TemporaryDirectory() as tmp:
+            start = time.perf_counter()
+            write_history(tmp, size, args.messages)
+            print(f"{size} conversations written in {time.perf_counter() - start:.1f}s")
+            for layout in LAYOUTS:
+                runs = [measure(layout, tmp, size) for _ in range(args.repeat)]
+                results[f"{layout}.open.{size}"] = {
+                    **baseline.summarize([r["open_ms"] for r in runs]),
+                    "rss_mb": round(max(r["rss_mb"] for r in runs), 2),
+                }
+                results[f"{layout}.first_get.{size}"] = baseline.summarize([r["first_get_ms"] for r in runs])
+    baseline.finish(results, args)
+
+
+if __name__ == "__main__":
+    main()
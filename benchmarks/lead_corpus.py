@@ -0,0 +1,230 @@
+"""
+Fuzz and benchmark corpus for lead extraction (parse_reply).
+
+    python benchmarks/lead_corpus.py --write        # regenerate benchmarks/corpus/lead_replies.jsonl
+    python benchmarks/lead_corpus.py                # fuzz check + timings against the corpus
+    python benchmarks/lead_corpus.py --source data/conversations --iterations 200
+
+The corpus is built from real bot replies: every reply with a <<JSON>> block
+in `--source` (a legacy conversations.json or a conversations directory),
+plus the mock's LEAD_REPLIES. Each block's fields are re-rendered the ways
+models get the format wrong (no braces, doubled braces, stray commas,
+single quotes, bare keys, CRLF, a missing <<ENDJSON>>, split in two blocks)
+with the reply text around them kept. Those cases must give back exactly
+the original fields. Truncated, noisy and marker-fragment cases only have
+to parse without raising and without leaking a marker into the visible text.
+
+The same cases run through the previous regex parser (search, six repair
+substitutions, then a second re.sub to strip) for comparison.
+"""
+import argparse
+import json
+import logging
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from app.services.parser import JSON_END, JSON_START, parse_reply  # noqa: E402
+from benchmarks import baseline  # noqa: E402
+from benchmarks.mock_llm import LEAD_REPLIES  # noqa: E402
+
+CORPUS = ROOT / "benchmarks" / "corpus" / "lead_replies.jsonl"
+SEED = 17
+
+
+# --- Sources ---
+def real_replies(source):
+    """Bot replies holding a block, from a legacy conversations.json or a conversations directory."""
+    source = Path(source)
+    if source.is_dir():
+        from app.services.conversation_files import ConversationFileStore
+        store = ConversationFileStore(source, write_behind=False)
+        try:
+            conversations = dict(store.iter_all())
+        finally:
+            store.close()
+    elif source.exists():
+        with open(source, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        conversations = data.get("conversations", data) if "seq" in data else data
+    else:
+        conversations = {}
+    return [m["message"] for messages in conversations.values() for m in messages
+            if m.get("role") == "bot" and JSON_START in m.get("message", "")]
+
+
+def split_reply(text):
+    """(text before the block, fields, text after) for a reply the tolerant parser can read."""
+    start = text.find(JSON_START)
+    end = text.find(JSON_END, start)
+    fields = parse_reply(text).fields
+    after = text[end + len(JSON_END):] if end != -1 else ""
+    return text[:start], fields, after
+
+
+# --- Renderings of one fields dict ---
+def _pairs(fields, quote='"', bare_keys=False):
+    def q(value):
+        return quote + value + quote if quote == "'" else json.dumps(value, ensure_ascii=False)
+    return [f"{k if bare_keys else q(k)}: {q(v) if isinstance(v, str) else json.dumps(v)}" for k, v in fields.items()]
+
+
+def renderings(fields):
+    """(name, block content) for every malformation that keeps the data."""
+    lines = _pairs(fields)
+    inner = ",\n    ".join(lines)
+    yield "strict", json.dumps(fields, ensure_ascii=False, indent=4)
+    yield "no_braces", "\n    " + " ,\n    ".join(lines) + " \n"
+    yield "extra_braces", "{{\n    " + inner + "\n}}"
+    yield "stray_commas", ",\n    " + inner + ",,\n"
+    yield "trailing_comma", "{\n    " + inner + ",\n}"
+    yield "missing_close", "{\n    " + inner + "\n"
+    yield "crlf", json.dumps(fields, ensure_ascii=False, indent=4).replace("\n", "\r\n")
+    texts = [v for k, v in fields.items() if isinstance(v, str)] + list(fields)
+    if not any("'" in t for t in texts):
+        yield "single_quotes", "{" + ", ".join(_pairs(fields, quote="'")) + "}"
+    if all(k.isidentifier() for k in fields):
+        yield "bare_keys", "{" + ", ".join(_pairs(fields, bare_keys=True)) + "}"
+
+
+def cases(replies, rng):
+    """Corpus entries: {"name", "text", "fields"}; `fields` is None for robustness-only cases."""
+    for n, reply in enumerate(replies):
+        before, fields, after = split_reply(reply)
+        if not fields:
+            continue
+        for name, content in renderings(fields):
+            yield {"name": f"{n}.{name}", "text": f"{before}{JSON_START}\n{content}\n{JSON_END}{after}",
+                   "fields": fields}
+        content = json.dumps(fields, ensure_ascii=False)
+        yield {"name": f"{n}.unterminated", "text": f"{before}{JSON_START}\n{content}\n", "fields": fields}
+        if len(fields) > 1:
+            keys = list(fields)
+            first = {k: fields[k] for k in keys[:len(keys) // 2]}
+            second = {k: fields[k] for k in keys[len(keys) // 2:]}
+            yield {"name": f"{n}.two_blocks",
+                   "text": f"{before}{JSON_START}{json.dumps(first)}{JSON_END} and "
+                           f"{JSON_START}{json.dumps(second)}{JSON_END}{after}",
+                   "fields": fields}
+        # Robustness only: whatever comes back, nothing may raise or leak a marker
+        for k in range(3):
+            yield {"name": f"{n}.truncated{k}", "text": reply[:rng.randrange(len(before), len(reply) + 1)],
+                   "fields": None}
+        noisy = list(reply)
+        for _ in range(max(1, len(reply) // 40)):
+            noisy.insert(rng.randrange(len(noisy) + 1), rng.choice('{}[],:"\'\\\n <>'))
+        yield {"name": f"{n}.noise", "text": "".join(noisy), "fields": None}
+        yield {"name": f"{n}.marker_fragments", "text": f"<<JSON {before} <<END {reply} <<JSO", "fields": None}
+
+
+def write_corpus(path, source):
+    rng = random.Random(SEED)
+    replies = real_replies(source) + [r for r in LEAD_REPLIES if JSON_START in r]
+    entries = list(cases(replies, rng))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    print(f"{len(entries)} cases from {len(replies)} replies written to {path}")
+
+
+def load_corpus(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+# --- The regex parser parse_reply replaced, for comparison ---
+def legacy_parse_reply(text):
+    match = re.search(r"<<JSON>>(.*?)<<ENDJSON>>", text, re.DOTALL)
+    fields = None
+    if match:
+        content = match.group(1).strip()
+        content = re.sub(r'^\s*,+', '', content)
+        content = re.sub(r',+\s*$', '', content)
+        if not content.startswith("{"):
+            content = "{\n" + content + "\n}"
+        if not content.endswith("}"):
+            content = content + "\n}"
+        content = re.sub(r',(\s*})', r'\1', content)
+        content = re.sub(r'^\{+', '{', content)
+        content = re.sub(r'\}+$', '}', content)
+        try:
+            fields = json.loads(content)
+        except json.JSONDecodeError:
+            fields = None
+    visible = re.sub(r"<<JSON>>.*?<<ENDJSON>>", "", text, flags=re.DOTALL).strip()
+    return visible, fields
+
+
+def check(entries, parse):
+    """(cases whose fields came back exactly, expected, list of problems)."""
+    recovered = expected = 0
+    problems = []
+    for entry in entries:
+        try:
+            visible, fields = parse(entry["text"])
+        except Exception as e:  # the point of a fuzz check: nothing may escape
+            problems.append(f"{entry['name']}: raised {e!r}")
+            continue
+        if JSON_START in visible or JSON_END in visible:
+            problems.append(f"{entry['name']}: marker left in the visible text")
+        if entry["fields"] is not None:
+            expected += 1
+            recovered += fields == entry["fields"]
+    return recovered, expected, problems
+
+
+def timed(entries, parse, iterations):
+    timings = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for entry in entries:
+            t = time.perf_counter()
+            parse(entry["text"])
+            timings.append((time.perf_counter() - t) * 1000)
+    return baseline.summarize(timings, time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default=str(CORPUS))
+    parser.add_argument("--write", action="store_true", help="regenerate the corpus from --source")
+    parser.add_argument("--source", default=str(ROOT / "conversations.json"),
+                        help="conversations.json or a conversations directory")
+    parser.add_argument("--iterations", type=int, default=100)
+    baseline.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.write:
+        write_corpus(Path(args.corpus), args.source)
+        return
+
+    entries = load_corpus(args.corpus)
+    # Unreadable blocks are expected here; keep the per-case warnings out of the report
+    logging.getLogger("app.services.parser").setLevel(logging.ERROR)
+    parsers = {
+        "parse_reply": lambda text: (lambda p: (p.visible, p.fields))(parse_reply(text)),
+        "legacy_regex": legacy_parse_reply,
+    }
+    results = {}
+    failed = False
+    for name, parse in parsers.items():
+        recovered, expected, problems = check(entries, parse)
+        results[name] = {**timed(entries, parse, args.iterations), "recovered": f"{recovered}/{expected}",
+                         "problems": len(problems)}
+        if name == "parse_reply":
+            for problem in problems[:10]:
+                print("PROBLEM " + problem)
+            failed = bool(problems) or recovered < expected
+    baseline.finish(results, args)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
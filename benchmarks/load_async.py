@@ -0,0 +1,102 @@
+"""
+Concurrency of the threaded WSGI app vs the ASGI app against a slow provider.
+
+    python benchmarks/load_async.py --sessions 300 --latency-ms 500 --threads 8
+
+Each session opens a conversation (greeting) and sends one message, i.e. two
+provider calls. The WSGI run models a deployment with `--threads` worker
+threads; the ASGI run serves every session from one event loop.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.mock_llm import MockConfig, start_mock_server  # noqa: E402
+
+PAGE_ID = "bench_page"
+SETUP = {"page_id": PAGE_ID, "user_id": "bench_owner", "business_name": "Bench", "field": ["name", "email"]}
+
+
+def report(name, wall, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95)]
+    print(f"{name:>6} {len(timings):>9} {wall:>8.2f} {len(timings) / wall:>10.1f} "
+          f"{statistics.median(timings):>8.0f} {p95:>8.0f}")
+
+
+def run_wsgi(sessions, threads):
+    import main
+
+    client = main.create_app().test_client()
+    client.post("/api/setup", json=SETUP)
+
+    def session(i):
+        start = time.perf_counter()
+        client.post("/api/clinicchat", json={"user_id": f"wsgi{i}", "page_id": PAGE_ID, "message": ""})
+        client.post("/api/clinicchat", json={"user_id": f"wsgi{i}", "page_id": PAGE_ID, "message": "Hi, I'm Sam"})
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        timings = list(pool.map(session, range(sessions)))
+    return time.perf_counter() - start, timings
+
+
+async def run_asgi(sessions):
+    import asgi
+
+    app = asgi.create_asgi_app()
+    async with app.test_app():
+        client = app.test_client()
+        await client.post("/api/setup", json=SETUP)
+
+        async def session(i):
+            start = time.perf_counter()
+            await client.post("/api/clinicchat", json={"user_id": f"asgi{i}", "page_id": PAGE_ID, "message": ""})
+            await client.post("/api/clinicchat", json={"user_id": f"asgi{i}", "page_id": PAGE_ID, "message": "Hi, I'm Sam"})
+            return (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        timings = await asyncio.gather(*(session(i) for i in range(sessions)))
+        return time.perf_counter() - start, timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=300)
+    parser.add_argument("--latency-ms", type=float, default=500)
+    parser.add_argument("--threads", type=int, default=8, help="WSGI worker threads")
+    parser.add_argument("--max-connections", type=int, default=500)
+    args = parser.parse_args()
+
+    server = start_mock_server(MockConfig(latency_ms=args.latency_ms))
+    os.environ.update({
+        "OPENAI_API": "mock-key", "DEEPSEEK_API": "mock-key",
+        "OPENAI_BASE_URL": server.base_url, "DEEPSEEK_BASE_URL": server.base_url,
+        "LLM_MAX_CONNECTIONS": str(args.max_connections), "LLM_MAX_KEEPALIVE": str(args.max_connections),
+    })
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # The stores use paths relative to the working directory
+        os.chdir(tmp)
+        print(f"{'mode':>6} {'sessions':>9} {'wall s':>8} {'sessions/s':>10} {'p50 ms':>8} {'p95 ms':>8}")
+        report("wsgi", *run_wsgi(args.sessions, args.threads))
+        report("asgi", *asyncio.run(run_asgi(args.sessions)))
+        # Write out and close the stores while their relative paths still resolve
+        from app.services.storage import get_storage
+        get_storage().close()
+        os.chdir(ROOT)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+Traffic generator: /setup plus multi-turn /clinicchat sessions at a fixed concurrency.
+
+    python benchmarks/load_sessions.py --sessions 1000 --turns 4 --concurrency 32
+    python benchmarks/load_sessions.py --app asgi --backend sqlite --save benchmarks/baselines/asgi-sqlite.json
+    python benchmarks/load_sessions.py --url http://127.0.0.1:8000 --sessions 200
+
+Each session asks for the greeting and then sends `--turns` messages; the
+mock provider walks through LEAD_REPLIES, so every session fills a lead
+one field at a time. `--pages` setups are posted up front and one is
+re-posted every `--setup-every` sessions, which resets that page's
+conversations mid-run as a real edit would.
+
+By default the app runs in this process (`--app wsgi` on a thread pool,
+`--app asgi` on one event loop) against a local mock provider, with its
+stores in a temporary directory, so memory (RSS) and disk growth per 1k
+sessions are reported too. Runs much shorter than 1000 sessions overstate
+the memory figure, which then includes one-off warm-up allocations.
+
+`--url` drives a running server instead, which must itself point at a mock
+(see mock_llm.py); only latency and throughput are reported then.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks import baseline  # noqa: E402
+from benchmarks.mock_llm import LEAD_REPLIES, MockConfig, start_mock_server  # noqa: E402
+
+MESSAGES = [
+    "Hi, I'm Sam.",
+    "You can email me at sam@example.com",
+    "My number is +1 555 0100",
+    "I studied computer engineering and have worked on BOM tooling for five years.",
+    "Lately I feel stuck and want to find out what I'm really good at.",
+]
+
+
+def setup_for(page):
+    return {"page_id": f"load_page{page}", "user_id": f"load_owner{page}", "business_name": f"Clinic {page}",
+            "field": ["name", "email", "phone"]}
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        import resource  # peak RSS only, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def disk_mb(directory):
+    return sum(p.stat().st_size for p in Path(directory).rglob("*") if p.is_file()) / 2 ** 20
+
+
+class Recorder:
+    def __init__(self):
+        self.timings = {"setup": [], "greeting": [], "turn": [], "session": []}
+        self.errors = 0
+
+    def add(self, kind, start, status):
+        self.timings[kind].append((time.perf_counter() - start) * 1000)
+        self.errors += status != 200
+
+
+def plan(args):
+    """(session index, page, re-post the page's setup first?) for every session."""
+    for i in range(args.sessions):
+        page = i % args.pages
+        yield i, page, bool(args.setup_every) and i > 0 and i % args.setup_every == 0
+
+
+# --- Drivers ---
+def run_sync(post, args, rec):
+    """`post(path, payload) -> status` from a thread pool: the Flask test client or httpx."""
+    chat_path = "/api/clinicchat/stream" if args.stream else "/api/clinicchat"
+
+    def timed(kind, path, payload):
+        start = time.perf_counter()
+        rec.add(kind, start, post(path, payload))
+
+    for page in range(args.pages):
+        timed("setup", "/api/setup", setup_for(page))
+
+    def session(item):
+        i, page, resetup = item
+        if resetup:
+            timed("setup", "/api/setup", setup_for(page))
+        start = time.perf_counter()
+        chat = {"page_id": f"load_page{page}", "user_id": f"load_user{i}", "model": args.model}
+        timed("greeting", chat_path, {**chat, "message": ""})
+        for turn in range(args.turns):
+            timed("turn", chat_path, {**chat, "message": MESSAGES[turn % len(MESSAGES)]})
+        rec.add("session", start, 200)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(session, plan(args)))
+
+
+async def run_async(post, args, rec):
+    """run_sync() for an async `post`, with `--concurrency` sessions in flight on one loop."""
+    chat_path = "/api/clinicchat/stream" if args.stream else "/api/clinicchat"
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def timed(kind, path, payload):
+        start = time.perf_counter()
+        rec.add(kind, start, await post(path, payload))
+
+    for page in range(args.pages):
+        await timed("setup", "/api/setup", setup_for(page))
+
+    async def session(item):
+        i, page, resetup = item
+        async with semaphore:
+            if resetup:
+                await timed("setup", "/api/setup", setup_for(page))
+            start = time.perf_counter()
+            chat = {"page_id": f"load_page{page}", "user_id": f"load_user{i}", "model": args.model}
+            await timed("greeting", chat_path, {**chat, "message": ""})
+            for turn in range(args.turns):
+                await timed("turn", chat_path, {**chat, "message": MESSAGES[turn % len(MESSAGES)]})
+            rec.add("session", start, 200)
+
+    await asyncio.gather(*(session(item) for item in plan(args)))
+
+
+def drive_wsgi(args, rec):
+    import main
+
+    client = main.create_app().test_client()
+
+    def post(path, payload):
+        response = client.post(path, json=payload)
+        response.get_data()  # drain streamed bodies
+        return response.status_code
+
+    run_sync(post, args, rec)
+
+
+def drive_asgi(args, rec):
+    import asgi
+
+    app = asgi.create_asgi_app()
+
+    async def go():
+        async with app.test_app():
+            client = app.test_client()
+
+            async def post(path, payload):
+                response = await client.post(path, json=payload)
+                await response.get_data()
+                return response.status_code
+
+            await run_async(post, args, rec)
+
+    asyncio.run(go())
+
+
+def drive_url(args, rec):
+    import httpx
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    with httpx.Client(base_url=args.url, limits=limits, timeout=120) as client:
+        def post(path, payload):
+            return client.post(path, json=payload).status_code
+
+        run_sync(post, args, rec)
+
+
+def flush_stores():
+    from app.services.storage import get_storage
+
+    storage = get_storage()
+    for store in (storage.conversations, storage.leads):
+        flush = getattr(store, "flush", None)
+        if flush:
+            flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--setup-every", type=int, default=0, help="re-post a setup every N sessions (0: never)")
+    parser.add_argument("--stream", action="store_true", help="use /clinicchat/stream")
+    parser.add_argument("--model", default="chatgpt")
+    parser.add_argument("--app", choices=["wsgi", "asgi"], default="wsgi")
+    parser.add_argument("--url", help="drive a running server instead of an in-process app")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--latency-dist", choices=["uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--tool-calls", action="store_true", help="the mock returns lead fields as tool calls")
+    parser.add_argument("--tool-only", action="store_true", help="the mock's tool calls come with no text")
+    baseline.add_arguments(parser)
+    args = parser.parse_args()
+    for name in ("save", "compare"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    rec = Recorder()
+    if args.url:
+        start = time.perf_counter()
+        drive_url(args, rec)
+        wall = time.perf_counter() - start
+        extra = {}
+    else:
+        server = start_mock_server(MockConfig(latency_ms=args.latency_ms, latency_dist=args.latency_dist,
+                                              error_rate=args.error_rate, replies=LEAD_REPLIES,
+                                              tool_calls=args.tool_calls, tool_only=args.tool_only))
+        os.environ.update({
+            "OPENAI_API": "mock-key", "DEEPSEEK_API": "mock-key",
+            "OPENAI_BASE_URL": server.base_url, "DEEPSEEK_BASE_URL": server.base_url,
+            "LLM_MAX_CONNECTIONS": str(max(args.concurrency * 2, 20)),
+            "LLM_MAX_KEEPALIVE": str(max(args.concurrency * 2, 10)),
+            "STORAGE_BACKEND": args.backend,
+        })
+        tmp = tempfile.TemporaryDirectory()
+        # The stores use paths relative to the working directory
+        os.chdir(tmp.name)
+        import main as _  # noqa: F401  (load the app before measuring memory)
+        from app.routes import bot_routes  # noqa: F401
+        rss_before, disk_before = rss_mb(), disk_mb(tmp.name)
+        start = time.perf_counter()
+        (drive_asgi if args.app == "asgi" else drive_wsgi)(args, rec)
+        wall = time.perf_counter() - start
+        flush_stores()
+        per_1k = 1000 / args.sessions
+        extra = {
+            "rss_mb_per_1k": round((rss_mb() - rss_before) * per_1k, 2),
+            "disk_mb_per_1k": round((disk_mb(tmp.name) - disk_before) * per_1k, 2),
+            "provider_calls": server.stats["requests"],
+        }
+        os.chdir(ROOT)
+        server.shutdown()
+
+    results = {kind: baseline.summarize(timings, wall) for kind, timings in rec.timings.items() if timings}
+    requests = [t for kind, timings in rec.timings.items() if kind != "session" for t in timings]
+    results["all_requests"] = {**baseline.summarize(requests, wall), "errors": rec.errors}
+    results["session"].update(extra)
+    print(f"{args.sessions} sessions x {args.turns} turns, concurrency {args.concurrency}, "
+          f"{args.url or args.app}, {wall:.1f}s")
+    baseline.finish(results, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+"""
+Local OpenAI/DeepSeek-compatible chat-completions server for tests and benchmarks.
+
+    python benchmarks/mock_llm.py --port 8900 --latency-ms 300 --error-rate 0.1
+
+`latency_ms` is the time to the first byte: `latency_ms +- jitter_ms` with
+the "uniform" distribution, or a lognormal with median `latency_ms` and
+shape `latency_sigma` with "lognormal" (a realistic long tail). With
+`"stream": true` the reply is sent as chat.completion.chunk SSE events, one
+word every `token_ms`.
+
+Replies: `reply` for every request, or `replies`, picked by how many user
+turns the prompt holds, so a multi-turn session walks through them.
+`LEAD_REPLIES` fills a name/email/phone lead one <<JSON>> block at a time.
+With `tool_calls` on, a request that offers `tools` gets the reply's
+<<JSON>> block back as a call to the first tool instead (streamed as
+argument fragments), the way providers with function calling answer.
+`tool_only` sends the call with no text, as models often do; the text
+comes once the call's result is sent back (`tool_choice: "none"`).
+
+Faults: `error_rate` answers with `error_status`, `slow_rate` adds `slow_ms`
+to a request (a latency tail). A client that hangs up while waiting is
+counted in `stats["cancelled"]`.
+
+Point the app at it with:
+
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 DEEPSEEK_BASE_URL=http://127.0.0.1:8900/v1
+
+The server runs on one asyncio loop (so hundreds of slow in-flight requests
+cost nothing) and speaks HTTP/1.1 keep-alive so connection reuse can be
+observed: `GET /stats` reports how many TCP connections were accepted.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import threading
+
+DEFAULT_REPLY = "Thanks for sharing! What prompted you to think about career planning now?"
+LEAD_REPLIES = [
+    "Hi there! I'm happy to help you explore your career path. May I have your name?",
+    'Nice to meet you, Sam! What email can I reach you at?\n<<JSON>>\n{"name": "Sam", "email": "", "phone": ""}\n<<ENDJSON>>',
+    'Thank you! And a phone number?\n<<JSON>>\n{"name": "Sam", "email": "sam@example.com", "phone": ""}\n<<ENDJSON>>',
+    'Thank you! I have everything I need.\n<<JSON>>\n'
+    '{"name": "Sam", "email": "sam@example.com", "phone": "+1 555 0100"}\n<<ENDJSON>>',
+    "Thanks for sharing! What prompted you to think about career planning now?",
+]
+REASONS = {200: "OK", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error",
+           502: "Bad Gateway", 503: "Service Unavailable", 504: "Gateway Timeout"}
+
+
+class MockConfig:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, error_status=503, retry_after=None,
+                 reply=DEFAULT_REPLY, token_ms=0.0, slow_rate=0.0, slow_ms=0.0, latency_dist="uniform",
+                 latency_sigma=0.5, replies=None, tool_calls=False, tool_only=False):
+        if latency_dist not in ("uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {latency_dist!r}")
+        self.latency_ms = latency_ms
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.replies = replies
+        self.tool_calls = tool_calls or tool_only
+        self.tool_only = tool_only
+        self.slow_rate = slow_rate
+        self.slow_ms = slow_ms
+        self.token_ms = token_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.reply = reply
+
+
+class MockLLMServer:
+    def __init__(self, config: MockConfig, host="127.0.0.1", port=0):
+        self.config = config
+        self.host = host
+        self.port = port
+        self.stats = {"connections": 0, "requests": 0, "errors": 0, "cancelled": 0}
+        self.seen_prefixes = set()
+        self.loop = None
+        self._server = None
+        self._handlers = set()
+        self._writers = set()
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, backlog=2048)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def shutdown(self):
+        if self.loop is not None and self._server is not None:
+            asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _stop(self):
+        # Hang up idle keep-alive connections too, so no handler is left pending
+        self._server.close()
+        for writer in list(self._writers):
+            writer.close()
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+
+    # --- HTTP ---
+    async def _handle(self, reader, writer):
+        self.stats["connections"] += 1
+        self._handlers.add(asyncio.current_task())
+        self._writers.add(writer)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                body = await reader.readexactly(length) if length else b""
+                await self._dispatch(method, path, body, reader, writer)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self._handlers.discard(asyncio.current_task())
+            self._writers.discard(writer)
+            writer.close()
+
+    def _write_json(self, writer, status, body, headers=None):
+        raw = json.dumps(body).encode("utf-8")
+        head = [f"HTTP/1.1 {status} {REASONS.get(status, 'Error')}", "Content-Type: application/json",
+                f"Content-Length: {len(raw)}"]
+        head += [f"{k}: {v}" for k, v in (headers or {}).items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + raw)
+
+    async def _dispatch(self, method, path, body, reader, writer):
+        if method == "GET" and path == "/stats":
+            self._write_json(writer, 200, self.stats)
+        elif method == "POST" and path.endswith("/chat/completions"):
+            await self._completion(json.loads(body or b"{}"), reader, writer)
+        else:
+            self._write_json(writer, 404, {"error": "not found"})
+        await writer.drain()
+
+    def _usage(self, payload, completion_tokens):
+        # Simulated prefix cache: a system prompt seen before counts as cached
+        messages = payload.get("messages") or []
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4
+        cached = 0
+        if messages and messages[0].get("role") == "system":
+            prefix = messages[0].get("content", "")
+            if prefix in self.seen_prefixes:
+                cached = len(prefix) // 4
+            self.seen_prefixes.add(prefix)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "prompt_cache_hit_tokens": cached,
+            "prompt_cache_miss_tokens": prompt_tokens - cached,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def _reply(self, payload):
+        replies = self.config.replies
+        if not replies:
+            return self.config.reply
+        # The n-th user turn gets replies[n]; later turns repeat the last one
+        turns = sum(1 for m in payload.get("messages") or [] if m.get("role") == "user")
+        return replies[min(turns, len(replies) - 1)]
+
+    async def _completion(self, payload, reader, writer):
+        cfg = self.config
+        self.stats["requests"] += 1
+        if cfg.latency_dist == "lognormal" and cfg.latency_ms > 0:
+            delay = random.lognormvariate(math.log(cfg.latency_ms), cfg.latency_sigma)
+        else:
+            delay = cfg.latency_ms + random.uniform(-cfg.jitter_ms, cfg.jitter_ms)
+        if random.random() < cfg.slow_rate:
+            delay += cfg.slow_ms
+        await asyncio.sleep(max(0.0, delay) / 1000)
+        if reader.at_eof():
+            self.stats["cancelled"] += 1
+            return
+
+        if random.random() < cfg.error_rate:
+            self.stats["errors"] += 1
+            headers = {"Retry-After": str(cfg.retry_after)} if cfg.retry_after is not None else None
+            self._write_json(writer, cfg.error_status, {"error": {"message": "mock provider error"}}, headers)
+            return
+
+        reply = self._reply(payload)
+        call = None
+        if cfg.tool_calls and payload.get("tools"):
+            reply, arguments = _split_block(reply)
+            if arguments is not None and payload.get("tool_choice") != "none":
+                call = {"name": payload["tools"][0]["function"]["name"], "arguments": arguments}
+                if cfg.tool_only:
+                    reply = ""
+        words = reply.split(" ") if reply else []
+        if payload.get("stream"):
+            await self._stream(payload, words, writer, call)
+            return
+
+        if cfg.token_ms:
+            await asyncio.sleep(cfg.token_ms * len(words) / 1000)
+        message = {"role": "assistant", "content": reply or None}
+        if call:
+            message["tool_calls"] = [{"id": "call_mock", "type": "function", "function": call}]
+        self._write_json(writer, 200, {
+            "id": "mock-completion",
+            "object": "chat.completion",
+            "model": payload.get("model", "mock"),
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if call else "stop"}],
+            "usage": self._usage(payload, len(words)),
+        })
+
+    async def _stream(self, payload, words, writer, call=None):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+
+        def chunk(data: bytes):
+            writer.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+        for i, word in enumerate(words):
+            if i and self.config.token_ms:
+                await asyncio.sleep(self.config.token_ms / 1000)
+            delta = word if i == len(words) - 1 else word + " "
+            event = {
+                "id": "mock-completion",
+                "object": "chat.completion.chunk",
+                "model": payload.get("model", "mock"),
+                "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}],
+            }
+            chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+            await writer.drain()
+        if call:
+            # The arguments arrive in fragments, after the name, as providers send them
+            half = len(call["arguments"]) // 2
+            fragments = [{"id": "call_mock", "type": "function", "function": {"name": call["name"], "arguments": ""}},
+                         {"function": {"arguments": call["arguments"][:half]}},
+                         {"function": {"arguments": call["arguments"][half:]}}]
+            for fragment in fragments:
+                event = {
+                    "id": "mock-completion",
+                    "object": "chat.completion.chunk",
+                    "model": payload.get("model", "mock"),
+                    "choices": [{"index": 0, "delta": {"tool_calls": [{"index": 0, **fragment}]}, "finish_reason": None}],
+                }
+                chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        if (payload.get("stream_options") or {}).get("include_usage"):
+            event = {"id": "mock-completion", "object": "chat.completion.chunk", "choices": [],
+                     "usage": self._usage(payload, len(words))}
+            chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        chunk(b"data: [DONE]\n\n")
+        chunk(b"")
+
+
+def _split_block(reply):
+    """(reply without its <<JSON>> block, the block's JSON text or None)."""
+    start = reply.find("<<JSON>>")
+    end = reply.find("<<ENDJSON>>", start)
+    if start == -1 or end == -1:
+        return reply, None
+    return (reply[:start] + reply[end + len("<<ENDJSON>>"):]).strip(), reply[start + len("<<JSON>>"):end].strip()
+
+
+def start_mock_server(config: MockConfig = None, host="127.0.0.1", port=0) -> MockLLMServer:
+    """Start the server on a background thread with its own loop; `port=0` picks a free port."""
+    server = MockLLMServer(config or MockConfig(), host, port)
+    ready = threading.Event()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, name="mock-llm", daemon=True).start()
+    ready.wait()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--token-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=503)
+    parser.add_argument("--retry-after", type=float, default=None)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    parser.add_argument("--slow-ms", type=float, default=0.0)
+    parser.add_argument("--latency-dist", choices=["uniform", "lognormal"], default="uniform")
+    parser.add_argument("--latency-sigma", type=float, default=0.5)
+    parser.add_argument("--lead-replies", action="store_true", help="walk through LEAD_REPLIES turn by turn")
+    parser.add_argument("--tool-calls", action="store_true", help="answer <<JSON>> blocks as tool calls")
+    parser.add_argument("--tool-only", action="store_true", help="tool calls with no text until the result is sent")
+    args = parser.parse_args()
+
+    config = MockConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.error_status, args.retry_after,
+                        token_ms=args.token_ms, slow_rate=args.slow_rate, slow_ms=args.slow_ms,
+                        latency_dist=args.latency_dist, latency_sigma=args.latency_sigma,
+                        replies=LEAD_REPLIES if args.lead_replies else None, tool_calls=args.tool_calls,
+                        tool_only=args.tool_only)
+
+    async def serve():
+        server = MockLLMServer(config, args.host, args.port)
+        await server.start()
+        print(f"Mock LLM listening on {server.base_url}")
+        await server._server.serve_forever()
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+N worker processes sharing one store: checks that no turn or lead is lost.
+
+    python benchmarks/multiworker_check.py --workers 4 --users 20 --shared 5 --turns 5
+    python benchmarks/multiworker_check.py --workers 2 --threads 4
+
+Every worker runs its own copy of the Flask app (as gunicorn workers would)
+against one SQLite database and the mock provider, sending from `--threads`
+threads (as gthread workers would), each with its own share of the users. Each worker chats with
+its own users and with a set of users shared by all workers, and merges a
+worker-specific field into every shared lead. Afterwards every
+conversation must hold exactly one greeting and every sent message exactly
+once, and every shared lead must carry the fields of all workers. A setup
+saved by one worker must also become visible to the others.
+
+`--backend json` runs the same check against the single-process JSON
+stores, which are expected to fail it. The exit status is 1 on any loss.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.mock_llm import MockConfig, start_mock_server  # noqa: E402
+
+PAGE_ID = "mw_page"
+SETUP = {"page_id": PAGE_ID, "user_id": "mw_owner", "business_name": "Multiworker", "field": ["name", "email"]}
+PROBE = {"page_id": "mw_probe", "user_id": "mw_probe_owner", "business_name": "v1"}
+REPLY = 'Nice to meet you! <<JSON>>{"name": "Sam"}<<ENDJSON>>'
+
+
+def worker(idx, users, shared, turns, threads, barrier, results):
+    import main
+    from app.routes.bot_routes import storage
+
+    app = main.create_app()
+    own = [f"w{idx}u{i}" for i in range(users)]
+    shared_users = [f"shared{i}" for i in range(shared)]
+    storage.setups.get_for_page(PROBE["page_id"])  # cache the probe's first version
+
+    def chat(thread):
+        # Threads split the users, so each one holds a shared user's lock while
+        # a thread of another worker may be waiting on one of this worker's
+        client = app.test_client()
+        mine = [u for n, u in enumerate(own) if n % threads == thread]
+        mine_shared = [u for n, u in enumerate(shared_users) if n % threads == thread]
+        failures = 0
+        for turn in range(turns):
+            for user_id in mine + mine_shared:
+                message = f"{user_id} from w{idx} turn {turn}"
+                response = client.post("/api/clinicchat",
+                                       json={"page_id": PAGE_ID, "user_id": user_id, "message": message})
+                failures += response.status_code != 200
+            for user_id in mine_shared:
+                storage.leads.upsert(PAGE_ID, user_id, {f"w{idx}": turn})
+        return failures
+
+    barrier.wait()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        failures = sum(pool.map(chat, range(threads)))
+
+    # Setup invalidation: worker 0 saves a new version, everyone waits to see it
+    barrier.wait()
+    if idx == 0:
+        storage.setups.save({**PROBE, "business_name": "v2"})
+    start = time.perf_counter()
+    seen = False
+    while time.perf_counter() - start < 5:
+        setup = storage.setups.get_for_page(PROBE["page_id"])
+        if setup and setup.get("business_name") == "v2":
+            seen = True
+            break
+        time.sleep(0.005)
+    results.put((idx, failures, seen, (time.perf_counter() - start) * 1000))
+    storage.close()
+
+
+def verify(storage, workers, users, shared, turns):
+    problems = []
+    expected = {}
+    for idx in range(workers):
+        for i in range(users):
+            user_id = f"w{idx}u{i}"
+            expected[user_id] = [f"{user_id} from w{idx} turn {t}" for t in range(turns)]
+    for i in range(shared):
+        user_id = f"shared{i}"
+        expected[user_id] = [f"{user_id} from w{idx} turn {t}" for idx in range(workers) for t in range(turns)]
+
+    lost_turns = 0
+    for user_id, sent in expected.items():
+        history = storage.conversations.get(f"{PAGE_ID}_{user_id}") or []
+        stored = Counter(m["message"] for m in history if m["role"] == "user")
+        bots = sum(1 for m in history if m["role"] == "bot")
+        missing = sum((Counter(sent) - stored).values())
+        lost_turns += missing
+        if missing or stored != Counter(sent):
+            problems.append(f"{user_id}: {missing} of {len(sent)} turns missing")
+        elif bots != len(sent) + 1:
+            problems.append(f"{user_id}: {bots} bot messages for {len(sent)} turns (expected one greeting)")
+
+    lost_leads = 0
+    for user_id in expected:
+        lead = storage.leads.get(PAGE_ID, user_id)
+        want = {"name": "Sam"}
+        if user_id.startswith("shared"):
+            want.update({f"w{idx}": turns - 1 for idx in range(workers)})
+        if lead is None or any(lead.get(k) != v for k, v in want.items()):
+            lost_leads += 1
+            problems.append(f"{user_id}: lead {lead!r} is missing fields of {want!r}")
+    return problems, lost_turns, lost_leads, sum(len(s) for s in expected.values())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--users", type=int, default=20, help="users per worker")
+    parser.add_argument("--shared", type=int, default=5, help="users every worker talks to")
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=2, help="request threads per worker")
+    parser.add_argument("--backend", choices=["sqlite", "json"], default="sqlite")
+    args = parser.parse_args()
+
+    server = start_mock_server(MockConfig(reply=REPLY))
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        os.environ.update({
+            "OPENAI_API": "mock-key", "DEEPSEEK_API": "mock-key",
+            "OPENAI_BASE_URL": server.base_url, "DEEPSEEK_BASE_URL": server.base_url,
+            "STORAGE_BACKEND": args.backend, "SQLITE_PATH": str(Path(tmp) / "data" / "app.db"),
+            "GREETING_POOL_SIZE": "0",
+        })
+        from app.services.storage import create_storage
+
+        storage = create_storage()
+        storage.setups.save(SETUP)
+        storage.setups.save(PROBE)
+        storage.close()
+
+        ctx = multiprocessing.get_context("spawn")
+        barrier = ctx.Barrier(args.workers)
+        results = ctx.Queue()
+        processes = [ctx.Process(target=worker, args=(idx, args.users, args.shared, args.turns, args.threads,
+                                                      barrier, results))
+                     for idx in range(args.workers)]
+        start = time.perf_counter()
+        for p in processes:
+            p.start()
+        reports = [results.get() for _ in processes]
+        for p in processes:
+            p.join()
+        wall = time.perf_counter() - start
+
+        storage = create_storage()
+        problems, lost_turns, lost_leads, total = verify(storage, args.workers, args.users, args.shared, args.turns)
+        storage.close()
+        os.chdir(ROOT)
+    server.shutdown()
+
+    failures = sum(r[1] for r in reports)
+    unseen = [r[0] for r in reports if not r[2]]
+    slowest = max(r[3] for r in reports)
+    print(f"backend={args.backend} workers={args.workers} threads={args.threads} turns={total} wall={wall:.2f}s")
+    print(f"failed requests: {failures}  lost turns: {lost_turns}  lost leads: {lost_leads}")
+    print(f"setup update seen by all workers: {not unseen} (slowest {slowest:.0f} ms)")
+    for problem in problems[:10]:
+        print("  " + problem)
+    if failures or problems or unseen:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from flask import Flask
+from flask import Flask, Response, request
 from flask_cors import CORS
 from dotenv import load_dotenv
 import os
@@ -19,10 +19,26 @@ def create_app():
     from app.routes.bot_routes import bot_bp
     app.register_blueprint(bot_bp, url_prefix="/api")
 
+    from app.services import metrics
+
     @app.route("/")
     def health_check():
         return {"message": "Backend is running!"}
 
+    # Prometheus scrape target; METRICS_ENABLED=0 turns instrumentation off
+    if metrics.ENABLED:
+        @app.before_request
+        def start_timing():
+            metrics.start_request()
+
+        @app.after_request
+        def record_timing(response):
+            return metrics.finish_request(response, request.endpoint)
+
+        @app.route("/metrics")
+        def metrics_endpoint():
+            return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
     return app
 
 if __name__ == "__main__":